@@ -0,0 +1,95 @@
+"""
+Check that picking a random avatar for /<user>.png costs the same no
+matter how many avatars the user owns.
+
+    uv run python benchmarks/random_avatar.py
+"""
+
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import select
+
+from rav2 import create_app
+from rav2.models import Avatar, db
+
+SIZES = [10, 100, 1_000, 10_000]
+REQUESTS = 500
+
+
+def timed(fn, n: int) -> float:
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1_000_000
+
+
+def main() -> None:
+    db_fd, db_path = tempfile.mkstemp()
+    data_dir = tempfile.TemporaryDirectory()
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}",
+            "AVATAR_DIR": data_dir.name,
+        }
+    )
+    with app.app_context():
+        db.create_all()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "INSERT INTO users(id, name, name_key, pass, email, message) "
+        "VALUES(1, 'bench', 'bench', '', '', '')"
+    )
+    conn.commit()
+
+    # every row shares one tiny file, the response body isn't what
+    # we're measuring
+    hash = "0" * 32
+    os.makedirs(os.path.join(data_dir.name, "00"))
+    with open(os.path.join(data_dir.name, "00", hash), "wb") as fp:
+        fp.write(b"x")
+
+    print(f"{'avatars':>8} {'order by random() µs':>22} {'/bench.png µs':>14}")
+    with app.app_context(), app.test_client() as client:
+        have = 0
+        for size in SIZES:
+            conn.executemany(
+                "INSERT INTO avatars(owner_id, hash, filename, width, height, "
+                "filesize, mime, enabled) VALUES(1, ?, 'x.png', 1, 1, 1, 'PNG', 1)",
+                [(hash,) for _ in range(have, size)],
+            )
+            conn.commit()
+            have = size
+            client.get("/bench.png")  # warm the pool
+
+            def old():
+                db.session.execute(
+                    select(Avatar)
+                    .where(Avatar.owner_id == 1)
+                    .where(Avatar.enabled == True)
+                    .order_by(db.func.random())
+                ).first()
+                db.session.rollback()
+
+            def new():
+                assert client.get("/bench.png").status_code == 200
+
+            print(
+                f"{size:>8} {timed(old, REQUESTS):>22.0f} {timed(new, REQUESTS):>14.0f}"
+            )
+
+    conn.close()
+    os.close(db_fd)
+    os.unlink(db_path)
+    data_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Compare gunicorn's sync workers with the ASGI entry point while lots of
+slow clients are downloading a big avatar: how many requests for an HTML
+page get through, and how long do they take?
+
+    uv run python benchmarks/slow_readers.py [--readers 1000] [--seconds 10]
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from rav2 import create_app
+from rav2.models import db
+
+HASH = "0" * 32
+PORT = 8765
+MODES = {
+    "sync": ["-k", "sync", "rav2:create_app()"],
+    "asgi": ["-k", "asgi", "rav2.asgi:create_asgi_app()"],
+}
+
+
+def make_site(root: str) -> None:
+    data = os.path.join(root, "data")
+    os.makedirs(os.path.join(data, "avatars", HASH[0:2]))
+    with open(os.path.join(data, "secret.txt"), "wb") as fp:
+        fp.write(os.urandom(32))
+    with open(os.path.join(data, "config.py"), "w") as fp:
+        fp.write(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{data}/rav.sqlite'\n")
+        fp.write(f"AVATAR_DIR = {os.path.join(data, 'avatars')!r}\n")
+        # we want to see the file being sent, not the shared memory cache
+        fp.write("HOT_CACHE_BYTES = 0\n")
+    # a 4MB GIF, more than the kernel will buffer for a slow client
+    with open(os.path.join(data, "avatars", HASH[0:2], HASH), "wb") as fp:
+        fp.write(b"GIF89a" + os.urandom(4 * 1024 * 1024))
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        app = create_app()
+        with app.app_context():
+            db.create_all()
+            db.session.execute(
+                db.text(
+                    "INSERT INTO users(id, name, name_key, pass, email, message, "
+                    "avatar_count) VALUES(1, 'bench', 'bench', '', '', '', 1)"
+                )
+            )
+            db.session.execute(
+                db.text(
+                    "INSERT INTO avatars(owner_id, hash, filename, width, height, "
+                    "filesize, mime, enabled) "
+                    f"VALUES(1, '{HASH}', 'big.gif', 1, 1, 4194310, 'GIF', 1)"
+                )
+            )
+            db.session.commit()
+    finally:
+        os.chdir(cwd)
+
+
+async def slow_reader(deadline: float) -> int:
+    """Download the big GIF at 10KB/s, returning how many bytes we got"""
+    sock = socket.socket()
+    # a tiny receive window, so the server can't dump the whole file into
+    # the kernel's buffers and forget about us
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    got = 0
+    try:
+        await loop.sock_connect(sock, ("127.0.0.1", PORT))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(f"GET /{HASH}.gif HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+        while time.monotonic() < deadline:
+            chunk = await reader.read(1024)
+            if not chunk:
+                break
+            got += len(chunk)
+            await asyncio.sleep(0.1)
+        writer.close()
+    except OSError:
+        pass
+    return got
+
+
+async def page_loader(deadline: float, latencies: list[float]) -> int:
+    """Fetch /manual over and over, returning how many requests failed"""
+    failed = 0
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection("127.0.0.1", PORT), 5
+            )
+            writer.write(b"GET /manual HTTP/1.0\r\nHost: bench\r\n\r\n")
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            if response[8:13] != b" 200 ":
+                raise OSError(response[0:20])
+            latencies.append(time.monotonic() - start)
+        except OSError, TimeoutError:
+            failed += 1
+    return failed
+
+
+async def run(readers: int, seconds: float) -> tuple[list[float], int, int]:
+    deadline = time.monotonic() + seconds
+    latencies: list[float] = []
+    slow = [asyncio.create_task(slow_reader(deadline)) for _ in range(readers)]
+    await asyncio.sleep(1)  # let them all get connected
+    fast = [asyncio.create_task(page_loader(deadline, latencies)) for _ in range(10)]
+    got = sum(await asyncio.gather(*slow))
+    failed = sum(await asyncio.gather(*fast))
+    return latencies, failed, got
+
+
+def wait_for_port() -> None:
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", PORT)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server didn't start")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    root = tempfile.TemporaryDirectory()
+    make_site(root.name)
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    }
+
+    print(
+        f"{args.readers} clients reading a 4MB avatar at 10KB/s, "
+        f"10 clients loading /manual, for {args.seconds:.0f}s"
+    )
+    print(
+        f"{'mode':>6} {'pages/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'failed':>7} {'avatar MB':>10}"
+    )
+    for mode, worker_args in MODES.items():
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-w", "4", "-b", f"127.0.0.1:{PORT}"]
+            + worker_args,
+            cwd=root.name,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port()
+            latencies, failed, got = asyncio.run(run(args.readers, args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+        if len(latencies) > 1:
+            p50 = statistics.median(latencies) * 1000
+            p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+        else:
+            p50 = p99 = float("nan")
+        print(
+            f"{mode:>6} {len(latencies) / args.seconds:>8.1f} {p50:>8.1f} "
+            f"{p99:>8.1f} {failed:>7} {got / 1024 / 1024:>10.1f}"
+        )
+
+    root.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""
+Per-route latency and throughput for the main public pages, against a
+synthetic site: N users with a skewed number of avatars each (a few
+users own most of them, as on the real site), and a real image file
+for every avatar.
+
+Each route is measured in-process with Flask's test client, and over
+HTTP against gunicorn; results can be saved as a baseline and later
+runs compared against it, exiting with status 1 if anything got slower.
+
+    uv run python benchmarks/suite.py --save baseline.json
+    ... change things ...
+    uv run python benchmarks/suite.py --compare baseline.json
+
+The dataset is generated from --seed, so the same options give the same
+site; pass --dataset DIR to keep it between runs rather than making a
+new one each time.
+"""
+
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw
+
+from rav2 import create_app
+from rav2.models import db
+from rav2.storage import BlobStore
+
+PORT = 8766
+SIZES = [(64, 64), (100, 100), (128, 128), (150, 150), (200, 200), (320, 240)]
+SERVERS = {
+    "sync": ["-k", "sync", "rav2:create_app()"],
+    "asgi": ["-k", "asgi", "rav2.asgi:create_asgi_app()"],
+}
+
+
+class Dataset(t.NamedTuple):
+    # (username, number of avatars), and (hash, has a thumbnail)
+    users: list[tuple[str, int]]
+    avatars: list[tuple[str, bool]]
+
+
+class Stats(t.NamedTuple):
+    p50: float
+    p90: float
+    p99: float
+    rps: float
+
+
+###################################################################
+# Dataset
+
+
+def skewed(rng: random.Random, n: int, k: int, s: float = 1.1) -> list[int]:
+    """`k` picks from range(n), zipf-distributed so that 0 is the most popular"""
+    return rng.choices(range(n), [1 / (i + 1) ** s for i in range(n)], k=k)
+
+
+def make_image(rng: random.Random) -> tuple[bytes, int, int]:
+    width, height = rng.choice(SIZES)
+    img = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in "rgb"))
+    draw = ImageDraw.Draw(img)
+    for _ in range(8):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle(
+            (x, y, x + rng.randrange(width // 2), y + rng.randrange(height // 2)),
+            fill=tuple(rng.randrange(256) for _ in "rgb"),
+        )
+    out = io.BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue(), width, height
+
+
+def make_dataset(root: str, users: int, avatars: int, seed: int) -> Dataset:
+    """
+    Create a site in `root` (run it with `root` as the current directory),
+    or load the one which is already there if it has the same parameters
+    """
+    data = os.path.join(root, "data")
+    params = {"users": users, "avatars": avatars, "seed": seed}
+    stamp = os.path.join(data, "dataset.json")
+    if os.path.exists(stamp):
+        with open(stamp) as fp:
+            saved = json.load(fp)
+        if saved["params"] == params:
+            return Dataset(
+                [tuple(u) for u in saved["users"]], [tuple(a) for a in saved["avatars"]]
+            )
+        shutil.rmtree(data)
+
+    os.makedirs(data)
+    with open(os.path.join(data, "secret.txt"), "wb") as fp:
+        fp.write(b"benchmark")
+    with open(os.path.join(data, "config.py"), "w") as fp:
+        fp.write(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{data}/rav.sqlite'\n")
+
+    rng = random.Random(seed)
+    owners = skewed(rng, users, avatars)
+    counts = [0] * users
+    for owner in owners:
+        counts[owner] += 1
+    user_rows = [
+        (id + 1, f"user{id}", f"user{id}", hashlib.md5(b"bench").hexdigest(), "", "", n)
+        for id, n in enumerate(counts)
+    ]
+    store = BlobStore(os.path.join(data, "avatars"))
+    avatar_rows = []
+    for id, owner in enumerate(owners, 1):
+        body, width, height = make_image(rng)
+        hash = hashlib.md5(body).hexdigest()
+        store.put(hash, body)
+        avatar_rows.append(
+            (id, owner + 1, hash, f"{id}.png", width, height, len(body), "PNG", 1)
+        )
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        with create_app().app_context():
+            db.create_all()
+    finally:
+        os.chdir(cwd)
+    conn = sqlite3.connect(os.path.join(data, "rav.sqlite"))
+    conn.executemany(
+        "INSERT INTO users(id, name, name_key, pass, email, message, avatar_count) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?)",
+        user_rows,
+    )
+    conn.executemany(
+        "INSERT INTO avatars(id, owner_id, hash, filename, width, height, "
+        "filesize, mime, enabled) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        avatar_rows,
+    )
+    conn.commit()
+    conn.close()
+
+    dataset = Dataset(
+        [(row[1], count) for row, count in zip(user_rows, counts)],
+        [(row[2], max(row[4], row[5]) > 144) for row in avatar_rows],
+    )
+    with open(stamp, "w") as fp:
+        json.dump({"params": params, **dataset._asdict()}, fp)
+    return dataset
+
+
+def make_urls(dataset: Dataset, n: int, seed: int) -> dict[str, list[str]]:
+    """`n` URLs for each route, popular users and avatars coming up most"""
+    rng = random.Random(seed)
+    # most-owned first, so that skewed() favours them
+    owners = sorted((u for u in dataset.users if u[1]), key=lambda u: -u[1])
+    thumbed = [hash for hash, thumb in dataset.avatars if thumb]
+    users = [owners[i][0] for i in skewed(rng, len(owners), n)]
+    return {
+        "/": ["/"] * n,
+        "/gallery": ["/gallery"] * n,
+        "/<user>.html": [f"/{u}.html" for u in users],
+        "/<user>.png": [f"/{u}.png" for u in users],
+        "/<hash>.png": [
+            f"/{dataset.avatars[i][0]}.png"
+            for i in skewed(rng, len(dataset.avatars), n)
+        ],
+        "/thumbs/<hash>.png": [
+            f"/thumbs/{thumbed[i]}.png" for i in skewed(rng, len(thumbed), n)
+        ],
+    }
+
+
+###################################################################
+# Measurement
+
+
+def summarise(latencies: list[float], elapsed: float) -> Stats:
+    q = statistics.quantiles(latencies, n=100)
+    return Stats(
+        statistics.median(latencies) * 1000,
+        q[89] * 1000,
+        q[98] * 1000,
+        len(latencies) / elapsed,
+    )
+
+
+def bench_client(root: str, urls: dict[str, list[str]], warmup: int) -> dict:
+    """One request at a time, in this process"""
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        app = create_app()
+        results = {}
+        with app.app_context(), app.test_client() as client:
+            for route, paths in urls.items():
+                for path in paths[0:warmup]:
+                    client.get(path)
+                latencies = []
+                start = time.perf_counter()
+                for path in paths:
+                    before = time.perf_counter()
+                    response = client.get(path)
+                    assert response.status_code == 200, (path, response.status)
+                    latencies.append(time.perf_counter() - before)
+                results[route] = summarise(latencies, time.perf_counter() - start)
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+def bench_server(
+    root: str,
+    urls: dict[str, list[str]],
+    warmup: int,
+    server: str,
+    workers: int,
+    clients: int,
+) -> dict:
+    """`clients` threads making requests at once, against gunicorn"""
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    }
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-w",
+            str(workers),
+            "-b",
+            f"127.0.0.1:{PORT}",
+        ]
+        + SERVERS[server],
+        cwd=root,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    local = threading.local()
+
+    def fetch(path: str) -> float:
+        if not hasattr(local, "conn"):
+            local.conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=30)
+        before = time.perf_counter()
+        local.conn.request("GET", path)
+        response = local.conn.getresponse()
+        response.read()
+        if response.will_close:
+            local.conn.close()
+        assert response.status == 200, (path, response.status)
+        return time.perf_counter() - before
+
+    try:
+        wait_for_port()
+        results = {}
+        with ThreadPoolExecutor(clients) as pool:
+            for route, paths in urls.items():
+                list(pool.map(fetch, paths[0:warmup]))
+                start = time.perf_counter()
+                latencies = list(pool.map(fetch, paths))
+                results[route] = summarise(latencies, time.perf_counter() - start)
+        return results
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def wait_for_port() -> None:
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", PORT)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server didn't start")
+
+
+###################################################################
+# Reporting
+
+
+def report(
+    mode: str, results: dict[str, Stats], baseline: dict | None, tolerance: float
+) -> list[str]:
+    """Print a table of results, returning the routes which got slower"""
+    print(f"\n{mode}")
+    print(
+        f"{'route':<20} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'req/s':>8}"
+        + (f" {'p50 vs base':>12} {'req/s vs base':>14}" if baseline else "")
+    )
+    regressions = []
+    for route, stats in results.items():
+        line = (
+            f"{route:<20} {stats.p50:>8.2f} {stats.p90:>8.2f} {stats.p99:>8.2f} "
+            f"{stats.rps:>8.0f}"
+        )
+        if baseline and route in baseline:
+            base = Stats(**baseline[route])
+            slower = stats.p50 / base.p50 - 1
+            fewer = base.rps / stats.rps - 1
+            line += f" {slower:>+12.0%} {-fewer:>+14.0%}"
+            if slower > tolerance or fewer > tolerance:
+                line += "  REGRESSION"
+                regressions.append(f"{mode} {route}")
+        print(line)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--avatars", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dataset", help="Directory to keep the dataset in")
+    parser.add_argument("--requests", type=int, default=500, help="Per route")
+    parser.add_argument("--warmup", type=int, default=50, help="Per route")
+    parser.add_argument("--mode", choices=["client", "server", "both"], default="both")
+    parser.add_argument("--server", choices=list(SERVERS), default="asgi")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with results saved by --save")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Slow-down (of p50 or req/s) counted as a regression",
+    )
+    args = parser.parse_args()
+
+    tmp = None
+    if args.dataset:
+        root = os.path.abspath(args.dataset)
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        root = tmp.name
+    start = time.perf_counter()
+    dataset = make_dataset(root, args.users, args.avatars, args.seed)
+    print(
+        f"{len(dataset.users)} users, {len(dataset.avatars)} avatars "
+        f"(busiest user has {max(u[1] for u in dataset.users)}), "
+        f"ready in {time.perf_counter() - start:.1f}s"
+    )
+    urls = make_urls(dataset, args.requests, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline["params"] != vars(args) | {"save": None, "compare": None}:
+            print("Warning: the baseline was run with different options")
+
+    results = {}
+    if args.mode in ("client", "both"):
+        results["client"] = bench_client(root, urls, args.warmup)
+    if args.mode in ("server", "both"):
+        results[f"gunicorn {args.server}"] = bench_server(
+            root, urls, args.warmup, args.server, args.workers, args.clients
+        )
+
+    regressions = []
+    for mode, stats in results.items():
+        regressions += report(
+            mode,
+            stats,
+            baseline["results"].get(mode) if baseline else None,
+            args.tolerance,
+        )
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(
+                {
+                    "params": vars(args) | {"save": None, "compare": None},
+                    "results": {
+                        mode: {route: s._asdict() for route, s in stats.items()}
+                        for mode, stats in results.items()
+                    },
+                },
+                fp,
+                indent=2,
+            )
+    if tmp:
+        tmp.cleanup()
+    if regressions:
+        print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import functools
 import hashlib
 import os
+import threading
+import time
 import typing as t
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import UTC, datetime
 
 import click
 from flask import (
@@ -12,16 +16,59 @@ from flask import (
     redirect,
     render_template,
     request,
+    send_file,
     send_from_directory,
     session,
     url_for,
 )
-from sqlalchemy import select, text
+from flask.ctx import _AppCtxGlobals
+from markupsafe import Markup
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from .models import Avatar, User, db
+from . import importer, jobs, sqlite
+from .formats import FormatCache
+from .fragments import FragmentCache
+from .hotcache import HotCache
+from .metrics import Metrics, metrics, time_queries
+from .migrate import MigrateError, migrate
+from .models import (
+    Avatar,
+    AvatarAddError,
+    Counter,
+    Job,
+    User,
+    count_avatars,
+    db,
+    ingest,
+    name_key,
+    recount_avatars,
+    thumb_size,
+)
+from .names import NameCache
+from .sampling import PoolCache
+from .storage import BlobStore, PackStore, collect_garbage
+from .variants import Size, VariantCache
 
 std_width = 512
+max_scale = 1024
+
+
+class Globals(_AppCtxGlobals):
+    """
+    Flask's `g`, except that `g.user` is only looked up the first time a
+    view asks for it, so that image requests from a logged-in browser
+    don't cost a query on the users table.
+    """
+
+    def __getattr__(self, name: str) -> t.Any:
+        if name == "user":
+            user_id = session.get("user_id")
+            self.user = None if user_id is None else db.get_or_404(User, user_id)
+            return self.user
+        return super().__getattr__(name)
 
 
 def create_app(test_config=None):
@@ -29,6 +76,7 @@ def create_app(test_config=None):
     # Load config
 
     app = Flask(__name__, instance_path=os.path.abspath("./data"))
+    app.app_ctx_globals_class = Globals  # ty: ignore
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)  # ty: ignore
     if not os.path.exists("./data"):  # pragma: no cover
         os.makedirs("./data")
@@ -37,9 +85,84 @@ def create_app(test_config=None):
             fp.write(os.urandom(32))
     with open("./data/secret.txt", "rb") as fp:
         secret_key = fp.read()
+    # shared-memory files are named after the instance, so that two sites
+    # on one machine don't share them
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else app.instance_path
+    shm_name = f"rav2-{hashlib.md5(app.instance_path.encode()).hexdigest()[0:8]}"
     app.config.from_mapping(
         SECRET_KEY=secret_key,
         SQLALCHEMY_DATABASE_URI="sqlite:///rav.sqlite",
+        # set on every connection to an SQLite database
+        SQLITE_PRAGMAS={
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -16 * 1024,  # KiB
+            # how long (in ms) to wait for another worker's write to finish
+            "busy_timeout": 5000,
+        },
+        # how long (in seconds) a worker may keep using its cached list of
+        # a user's enabled avatars before re-reading it from the database
+        AVATAR_POOL_TTL=60,
+        # usernames whose ids each worker remembers for /<user>.png, and
+        # for how long (in seconds)
+        USER_ID_CACHE_ITEMS=10_000,
+        USER_ID_CACHE_TTL=60,
+        AVATAR_DIR=os.path.join(app.instance_path, "avatars"),
+        # if set, avatar bodies are sent by the front-end proxy rather than
+        # by us; eg with nginx:
+        #   AVATAR_ACCEL_REDIRECT = "/_avatars/"
+        #   location /_avatars/ { internal; alias /data/avatars/; }
+        # (for apache / lighttpd, set USE_X_SENDFILE = True instead)
+        AVATAR_ACCEL_REDIRECT=None,
+        # scaled copies for ?scale=WxH, least-recently-used are deleted
+        # when they add up to more than AVATAR_VARIANT_BYTES
+        AVATAR_VARIANT_DIR=os.path.join(app.instance_path, "variants"),
+        AVATAR_VARIANT_BYTES=256 * 1024 * 1024,
+        # more compact formats to send to browsers which accept them (as
+        # far as Pillow can write them); each avatar is encoded in the
+        # background the first time it's asked for, and browsers get the
+        # smallest copy they accept
+        AVATAR_FORMATS=["avif", "webp"],
+        AVATAR_FORMAT_DIR=os.path.join(app.instance_path, "formats"),
+        AVATAR_FORMAT_THREADS=2,
+        # "files" stores each avatar as AVATAR_DIR/xx/<hash>; "packs"
+        # appends them to large files in AVATAR_DIR/packs/ (see the
+        # pack-storage command for converting an existing tree)
+        AVATAR_STORAGE="files",
+        THUMB_DIR=os.path.join(app.instance_path, "thumbs"),
+        AVATAR_MAX_BYTES=10 * 1024 * 1024,
+        AVATAR_MAX_PIXELS=4096 * 4096,
+        # avatars of up to 1/16th of HOT_CACHE_BYTES are kept in memory,
+        # one copy shared by all workers; 0 to disable. (docker only gives
+        # containers 64MB of /dev/shm unless run with --shm-size)
+        HOT_CACHE_BYTES=32 * 1024 * 1024,
+        HOT_CACHE_PATH=os.path.join(shm_dir, f"{shm_name}.hot"),
+        # threads per worker for running views when serving via rav2.asgi;
+        # each may hold a database connection, so the pools are the same size
+        ASGI_THREADS=8,
+        # request bodies (ie uploads) over this many bytes are spooled to a
+        # temporary file by rav2.asgi, rather than held in memory
+        ASGI_SPOOL_BYTES=256 * 1024,
+        # avatars shown on each page of a user's gallery (and listed by each
+        # page of /api/<user>/avatars)
+        AVATARS_PER_PAGE=100,
+        # rendered HTML for the gallery pages, per worker
+        FRAGMENT_CACHE_BYTES=16 * 1024 * 1024,
+        # each worker's counters for /metrics go in a file here, so that they
+        # can be added up; None to disable. Files from old workers are kept,
+        # so that counters don't go backwards - clear it out when restarting
+        METRICS_DIR=os.path.join(shm_dir, f"{shm_name}.metrics"),
+        # log requests which take longer than this many seconds, along with
+        # the SQL they ran; None to disable
+        SLOW_REQUEST_SECONDS=None,
+        # background jobs (see `flask worker`): how often an idle worker
+        # checks for new ones, how many times to try each, how long to wait
+        # before the first retry (doubling each time after that), and how
+        # long a job may run before it's assumed that its worker has died
+        JOB_POLL_SECONDS=1,
+        JOB_ATTEMPTS=5,
+        JOB_RETRY_SECONDS=30,
+        JOB_LEASE_SECONDS=600,
     )
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -47,11 +170,24 @@ def create_app(test_config=None):
     else:
         # load the test config if passed in
         app.config.from_mapping(test_config)
+    if app.config["MAX_CONTENT_LENGTH"] is None:
+        # reject oversized uploads before reading them, allowing some
+        # room for the other form fields
+        app.config["MAX_CONTENT_LENGTH"] = app.config["AVATAR_MAX_BYTES"] + 64 * 1024
 
     ###################################################################
     # Load database
 
+    sqlite.configure(app)
     db.init_app(app)
+    with app.app_context():
+        sqlite.tune(db.engines, app.config["SQLITE_PRAGMAS"])
+    store_class = {"files": BlobStore, "packs": PackStore}[app.config["AVATAR_STORAGE"]]
+    app.extensions["rav2.blobs"] = store_class(app.config["AVATAR_DIR"])
+    app.extensions["rav2.thumbs"] = BlobStore(app.config["THUMB_DIR"])
+    app.extensions["rav2.metrics"] = Metrics(app.config["METRICS_DIR"])
+    with app.app_context():
+        time_queries(db.engines)
 
     @click.command("init-db")
     def init_db_command():  # pragma: no cover
@@ -62,26 +198,644 @@ def create_app(test_config=None):
 
     app.cli.add_command(init_db_command)
 
+    @click.command("migrate-db")
+    def migrate_db_command():
+        """Upgrade an existing database to the current schema."""
+        with app.app_context():
+            try:
+                changes = migrate()
+            except MigrateError as e:
+                raise click.ClickException(str(e)) from e
+            for change in changes:
+                click.echo(change)
+        click.echo("Database is up to date.")
+
+    app.cli.add_command(migrate_db_command)
+
+    @click.command("rebuild-leaderboard")
+    @click.option("--verify", is_flag=True, help="Report, but don't fix")
+    def rebuild_leaderboard_command(verify: bool):
+        """Check each user's avatar count (for the gallery) from scratch."""
+        with app.app_context():
+            actual = (
+                select(Avatar.owner_id, db.func.count().label("count"))
+                .group_by(Avatar.owner_id)
+                .subquery()
+            )
+            count = db.func.coalesce(actual.c.count, 0)
+            wrong = db.session.execute(
+                select(User.username, User.avatar_count, count)
+                .outerjoin(actual, actual.c.owner_id == User.id)
+                .where(User.avatar_count != count)
+            ).all()
+            for username, stored, real in wrong:
+                click.echo(f"{username}: counted {stored}, has {real}")
+            if verify:
+                if wrong:
+                    raise click.ClickException(f"{len(wrong)} users are wrong")
+                click.echo("All users are right.")
+                return
+            db.session.execute(recount_avatars())
+            Counter.bump("gallery")
+            db.session.commit()
+        click.echo(f"Fixed {len(wrong)} users.")
+
+    app.cli.add_command(rebuild_leaderboard_command)
+
+    @click.command("gc-storage")
+    @click.option(
+        "--grace",
+        default=3600,
+        help="Leave files modified in the last this-many seconds alone",
+    )
+    @click.option("--dry-run", is_flag=True, help="Report, but don't delete")
+    def gc_storage_command(grace: int, dry_run: bool):
+        """Delete files which no avatar uses any more; list missing ones."""
+        with app.app_context():
+            referenced = set(
+                db.session.execute(select(Avatar.hash).distinct()).scalars()
+            )
+            db.session.commit()
+
+            def in_use(hash: str) -> bool:
+                # (a transaction of its own, to see avatars added since)
+                found = db.session.execute(
+                    select(Avatar.id).where(Avatar.hash == hash).limit(1)
+                ).first()
+                db.session.commit()
+                return found is not None
+
+            report = collect_garbage(
+                app.extensions["rav2.blobs"],
+                [
+                    app.config["THUMB_DIR"],
+                    app.config["AVATAR_VARIANT_DIR"],
+                    app.config["AVATAR_FORMAT_DIR"],
+                ],
+                referenced,
+                grace,
+                dry_run,
+                in_use,
+            )
+        for hash in report.missing:
+            click.echo(f"Missing: {hash}", err=True)
+        click.echo(
+            f"{'Would delete' if dry_run else 'Deleted'} {report.deleted} files "
+            f"({report.deleted_bytes} bytes), {len(report.missing)} missing."
+        )
+
+    app.cli.add_command(gc_storage_command)
+
+    @click.command("pack-storage")
+    @click.option("--delete", is_flag=True, help="Delete files once packed")
+    def pack_storage_command(delete: bool):
+        """Copy avatar files into pack files, for AVATAR_STORAGE = "packs"."""
+        files = BlobStore(app.config["AVATAR_DIR"])
+        packs = PackStore(app.config["AVATAR_DIR"])
+        count = size = 0
+        # safe to re-run after an interruption - blobs which are already
+        # in a pack are skipped
+        for hash, _, length in list(files.entries()):
+            with files.open(hash) as fp:
+                packs.put(hash, fp.read())
+            if delete:
+                files.delete(hash)
+            count += 1
+            size += length
+        click.echo(f"Packed {count} files ({size} bytes).")
+
+    app.cli.add_command(pack_storage_command)
+
+    @click.command("compact-packs")
+    def compact_packs_command():
+        """Reclaim the space used by deleted avatars in pack files."""
+        packs = PackStore(app.config["AVATAR_DIR"])
+        click.echo(f"Reclaimed {packs.compact()} bytes.")
+
+    app.cli.add_command(compact_packs_command)
+
+    def worker_settings() -> importer.Settings:
+        """For the processes of the commands below (see `rav2.importer`)"""
+        return importer.Settings(
+            app.config["AVATAR_STORAGE"],
+            app.config["AVATAR_DIR"],
+            app.config["THUMB_DIR"],
+            app.config["AVATAR_MAX_BYTES"],
+            app.config["AVATAR_MAX_PIXELS"],
+        )
+
+    @click.command("backfill-thumbs")
+    @click.option("--workers", default=os.cpu_count(), help="Processes to use")
+    def backfill_thumbs_command(workers: int):
+        """Create any gallery thumbnails which are missing."""
+        with app.app_context():
+            todo = [
+                (avatar.hash, avatar.thumbname, avatar.mime)
+                for avatar in db.session.execute(
+                    select(Avatar).where(
+                        or_(Avatar.width > thumb_size, Avatar.height > thumb_size)
+                    )
+                ).scalars()
+                if not os.path.exists(avatar.thumbname)
+            ]
+        failed = 0
+        with ProcessPoolExecutor(
+            workers, initializer=importer.init_worker, initargs=(worker_settings(),)
+        ) as pool:
+            futures = {
+                pool.submit(importer.thumb_one, hash, mime): dst
+                for hash, dst, mime in todo
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    click.echo(f"{futures[future]}: {e}", err=True)
+                    failed += 1
+        click.echo(f"Created {len(todo) - failed} thumbnails, {failed} failed.")
+
+    app.cli.add_command(backfill_thumbs_command)
+
+    @click.command("encode-formats")
+    @click.option("--workers", default=os.cpu_count(), help="Processes to use")
+    def encode_formats_command(workers: int):
+        """Create the AVATAR_FORMATS copies of every avatar ahead of time."""
+        with app.app_context():
+            todo = {
+                formats.path(avatar.hash, format): (
+                    avatar.hash,
+                    format,
+                    avatar.filesize,
+                )
+                for avatar in db.session.execute(select(Avatar)).scalars()
+                for format in formats.formats
+                if not os.path.exists(formats.path(avatar.hash, format))
+            }
+        encoded = saved = failed = 0
+        with ProcessPoolExecutor(
+            workers, initializer=importer.init_worker, initargs=(worker_settings(),)
+        ) as pool:
+            futures = {
+                pool.submit(importer.encode_one, hash, dst, format, limit): (dst, limit)
+                for dst, (hash, format, limit) in todo.items()
+            }
+            for future in as_completed(futures):
+                dst, limit = futures[future]
+                try:
+                    size = future.result()
+                except (OSError, ValueError) as e:
+                    click.echo(f"{dst}: {e}", err=True)
+                    failed += 1
+                    continue
+                if size:
+                    encoded += 1
+                    saved += limit - size
+        click.echo(
+            f"Encoded {encoded} files ({saved} bytes smaller than the originals), "
+            f"{len(todo) - encoded - failed} not worth it, {failed} failed."
+        )
+
+    app.cli.add_command(encode_formats_command)
+
+    @click.command("import-avatars")
+    @click.argument("username")
+    @click.argument("source", type=click.Path(exists=True))
+    @click.option("--workers", default=os.cpu_count(), help="Processes to use")
+    @click.option("--batch", default=500, help="Avatars to add per transaction")
+    def import_avatars_command(username: str, source: str, workers: int, batch: int):
+        """
+        Add every image in a directory or zip file to a user's avatars.
+        Images which the user already has are skipped, so an interrupted
+        import can just be run again. The running site picks them for
+        /<user>.png once its AVATAR_POOL_TTL is up.
+        """
+        files = importer.find_jobs(source)
+        imported = skipped = failed = 0
+        with app.app_context():
+            user = db.session.execute(
+                select(User).where(User.name_key == name_key(username))
+            ).scalar_one_or_none()
+            if user is None:
+                raise click.ClickException(f"No such user: {username}")
+            user_id = user.id
+            existing = set(
+                db.session.execute(
+                    select(Avatar.hash).where(Avatar.owner_id == user_id)
+                ).scalars()
+            )
+            # let go of the write lock while the first batch is processed
+            db.session.rollback()
+            added = 0
+            with ProcessPoolExecutor(
+                workers, initializer=importer.init_worker, initargs=(worker_settings(),)
+            ) as pool:
+                for done, result in enumerate(
+                    pool.map(importer.import_one, files, chunksize=16), 1
+                ):
+                    if result.info is None:
+                        click.echo(f"{result.job.name}: {result.error}", err=True)
+                        failed += 1
+                    elif result.info.hash in existing:
+                        skipped += 1
+                    else:
+                        existing.add(result.info.hash)
+                        # (not user.avatars.append(), which would load them
+                        # all again after every commit)
+                        avatar = Avatar(result.job.name, result.info)
+                        avatar.owner_id = user_id
+                        db.session.add(avatar)
+                        added += 1
+                    if added == batch or (done == len(files) and added):
+                        count_avatars(user_id, added)
+                        Counter.bump("gallery", f"user:{user_id}")
+                        db.session.commit()
+                        imported += added
+                        added = 0
+                        click.echo(f"{done}/{len(files)} files done")
+        click.echo(
+            f"Imported {imported} avatars, {skipped} already there, {failed} failed."
+        )
+
+    app.cli.add_command(import_avatars_command)
+
+    @click.command("worker")
+    @click.option("--threads", default=2, help="Jobs to run at once")
+    @click.option("--burst", is_flag=True, help="Exit when no jobs are due")
+    def worker_command(threads: int, burst: bool):
+        """Run queued background jobs (thumbnails, compact formats)."""
+        stop = threading.Event()
+        results: list[str] = []
+
+        def work() -> None:
+            with app.app_context():
+                while not stop.is_set():
+                    try:
+                        result = jobs.run_one()
+                    except OperationalError as e:
+                        # most likely the database was locked for longer
+                        # than busy_timeout; the job's lease will run out
+                        # and it'll be picked up again
+                        app.logger.warning(f"Worker can't run jobs: {e.orig}")
+                        db.session.rollback()
+                        result = None
+                    if result is not None:
+                        results.append(result)
+                    elif burst:
+                        return
+                    else:  # pragma: no cover
+                        stop.wait(app.config["JOB_POLL_SECONDS"])
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:  # pragma: no cover
+            # let the jobs which are running finish
+            stop.set()
+            for worker in workers:
+                worker.join()
+        click.echo(
+            f"Ran {len(results)} jobs: {results.count('done')} done, "
+            f"{results.count('retry')} to retry, {results.count('failed')} failed."
+        )
+
+    app.cli.add_command(worker_command)
+
+    ###################################################################
+    # Finding users
+
+    def find_user(username: str) -> User:
+        """The user with this name, ignoring case, or a 404"""
+        return db.one_or_404(select(User).where(User.name_key == name_key(username)))
+
+    # name_key -> user id, for the requests which only need the id
+    user_ids = NameCache(
+        app.config["USER_ID_CACHE_ITEMS"], app.config["USER_ID_CACHE_TTL"]
+    )
+
+    def find_user_id(username: str) -> int:
+        """The id of the user with this name, ignoring case, or a 404"""
+        key = name_key(username)
+        user_id = user_ids.get(
+            key,
+            counted(
+                "user_ids",
+                lambda: db.session.scalar(select(User.id).where(User.name_key == key)),
+            ),
+        )
+        if user_id is None:
+            abort(404)
+        return user_id
+
+    ###################################################################
+    # Random avatar selection
+
+    # user_id -> ids of that user's enabled avatars
+    user_pools: PoolCache[int] = PoolCache(app.config["AVATAR_POOL_TTL"])
+
+    def load_user_pool(user_id: int) -> t.Callable[[], t.Iterable[int]]:
+        return lambda: db.session.execute(
+            select(Avatar.id)
+            .where(Avatar.owner_id == user_id)
+            .where(Avatar.enabled == True)
+        ).scalars()
+
+    def random_avatar(user_id: int) -> Avatar | None:
+        avatar_id = user_pools.get(user_id, load_user_pool(user_id)).choice()
+        if avatar_id is None:
+            return None
+        avatar = db.session.get(Avatar, avatar_id)
+        if avatar and avatar.owner_id == user_id and avatar.enabled:
+            return avatar
+        # another worker changed this user's avatars since we loaded
+        # the pool, so reload it and try once more
+        user_pools.invalidate(user_id)
+        avatar_id = user_pools.get(user_id, load_user_pool(user_id)).choice()
+        return db.session.get(Avatar, avatar_id) if avatar_id is not None else None
+
+    # ids of all avatars which are suitable for the front page and gallery
+    showcase_pools: PoolCache[str] = PoolCache(app.config["AVATAR_POOL_TTL"])
+
+    def in_showcase(avatar: Avatar) -> bool:
+        return (
+            avatar.enabled and avatar.width <= std_width and avatar.height <= std_width
+        )
+
+    def load_showcase_pool() -> t.Iterable[int]:
+        return db.session.execute(
+            select(Avatar.id)
+            .where(Avatar.enabled == True)
+            .where(Avatar.width <= std_width)
+            .where(Avatar.height <= std_width)
+        ).scalars()
+
+    def random_showcase(k: int) -> list[Avatar]:
+        ids = showcase_pools.get("all", load_showcase_pool).sample(k)
+        avatars = {
+            avatar.id: avatar
+            for avatar in db.session.execute(
+                select(Avatar)
+                .options(joinedload(Avatar.owner))
+                .where(Avatar.id.in_(ids))
+                .where(Avatar.enabled == True)
+            ).scalars()
+        }
+        return [avatars[id] for id in ids if id in avatars]
+
+    def avatar_changed(avatar: Avatar, deleted: bool = False) -> None:
+        """Update the random pools after an avatar was added / changed / deleted"""
+        user_pools.invalidate(avatar.owner_id)
+        pool = showcase_pools.peek("all")
+        if pool is not None:
+            if not deleted and in_showcase(avatar):
+                pool.add(avatar.id)
+            else:
+                pool.remove(avatar.id)
+
+    variants = VariantCache(
+        app.config["AVATAR_VARIANT_DIR"], app.config["AVATAR_VARIANT_BYTES"]
+    )
+
+    formats = app.extensions["rav2.formats"] = FormatCache(
+        app.config["AVATAR_FORMAT_DIR"],
+        app.config["AVATAR_FORMATS"],
+        app.config["AVATAR_FORMAT_THREADS"],
+    )
+
+    fragments = FragmentCache(app.config["FRAGMENT_CACHE_BYTES"])
+
+    def counted[T](cache: str, make: t.Callable[[], T]) -> t.Callable[[], T]:
+        """
+        Count a lookup in `cache`, and wrap the function which creates what
+        was looked up (which the cache only calls when it misses) to count
+        a miss
+        """
+        metrics().inc("rav2_cache_lookups_total", cache=cache)
+
+        def wrapped() -> T:
+            metrics().inc("rav2_cache_misses_total", cache=cache)
+            return make()
+
+        return wrapped
+
+    hot = (
+        HotCache(app.config["HOT_CACHE_PATH"], app.config["HOT_CACHE_BYTES"])
+        if app.config["HOT_CACHE_BYTES"]
+        else None
+    )
+
+    @click.command("cache-stats")
+    def cache_stats_command():
+        """Show how well the shared avatar cache is doing."""
+        if hot is None:
+            click.echo("HOT_CACHE_BYTES is 0, the cache is disabled.")
+            return
+        stats = hot.stats()
+        # lookups are counted by each worker, see send_original()
+        totals = app.extensions["rav2.metrics"].totals()
+        labels = (("cache", "hot"),)
+        total = int(totals.get(("rav2_cache_lookups_total", labels), 0))
+        misses = int(totals.get(("rav2_cache_misses_total", labels), 0))
+        hits = total - misses
+        click.echo(
+            f"{stats.items} avatars cached; {hits} hits, {misses} "
+            f"misses ({hits / total if total else 0:.0%} hit rate), "
+            f"{stats.evictions} evictions."
+        )
+
+    app.cli.add_command(cache_stats_command)
+
     ###################################################################
     # Route utils
 
     @app.before_request
-    def load_logged_in_user():
-        user_id = session.get("user_id")
-        if user_id is None:
-            g.user = None
-        else:
-            g.user = db.get_or_404(User, user_id)
+    def forget_logged_in_user():
+        # normally each request gets a fresh `g`, but if the app context
+        # is shared (eg in tests) then don't keep the previous request's user
+        g.pop("user", None)
+
+    @app.before_request
+    def start_timing():
+        g.request_start = time.perf_counter()
+        g.sql = []
+
+    @app.after_request
+    def record_timing(response: Response) -> Response:
+        start = g.pop("request_start", None)
+        if start is None:  # pragma: no cover
+            return response
+        elapsed = time.perf_counter() - start
+        sql = g.pop("sql")
+        sql_seconds = sum(seconds for seconds, _ in sql)
+        route = request.endpoint or "none"
+        m = metrics()
+        m.inc("rav2_requests_total", route=route, status=str(response.status_code))
+        m.observe("rav2_request_duration_seconds", elapsed, route=route)
+        m.inc("rav2_sql_statements_total", len(sql), route=route)
+        m.inc("rav2_sql_seconds_total", sql_seconds, route=route)
+        m.observe("rav2_sql_statements_per_request", len(sql))
+        slow = app.config["SLOW_REQUEST_SECONDS"]
+        if slow is not None and elapsed >= slow:
+            app.logger.warning(
+                f"Slow request: {request.method} {request.full_path} took "
+                f"{elapsed * 1000:.1f}ms, {len(sql)} SQL statements took "
+                f"{sql_seconds * 1000:.1f}ms"
+                + "".join(
+                    f"\n  {seconds * 1000:7.1f}ms {statement}"
+                    for seconds, statement in sql
+                )
+            )
+        return response
 
     def login_required(view):
         @functools.wraps(view)
         def wrapped_view(**kwargs):
-            if g.user is None:
+            # (without loading g.user, so that the view decides when its
+            # transaction starts)
+            if session.get("user_id") is None:
                 return redirect(url_for("index"))
             return view(**kwargs)
 
         return wrapped_view
 
+    def read_only(view):
+        """Send the view's queries to the read-only connection pool"""
+
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            g.read_only = True
+            try:
+                return view(**kwargs)
+            finally:
+                g.read_only = False
+
+        return wrapped_view
+
+    @app.errorhandler(OperationalError)
+    def database_busy(e: OperationalError):
+        if "database is locked" not in str(e.orig):
+            raise e
+        # another worker kept the database locked for longer than
+        # busy_timeout; we're overloaded, but this isn't a bug
+        app.logger.warning(f"Gave up waiting for the database: {e.orig}")
+        return "The site is busy, please try again", 503, {"Retry-After": "1"}
+
+    def get_scale() -> Size | None:
+        scale = request.args.get("scale")
+        if not scale:
+            return None
+        try:
+            width, height = (int(n) for n in scale.split("x"))
+        except ValueError:
+            abort(400, "scale should be WIDTHxHEIGHT")
+        if not (0 < width <= max_scale and 0 < height <= max_scale):
+            abort(400, f"scale should be between 1x1 and {max_scale}x{max_scale}")
+        return width, height
+
+    def etag_for(hash: str, size: Size | None) -> str:
+        return f"{hash}-{size[0]}x{size[1]}" if size else hash
+
+    def accepted_formats(size: Size | None) -> list[str]:
+        """The compact formats which we could send instead of the original"""
+        if size is not None:
+            return []
+        # only formats which are asked for by name - "*/*" doesn't count
+        named = {value for value, quality in request.accept_mimetypes if quality}
+        return [format for format in formats.formats if f"image/{format}" in named]
+
+    def send_avatar(avatar: Avatar, size: Size | None = None) -> Response:
+        mimetype = "image/" + avatar.mime.lower()
+        etag = etag_for(avatar.hash, size)
+        # never scale up, just let the client do that
+        if size and (size[0] < avatar.width or size[1] < avatar.height):
+            path = variants.get(
+                counted("variants", avatar.open), avatar.hash, avatar.mime, size
+            )
+            return send_file(path, mimetype=mimetype, etag=etag, conditional=True)
+        found, final = formats.choose(
+            functools.partial(app.extensions["rav2.blobs"].open, avatar.hash),
+            avatar.hash,
+            avatar.filesize,
+            accepted_formats(size),
+        )
+        response = send_original(avatar, mimetype, etag, found)
+        if size is None and formats.formats:
+            # which format we sent depends on what the browser accepts
+            response.vary.add("Accept")
+        if not final:
+            # a copy in a format the browser prefers is on its way, so
+            # don't let it (or a CDN) keep this one for long
+            response.cache_control.public = True
+            response.cache_control.max_age = 60
+        return response
+
+    def send_original(
+        avatar: Avatar, mimetype: str, etag: str, found: tuple[str, str] | None
+    ) -> Response:
+        if found is not None:
+            format, path = found
+            return send_file(
+                path,
+                mimetype=f"image/{format}",
+                etag=f"{etag}-{format}",
+                conditional=True,
+            )
+        path = avatar.dataname
+        accel = app.config["AVATAR_ACCEL_REDIRECT"]
+        if path is not None and accel:
+            response = Response(mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers["X-Accel-Redirect"] = (
+                f"{accel}{avatar.hash[0:2]}/{avatar.hash}"
+            )
+            return response
+        if path is None or (
+            hot is not None
+            and avatar.filesize <= hot.max_item
+            and not app.config["USE_X_SENDFILE"]
+        ):
+            cached = None
+            if hot is not None:
+                cached = hot.get(avatar.hash)
+                m = metrics()
+                m.inc("rav2_cache_lookups_total", cache="hot")
+                if cached is None:
+                    m.inc("rav2_cache_misses_total", cache="hot")
+            if cached is None:
+                data = avatar.data
+                mtime = os.path.getmtime(path) if path is not None else 0
+                if hot is not None:
+                    hot.put(avatar.hash, data, mtime)
+            else:
+                data, mtime = cached
+            # either a copy from the shared cache, or for packed avatars a
+            # view of the mapped pack file
+            response = Response([data], mimetype=mimetype)  # ty: ignore
+            response.content_length = len(data)
+            response.set_etag(etag)
+            if mtime:
+                response.last_modified = datetime.fromtimestamp(mtime, UTC)
+            response.make_conditional(
+                request, accept_ranges=True, complete_length=len(data)
+            )
+            return response
+        # send_file hands the open file to wsgi.file_wrapper, so gunicorn
+        # can sendfile() it without the bytes passing through python, and
+        # it deals with If-None-Match / If-Modified-Since / Range for us
+        return send_file(path, mimetype=mimetype, etag=etag, conditional=True)
+
+    def immutable(response: Response, etag: str | None = None) -> Response:
+        if etag is not None:
+            response.set_etag(etag)
+        response.cache_control.public = True
+        # (unless send_avatar() has said that it's only a stand-in)
+        if response.cache_control.max_age is None:
+            response.cache_control.max_age = 365 * 24 * 60 * 60
+            response.cache_control.immutable = True
+        return response
+
     ###################################################################
     # Public routes
 
@@ -94,15 +848,9 @@ def create_app(test_config=None):
         )
 
     @app.route("/")
+    @read_only
     def index() -> str:
-        avatars = db.session.execute(
-            select(Avatar)
-            .where(Avatar.enabled == True)
-            .where(Avatar.width <= std_width)
-            .where(Avatar.height <= std_width)
-            .order_by(db.func.random())
-            .limit(12)
-        ).scalars()
+        avatars = random_showcase(12)
         return render_template(
             "index.html",
             title="Shish's Avatar Hosting",
@@ -121,75 +869,221 @@ def create_app(test_config=None):
 
     @app.route("/<path>.<ext>")
     @app.route("/<path>/<name>.<ext>")
+    @read_only
     def avatar(
         path: str, name: t.Optional[str] = None, ext: t.Optional[str] = None
     ) -> Response:
+        size = get_scale()
         if len(path) == 32:
+            # the URL is the hash of the content, so if the client has a
+            # copy then it's the right copy and we don't need to look it up
+            etag = etag_for(path, size)
+            accepted = accepted_formats(size)
+            # (if they have the original but accept something better, that
+            # may have been encoded since, so check)
+            for format in accepted or [None]:
+                tag = f"{etag}-{format}" if format else etag
+                if tag in request.if_none_match:
+                    response = immutable(Response(status=304), tag)
+                    if formats.formats and size is None:
+                        response.vary.add("Accept")
+                    return response
             avatar = db.first_or_404(select(Avatar).where(Avatar.hash == path))
-            return Response(avatar.data, mimetype="image/" + avatar.mime.lower())
+            return immutable(send_avatar(avatar, size))
         else:
-            user = db.one_or_404(select(User).where(User.username == path))
-            avatar = db.first_or_404(
-                select(Avatar)
-                .where(Avatar.owner == user)
-                .where(Avatar.enabled == True)
-                .order_by(db.func.random())
-            )
-            # FIXME:
-            # if request.form['has_key("scale"):
-            #    scale = [int(n) for n in form["scale"].value.split("x")]
-            #    avatar.scale(scale)
-            return Response(avatar.data, mimetype="image/" + avatar.mime.lower())
+            avatar = random_avatar(find_user_id(path))
+            if avatar is None:
+                abort(404)
+            response = send_avatar(avatar, size)
+            # the next request should get a different random pick
+            response.cache_control.no_cache = True
+            return response
+
+    @app.route("/thumbs/<hash>.<ext>")
+    @read_only
+    def thumb(hash: str, ext: str) -> Response:
+        if hash in request.if_none_match:
+            return immutable(Response(status=304), hash)
+        avatar = db.first_or_404(select(Avatar).where(Avatar.hash == hash))
+        if not avatar.has_thumb:
+            return immutable(send_avatar(avatar))
+        if not os.path.exists(avatar.thumbname):
+            # uploaded before we had thumbnails, and not backfilled yet
+            avatar.make_thumb()
+        return immutable(
+            send_file(
+                avatar.thumbname,
+                mimetype="image/" + avatar.mime.lower(),
+                etag=hash,
+                conditional=True,
+            ),
+            hash,
+        )
 
     @app.route("/gallery")
+    @read_only
     def gallery() -> str:
-        user_counts = db.session.execute(
-            text(
-                """
-                    select name as username, count(*) as count
-                    from users
-                    join avatars on avatars.owner_id=users.id
-                    group by username
-                    order by count desc
-                    limit 35
-                """
+        def render_recent() -> str:
+            user_counts = db.session.execute(
+                select(User.username, User.avatar_count)
+                .where(User.avatar_count > 0)
+                .order_by(User.avatar_count.desc())
+                .limit(35)
+            )
+            new_avatars = db.session.execute(
+                select(Avatar)
+                .options(joinedload(Avatar.owner))
+                .where(Avatar.enabled == True)
+                .where(Avatar.width <= std_width)
+                .where(Avatar.height <= std_width)
+                .order_by(-Avatar.id)
+                .limit(8)
+            ).scalars()
+            return render_template(
+                "_gallery_list_recent.html",
+                user_counts=user_counts,
+                new_avatars=new_avatars,
             )
+
+        version = Counter.read("gallery")
+        recent = fragments.get(
+            "gallery", version.value, counted("fragments", render_recent)
         )
-        new_avatars = db.session.execute(
-            select(Avatar)
-            .where(Avatar.enabled == True)
-            .where(Avatar.width <= std_width)
-            .where(Avatar.height <= std_width)
-            .order_by(-Avatar.id)
-            .limit(8)
-        ).scalars()
-        random_avatars = db.session.execute(
-            select(Avatar)
-            .where(Avatar.enabled == True)
-            .where(Avatar.width <= std_width)
-            .where(Avatar.height <= std_width)
-            .order_by(db.func.random())
-            .limit(16)
-        ).scalars()
+        random_avatars = random_showcase(16)
 
         return render_template(
             "gallery_list.html",
             title="Gallery List",
             heading="Gallery List",
-            user_counts=user_counts,
-            new_avatars=new_avatars,
+            recent=Markup(recent),
             random_avatars=random_avatars,
         )
 
+    def avatar_page(
+        user: User, limit: int, before: int | None = None, after: int | None = None
+    ) -> tuple[list[Avatar], bool]:
+        """
+        Up to `limit` of the user's avatars - newest first, starting below
+        id `before`; or if `after` is given, oldest first, starting above
+        it - and whether there are any more. Each page is a range scan of
+        ix_avatars_owner_id (SQLite indexes end with the rowid, ie the
+        avatar id), so it costs the same however far into the list it is.
+        """
+        query = select(Avatar).where(Avatar.owner_id == user.id).limit(limit + 1)
+        if after is not None:
+            query = query.where(Avatar.id > after).order_by(Avatar.id)
+        else:
+            query = query.order_by(Avatar.id.desc())
+            if before is not None:
+                query = query.where(Avatar.id < before)
+        avatars = list(db.session.scalars(query))
+        return avatars[:limit], len(avatars) > limit
+
+    def user_conditional(user: User) -> tuple[Response, int]:
+        """
+        An empty response, which is a 304 if the client's copy of the page
+        is as new as the user's avatars; and the version of those
+        """
+        version = Counter.read(f"user:{user.id}")
+        response = Response()
+        response.set_etag(f"user-{user.id}-{version.value}")
+        response.last_modified = version.updated.replace(tzinfo=UTC)
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+        return response, version.value
+
     @app.route("/<user_name>.html")
-    def user_gallery(user_name: str) -> str:
-        user = db.one_or_404(db.select(User).filter(User.username == user_name))
-        return render_template(
-            "gallery.html",
-            title=f"{user_name}'s Avatar Gallery",
-            heading=f"{user_name}'s Avatar Gallery",
-            user=user,
+    @read_only
+    def user_gallery(user_name: str) -> Response:
+        user = find_user(user_name)
+        before = request.args.get("before", type=int)
+
+        response, version = user_conditional(user)
+        if response.status_code == 304:
+            return response
+
+        def render() -> str:
+            avatars, more = avatar_page(user, app.config["AVATARS_PER_PAGE"], before)
+            return render_template(
+                "gallery.html",
+                title=f"{user.username}'s Avatar Gallery",
+                heading=f"{user.username}'s Avatar Gallery",
+                user=user,
+                avatars=avatars,
+                before=before,
+                next_before=avatars[-1].id if more else None,
+            )
+
+        response.set_data(
+            fragments.get(
+                f"user:{user.id}:{before}",
+                version,
+                counted("fragments", render),
+            )
         )
+        return response
+
+    @app.route("/api/<user_name>/avatars")
+    @read_only
+    def api_avatars(user_name: str) -> Response:
+        """
+        The user's avatars, oldest first, a page at a time; each page links
+        to the next one with ?after=<the last avatar's id>, so avatars
+        uploaded while a client is working through the list turn up at the
+        end rather than shifting the pages around
+        """
+        user = find_user(user_name)
+        after = request.args.get("after", 0, type=int)
+        per_page = app.config["AVATARS_PER_PAGE"]
+        limit = min(max(request.args.get("limit", per_page, type=int), 1), per_page)
+
+        response, _ = user_conditional(user)
+        if response.status_code == 304:
+            return response
+
+        avatars, more = avatar_page(user, limit, after=after)
+        next = None
+        if more:
+            next = url_for("api_avatars", user_name=user.username, after=avatars[-1].id)
+            response.headers["Link"] = f'<{next}>; rel="next"'
+        response.mimetype = "application/json"
+        response.set_data(
+            app.json.dumps(
+                {
+                    "avatars": [
+                        {
+                            "id": avatar.id,
+                            "hash": avatar.hash,
+                            "filename": avatar.filename,
+                            "width": avatar.width,
+                            "height": avatar.height,
+                            "filesize": avatar.filesize,
+                            "mime": avatar.mime,
+                            "enabled": avatar.enabled,
+                            "link": avatar.link,
+                            "thumb_link": avatar.thumb_link,
+                        }
+                        for avatar in avatars
+                    ],
+                    "next": next,
+                }
+            )
+        )
+        return response
+
+    @app.route("/metrics")
+    def metrics_page() -> Response:
+        if app.config["METRICS_DIR"] is None:
+            abort(404)
+        extra = []
+        if hot is not None:
+            # the shared cache keeps its own totals for all workers
+            stats = hot.stats()
+            extra = [
+                ("rav2_hot_cache_evictions_total", {}, stats.evictions),
+                ("rav2_hot_cache_items", {}, stats.items),
+            ]
+        return Response(metrics().collect(extra), mimetype="text/plain; version=0.0.4")
 
     ###################################################################
     # Create user / login / logout
@@ -202,11 +1096,12 @@ def create_app(test_config=None):
         if len(username) >= 32:
             return abort(403, "Username needs to be less than 32 characters")
 
+        taken = "That username has already been taken, sorry D:"
         user = db.session.execute(
-            select(User).where(db.func.lower(User.username) == db.func.lower(username))
+            select(User).where(User.name_key == name_key(username))
         ).scalar()
         if user:
-            return abort(403, "That username has already been taken, sorry D:")
+            return abort(403, taken)
 
         password1 = request.form["password1"]
         password2 = request.form["password2"]
@@ -219,20 +1114,28 @@ def create_app(test_config=None):
 
         user = User(username, password1, email)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # someone else signed up with the name since we checked
+            db.session.rollback()
+            return abort(403, taken)
+        # this worker may remember the name as not belonging to anyone
+        user_ids.forget(user.name_key)
 
         session["user_id"] = user.id
         app.logger.info("User created")
         return redirect(url_for("user"))
 
     @app.route("/login", methods=["POST"])
+    @read_only
     def login():
         username = request.form["username"]
         password = hashlib.md5(request.form["password"].encode("utf8")).hexdigest()
 
         user = db.one_or_404(
             select(User)
-            .where(db.func.lower(User.username) == db.func.lower(username))
+            .where(User.name_key == name_key(username))
             .where(User.password == password),
             description="No user was found with that username + password",
         )
@@ -241,6 +1144,7 @@ def create_app(test_config=None):
         return redirect(url_for("user"))
 
     @app.route("/logout")
+    @read_only
     def logout():
         app.logger.info("logged out")
         session.clear()
@@ -250,13 +1154,26 @@ def create_app(test_config=None):
     # Functions for logged-in users
 
     @app.route("/user")
+    @read_only
     @login_required
     def user():
+        before = request.args.get("before", type=int)
+        avatars, more = avatar_page(g.user, app.config["AVATARS_PER_PAGE"], before)
+        user_jobs = db.session.scalars(
+            select(Job)
+            .where(Job.owner_id == g.user.id)
+            .order_by(Job.id.desc())
+            .limit(20)
+        )
         return render_template(
             "user.html",
             title=g.user.username + "'s Page",
             heading=g.user.username + "'s Page",
             user=g.user,
+            avatars=avatars,
+            before=before,
+            next_before=avatars[-1].id if more else None,
+            jobs=list(user_jobs),
         )
 
     @app.route("/toggle")
@@ -269,7 +1186,9 @@ def create_app(test_config=None):
         )
 
         avatar.enabled = not avatar.enabled
+        Counter.bump("gallery", f"user:{g.user.id}")
         db.session.commit()
+        avatar_changed(avatar)
         app.logger.info(
             "Avatar " + request.args["avatar_id"] + " set to " + str(avatar.enabled)
         )
@@ -291,7 +1210,10 @@ def create_app(test_config=None):
             .where(Avatar.owner_id == g.user.id)
         )
         db.session.delete(avatar)
+        count_avatars(g.user.id, -1)
+        Counter.bump("gallery", f"user:{g.user.id}")
         db.session.commit()
+        avatar_changed(avatar, deleted=True)
         app.logger.info("Avatar " + request.args["avatar_id"] + " removed")
         return redirect(url_for("user"))
 
@@ -300,6 +1222,7 @@ def create_app(test_config=None):
     def settings():
         g.user.message = request.form["message"]
         g.user.email = request.form["email"]
+        Counter.bump(f"user:{g.user.id}")
         db.session.commit()
         return redirect(url_for("user"))
 
@@ -308,7 +1231,6 @@ def create_app(test_config=None):
     def upload():
         f = request.files["avatar_data"]
         name = f.filename or "avatar.png"
-        data = f.read()
 
         app.logger.info("Avatar uploaded: " + name)
 
@@ -317,8 +1239,30 @@ def create_app(test_config=None):
         if len(name) > 32:
             name = name[-32:]
 
-        g.user.avatars.append(Avatar(name, data))
+        # before touching the database, as loading g.user starts a
+        # transaction which holds the write lock
+        try:
+            avatar = Avatar(name, ingest(f.stream))
+        except AvatarAddError as e:
+            return abort(403, str(e))
+        # (not g.user.avatars.append(), which would load all of them)
+        avatar.owner_id = g.user.id
+        db.session.add(avatar)
+        count_avatars(g.user.id, 1)
+        Counter.bump("gallery", f"user:{g.user.id}")
+        db.session.flush()
+        # the rest can be done by `flask worker` - or if it isn't running,
+        # when the files are first asked for
+        if avatar.has_thumb:
+            jobs.enqueue(
+                "thumb", f"Thumbnail for {name}", g.user.id, avatar_id=avatar.id
+            )
+        if formats.formats:
+            jobs.enqueue(
+                "formats", f"Compact copies of {name}", g.user.id, avatar_id=avatar.id
+            )
         db.session.commit()
+        avatar_changed(avatar)
         return redirect(url_for("user"))
 
     return app
@@ -0,0 +1,260 @@
+"""
+An ASGI entry point, for serving with gunicorn's asyncio worker:
+
+    gunicorn -k asgi -w 4 "rav2.asgi:create_asgi_app()"
+
+Views still run as normal (blocking) Flask code, in a small pool of
+threads per worker; but sending the response, which for a slow client
+downloading a big GIF is most of the request's lifetime, is done by the
+event loop, so a thousand slow clients cost a thousand coroutines rather
+than a thousand threads or processes.
+"""
+
+import asyncio
+import sys
+import tempfile
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from werkzeug.wsgi import _RangeWrapper
+
+from . import create_app
+
+Scope = dict[str, t.Any]
+Receive = t.Callable[[], t.Awaitable[dict[str, t.Any]]]
+Send = t.Callable[[dict[str, t.Any]], t.Awaitable[None]]
+
+
+class AsyncFile:
+    """
+    Our `wsgi.file_wrapper`: rather than being read by the view's thread,
+    the file is handed back to the event loop, which reads it a block at
+    a time in the background as the client is ready for more.
+    """
+
+    def __init__(self, fp: t.IO[bytes], block_size: int = 64 * 1024) -> None:
+        self.fp = fp
+        self.block_size = block_size
+
+    # in case some middleware wants to read it the normal way
+    def __iter__(self) -> t.Self:
+        return self
+
+    def __next__(self) -> bytes:
+        block = self.fp.read(self.block_size)
+        if not block:
+            raise StopIteration
+        return block
+
+    def seekable(self) -> bool:
+        return self.fp.seekable()
+
+    def seek(self, offset: int) -> None:
+        self.fp.seek(offset)
+
+    def tell(self) -> int:
+        return self.fp.tell()
+
+    def close(self) -> None:
+        self.fp.close()
+
+    async def send(self, send: Send, start: int = 0, end: int | None = None) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.fp.seek, start)
+        remaining = end - start if end is not None else None
+
+        def read() -> bytes:
+            nonlocal remaining
+            if remaining is not None and remaining <= 0:
+                return b""
+            size = (
+                self.block_size
+                if remaining is None
+                else min(remaining, self.block_size)
+            )
+            block = self.fp.read(size)
+            if remaining is not None:
+                remaining -= len(block)
+            return block
+
+        # read one block ahead, so that the last block can be sent with
+        # more_body=False: gunicorn loses a keep-alive connection's next
+        # request if it arrives before a separate, empty, final message
+        block = await loop.run_in_executor(None, read)
+        while True:
+            next_block = await loop.run_in_executor(None, read) if block else b""
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": block,
+                    "more_body": bool(next_block),
+                }
+            )
+            if not next_block:
+                return
+            block = next_block
+
+
+class ASGIApp:
+    """Serve a Flask app over ASGI, running views in a bounded thread pool"""
+
+    def __init__(self, app: Flask, threads: int) -> None:
+        self.app = app
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="rav2-view")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    self.pool.shutdown()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        read = await self.read_body(receive)
+        if read is None:
+            await send_simple(send, 413, b"Request Entity Too Large")
+            return
+
+        body, length = read
+        loop = asyncio.get_running_loop()
+        try:
+            status, headers, content = await loop.run_in_executor(
+                self.pool, self.run_view, self.environ(scope, body, length)
+            )
+        finally:
+            body.close()
+
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        if isinstance(content, AsyncFile):
+            try:
+                await content.send(send)
+            finally:
+                content.close()
+        elif isinstance(content, _RangeWrapper) and isinstance(
+            content.iterable, AsyncFile
+        ):
+            try:
+                await content.iterable.send(send, content.start_byte, content.end_byte)
+            finally:
+                content.iterable.close()
+        else:
+            await send({"type": "http.response.body", "body": content})
+
+    async def read_body(self, receive: Receive) -> tuple[t.IO[bytes], int] | None:
+        """
+        The request body and its length, or None if it's over
+        MAX_CONTENT_LENGTH. Big bodies are spooled to a temporary file, so
+        that uploads don't cost their size in memory per request.
+        """
+        limit = self.app.config["MAX_CONTENT_LENGTH"]
+        spool = self.app.config["ASGI_SPOOL_BYTES"]
+        loop = asyncio.get_running_loop()
+        body = tempfile.SpooledTemporaryFile(max_size=spool)  # noqa: SIM115 - closed by the caller
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if limit is not None and size > limit:
+                body.close()
+                return None
+            if size > spool:
+                # on disk by now, so don't hold up the event loop
+                await loop.run_in_executor(None, body.write, chunk)
+            else:
+                body.write(chunk)
+            if not message.get("more_body"):
+                body.seek(0)
+                return t.cast(t.IO[bytes], body), size
+
+    def environ(self, scope: Scope, body: t.IO[bytes], length: int) -> dict[str, t.Any]:
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("latin1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "REMOTE_ADDR": client[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": AsyncFile,
+        }
+        for name, value in scope["headers"]:
+            key = name.decode("latin1").upper().replace("-", "_")
+            value = value.decode("latin1")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = f"HTTP_{key}"
+            if key in environ:
+                # (cookies have a separator of their own)
+                separator = "; " if key == "HTTP_COOKIE" else ","
+                value = f"{environ[key]}{separator}{value}"
+            environ[key] = value
+        # we've read the whole body already, however it was sent
+        environ["CONTENT_LENGTH"] = str(length)
+        return environ
+
+    def run_view(
+        self, environ: dict[str, t.Any]
+    ) -> tuple[int, list[tuple[bytes, bytes]], t.Any]:
+        """
+        Run the WSGI app, returning the status, headers, and either the
+        whole body or a file for the event loop to send
+        """
+        response: list[t.Any] = []
+
+        def start_response(status: str, headers: list[tuple[str, str]], exc_info=None):
+            response[:] = [status, headers]
+
+        content = self.app.wsgi_app(environ, start_response)
+        if not isinstance(content, AsyncFile) and not (
+            isinstance(content, _RangeWrapper)
+            and isinstance(content.iterable, AsyncFile)
+        ):
+            # files are closed once the event loop has sent them; anything
+            # else is read here, while we're in a thread
+            try:
+                body = b"".join(content)
+            finally:
+                close = getattr(content, "close", None)
+                if close is not None:
+                    close()
+            content = body
+        status, headers = response
+        return (
+            int(status.split(" ", 1)[0]),
+            [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers],
+            content,
+        )
+
+
+async def send_simple(send: Send, status: int, body: bytes) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain")],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(test_config=None) -> ASGIApp:
+    app = create_app(test_config)
+    return ASGIApp(app, app.config["ASGI_THREADS"])
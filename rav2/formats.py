@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image, features
+
+log = logging.getLogger(__name__)
+
+SUPPORTED = [format for format in ("avif", "webp") if features.check(format)]
+
+
+def encode(src: str | t.IO[bytes], dst: str, format: str, limit: int) -> int:
+    """
+    Write a copy of `src` to `dst` in `format`, returning its size - or if
+    it isn't smaller than `limit` bytes (or `src` is animated, which we
+    don't try to preserve), write an empty file so that we know not to
+    try again, and return 0.
+    """
+    with Image.open(src) as img:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if getattr(img, "is_animated", False):
+            write_empty(tmp)
+        elif format == "webp":
+            # pixel art stays pixel-perfect, photos get the usual lossy
+            # treatment
+            lossless = img.format != "JPEG"
+            img.save(tmp, "WEBP", lossless=lossless, quality=80, method=4)
+        else:
+            img.save(tmp, format.upper(), quality=60)
+    size = os.path.getsize(tmp)
+    if size >= limit:
+        write_empty(tmp)
+        size = 0
+    os.replace(tmp, dst)
+    return size
+
+
+def write_empty(path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb"):
+        pass
+
+
+class FormatCache:
+    """
+    Copies of avatars in more compact formats, stored on disk as
+    `<root>/xx/<hash>.<format>`, for browsers which say they accept them.
+
+    The first request for an avatar gets the original, and queues the
+    encoding to be done by a pool of background threads; once that's
+    finished, later requests get the new copy.
+    """
+
+    def __init__(self, root: str, formats: list[str], threads: int) -> None:
+        self.root = root
+        self.formats = [format for format in SUPPORTED if format in formats]
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix="rav2-encode")
+        self._pending: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        # requests don't wait for encoding, so if it can't keep up then
+        # don't let the queue grow without limit
+        self.max_pending = 1000
+
+    def path(self, hash: str, format: str) -> str:
+        return os.path.join(self.root, hash[0:2], f"{hash}.{format}")
+
+    def get(
+        self,
+        open: t.Callable[[], t.IO[bytes]],
+        hash: str,
+        size: int,
+        accepted: t.Container[str],
+    ) -> tuple[str, str] | None:
+        """
+        The (format, path) of the smallest copy of `hash` in a format which
+        the client accepts, if there is one yet. `open()` returns the
+        original, which is `size` bytes.
+        """
+        return self.choose(open, hash, size, accepted)[0]
+
+    def choose(
+        self,
+        open: t.Callable[[], t.IO[bytes]],
+        hash: str,
+        size: int,
+        accepted: t.Container[str],
+    ) -> tuple[tuple[str, str] | None, bool]:
+        """
+        `get()`, and whether that's final - ie False if there's a format
+        which the client accepts that hasn't been encoded yet
+        """
+        best = None
+        final = True
+        for format in self.formats:
+            if format not in accepted:
+                continue
+            path = self.path(hash, format)
+            try:
+                encoded = os.path.getsize(path)
+            except FileNotFoundError:
+                self._queue(open, hash, size, format)
+                final = False
+                continue
+            # (empty files are for ones which weren't worth it)
+            if encoded and (best is None or encoded < best[0]):
+                best = (encoded, format, path)
+        return (best[1:] if best is not None else None), final
+
+    def wait(self) -> None:
+        """Wait for any queued encoding to be done"""
+        with self._lock:
+            pending = list(self._pending.values())
+        for future in pending:
+            future.result()
+
+    def _queue(
+        self, open: t.Callable[[], t.IO[bytes]], hash: str, size: int, format: str
+    ) -> None:
+        path = self.path(hash, format)
+        with self._lock:
+            if path in self._pending or len(self._pending) >= self.max_pending:
+                return
+            self._pending[path] = self._pool.submit(
+                self._encode, open, path, format, size
+            )
+
+    def _encode(
+        self, open: t.Callable[[], t.IO[bytes]], path: str, format: str, size: int
+    ) -> None:
+        try:
+            with open() as src:
+                encode(src, path, format, size)
+        except (OSError, ValueError) as e:
+            # not an image we can read, so it'll always be sent as-is
+            log.warning(f"Can't encode {path}: {e}")
+            write_empty(path)
+        finally:
+            with self._lock:
+                del self._pending[path]
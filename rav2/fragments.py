@@ -0,0 +1,36 @@
+import threading
+import typing as t
+from collections import OrderedDict
+
+
+class FragmentCache:
+    """
+    Rendered chunks of HTML, keyed by a name plus the version of the data
+    they were rendered from, so that stale entries are never returned -
+    they just stop being asked for, and fall out of the end of the LRU
+    once the cache holds more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._items: OrderedDict[tuple[str, int], str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str, version: int, render: t.Callable[[], str]) -> str:
+        key = (name, version)
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+                return html
+
+        html = render()
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = html
+                self._used += len(html)
+            while self._used > self.max_bytes and self._items:
+                _, old = self._items.popitem(last=False)
+                self._used -= len(old)
+        return html
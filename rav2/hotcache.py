@@ -0,0 +1,234 @@
+import mmap
+import os
+import typing as t
+from struct import Struct
+
+from .storage import FileLock
+
+
+class HotStats(t.NamedTuple):
+    evictions: int
+    items: int
+
+
+class HotCache:
+    """
+    Avatar bodies kept in a memory-mapped file (in /dev/shm by default), so
+    that every worker on the machine shares one copy of each popular avatar.
+
+    The file holds a hash table of md5 -> (offset, length) followed by a
+    ring buffer of data. New entries are written at the ring's head,
+    evicting whatever was there before - except that entries which have
+    been read since the head last came round get a second chance (CLOCK),
+    so popular avatars stay put while one-off requests cycle through.
+    When the hash table holds as many entries as it should, the head is
+    moved on until one is evicted, even if the ring still has room.
+
+    Lookups only take the lock shared, so that workers don't queue up
+    behind each other for popular avatars; hits and misses are counted in
+    each worker's metrics rather than here.
+    """
+
+    # magic, slots, arena size, head, limit, items, used slots, evictions
+    header = Struct("<8sQQQQQQQ")
+    header_size = 128
+    MAGIC, SLOTS, ARENA, HEAD, LIMIT, ITEMS, USED, EVICTIONS = range(8)
+    # md5, state, referenced, offset, length
+    slot = Struct("<16sIIQQ")
+    # md5, data length, record size, mtime of the original
+    record = Struct("<16sQQd")
+    magic = b"RAVHOT02"
+    EMPTY, LIVE, DELETED = 0, 1, 2
+    # the table is rebuilt when this much of it is used (including
+    # tombstones), and entries are evicted to keep them under `FULL`
+    MAX_LOAD = 0.7
+    FULL = 0.6
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_item = max_bytes // 16
+        # enough slots for the ring to be full of 1KB avatars
+        self._slots = max(64, max_bytes // 1024)
+        self._arena = max_bytes
+        self._arena_offset = self.header_size + self._slots * self.slot.size
+        self._lock = FileLock(f"{path}.lock")
+        size = self._arena_offset + self._arena
+        with self._lock:
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                # other workers may still have the old file mapped, so make
+                # a new one rather than changing the size of theirs
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as fp:
+                    fp.truncate(size)
+                os.replace(tmp, path)
+            with open(path, "r+b") as fp:
+                self._map = mmap.mmap(fp.fileno(), size)
+            h = self._get_header()
+            if (h[self.MAGIC], h[self.SLOTS], h[self.ARENA]) != (
+                self.magic,
+                self._slots,
+                self._arena,
+            ):
+                self._map[0 : self._arena_offset] = bytes(self._arena_offset)
+                h = [self.magic, self._slots, self._arena] + [0] * 5
+                self._set_header(h)
+
+    def get(self, hash: str) -> tuple[bytes, float] | None:
+        """The cached (data, mtime) for `hash`, if there is any"""
+        key = bytes.fromhex(hash)
+        with self._lock.shared():
+            n, found = self._find(key)
+            if found is None:
+                return None
+            # other readers can only be setting it too, and it's only
+            # cleared by put(), which has the lock to itself
+            self._set_referenced(n, 1)
+            offset, length = found
+            start = self._arena_offset + offset
+            mtime = self.record.unpack_from(self._map, start)[3]
+            start += self.record.size
+            return self._map[start : start + length], mtime
+
+    def put(self, hash: str, data: bytes | memoryview, mtime: float = 0) -> bool:
+        """Cache `data`, returning False if it was there already or is too big"""
+        if len(data) > self.max_item:
+            return False
+        key = bytes.fromhex(hash)
+        with self._lock:
+            if self._find(key)[1] is not None:
+                return False
+            h = self._get_header()
+            need = (self.record.size + len(data) + 7) & ~7
+            pos, size = self._make_room(
+                h, need, evict=h[self.ITEMS] >= self._slots * self.FULL
+            )
+            if h[self.USED] >= self._slots * self.MAX_LOAD:
+                self._rehash(h)
+            start = self._arena_offset + pos
+            self.record.pack_into(self._map, start, key, len(data), size, mtime)
+            self._map[
+                start + self.record.size : start + self.record.size + len(data)
+            ] = data
+            # _make_room() may have turned slots into tombstones, so look
+            # again for the best place to put ours
+            n, _ = self._find(key)
+            if self.slot.unpack_from(self._map, self._slot_offset(n))[1] == self.EMPTY:
+                h[self.USED] += 1
+            self.slot.pack_into(
+                self._map, self._slot_offset(n), key, self.LIVE, 0, pos, len(data)
+            )
+            h[self.ITEMS] += 1
+            self._set_header(h)
+        return True
+
+    def stats(self) -> HotStats:
+        with self._lock.shared():
+            h = self._get_header()
+        return HotStats(h[self.EVICTIONS], h[self.ITEMS])
+
+    ###################################################################
+    # Hash table
+
+    def _get_header(self) -> list:
+        return list(self.header.unpack_from(self._map))
+
+    def _set_header(self, h: list) -> None:
+        self.header.pack_into(self._map, 0, *h)
+
+    def _slot_offset(self, n: int) -> int:
+        return self.header_size + n * self.slot.size
+
+    def _set_referenced(self, n: int, referenced: int) -> None:
+        Struct("<I").pack_into(self._map, self._slot_offset(n) + 20, referenced)
+
+    def _find(self, key: bytes) -> tuple[int, tuple[int, int] | None]:
+        """
+        Returns (slot number, (offset, length)) if the key is cached, or
+        (slot number to insert it at, None) if it isn't
+        """
+        n = int.from_bytes(key[0:8], "little") % self._slots
+        free = None
+        while True:
+            k, state, _, offset, length = self.slot.unpack_from(
+                self._map, self._slot_offset(n)
+            )
+            if state == self.EMPTY:
+                return (n if free is None else free), None
+            if state == self.DELETED:
+                if free is None:
+                    free = n
+            elif k == key:
+                return n, (offset, length)
+            n = (n + 1) % self._slots
+
+    def _rehash(self, h: list) -> None:
+        """Clear out tombstones"""
+        live = []
+        for n in range(self._slots):
+            slot = self.slot.unpack_from(self._map, self._slot_offset(n))
+            if slot[1] == self.LIVE:
+                live.append(slot)
+        self._map[self.header_size : self._arena_offset] = bytes(
+            self._arena_offset - self.header_size
+        )
+        for slot in live:
+            n, _ = self._find(slot[0])
+            self.slot.pack_into(self._map, self._slot_offset(n), *slot)
+        h[self.USED] = len(live)
+
+    ###################################################################
+    # Ring buffer
+
+    def _make_room(self, h: list, need: int, evict: bool = False) -> tuple[int, int]:
+        """
+        Free at least `need` bytes at the head of the ring, returning the
+        (position, size) of the space - and if `evict`, evict at least one
+        record on the way, to make room in the hash table.
+
+        Records in [head, limit) are from the previous lap; the rest of
+        the ring, up to the head, has been written in this one. Records
+        are contiguous, so that they can be walked from the head - when
+        a referenced record is kept, it is moved back to close any gap,
+        and when there is a gap left at the end it's added to the new
+        record's size.
+        """
+        while True:
+            pos = scan = h[self.HEAD]
+            limit = h[self.LIMIT]
+            while scan < limit and (scan - pos < need or evict):
+                key, _, size, _ = self.record.unpack_from(
+                    self._map, self._arena_offset + scan
+                )
+                n, found = self._find(key)
+                if found is not None and found[0] == scan:
+                    slot_offset = self._slot_offset(n)
+                    if self.slot.unpack_from(self._map, slot_offset)[2]:
+                        # read since we last came past: keep it for another lap
+                        self._set_referenced(n, 0)
+                        if pos != scan:
+                            self._map.move(
+                                self._arena_offset + pos,
+                                self._arena_offset + scan,
+                                size,
+                            )
+                            Struct("<Q").pack_into(self._map, slot_offset + 24, pos)
+                        pos += size
+                    else:
+                        Struct("<I").pack_into(
+                            self._map, slot_offset + 16, self.DELETED
+                        )
+                        h[self.ITEMS] -= 1
+                        h[self.EVICTIONS] += 1
+                        evict = False
+                scan += size
+            if scan - pos >= need and not evict:
+                h[self.HEAD] = scan
+                return pos, scan - pos
+            # we've reached the end of the previous lap's records
+            if pos + need <= self._arena and not evict:
+                h[self.HEAD] = h[self.LIMIT] = pos + need
+                return pos, need
+            # and there isn't room at the end of the ring, so go round again;
+            # every referenced bit is cleared on the way, so this ends
+            # within two more laps
+            h[self.HEAD], h[self.LIMIT] = 0, pos
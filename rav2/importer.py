@@ -0,0 +1,106 @@
+"""
+The worker side of `flask import-avatars`: each process reads, hashes,
+checks and stores images, and makes their thumbnails, leaving only the
+database inserts for the parent.
+
+`flask backfill-thumbs` and `flask encode-formats` use the same workers,
+which open each avatar from their own store, so that the parent only has
+to send them hashes.
+"""
+
+import os
+import typing as t
+import zipfile
+
+from .formats import encode
+from .models import AvatarAddError, ImageInfo, store_image, thumb_size
+from .storage import BlobStore, PackStore
+from .variants import resize
+
+
+class Settings(t.NamedTuple):
+    storage: str
+    avatar_dir: str
+    thumb_dir: str
+    max_bytes: int
+    max_pixels: int
+
+
+class Job(t.NamedTuple):
+    # the avatar's filename, as if it had been uploaded
+    name: str
+    # a file, or a zip file and the name of a file inside it
+    path: str
+    member: str | None = None
+
+
+class Result(t.NamedTuple):
+    job: Job
+    info: ImageInfo | None
+    error: str | None
+
+
+_settings: Settings
+_blobs: BlobStore
+_thumbs: BlobStore
+_zips: dict[str, zipfile.ZipFile] = {}
+
+
+def init_worker(settings: Settings) -> None:
+    global _settings, _blobs, _thumbs
+    _settings = settings
+    store_class = {"files": BlobStore, "packs": PackStore}[settings.storage]
+    _blobs = store_class(settings.avatar_dir)
+    _thumbs = BlobStore(settings.thumb_dir)
+
+
+def find_jobs(source: str) -> list[Job]:
+    """Every file in a directory (recursively) or a zip file"""
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            members = sorted(i.filename for i in zf.infolist() if not i.is_dir())
+        return [Job(upload_name(m), source, m) for m in members]
+    paths = sorted(
+        os.path.join(root, name) for root, _, names in os.walk(source) for name in names
+    )
+    return [Job(upload_name(p), p) for p in paths]
+
+
+def upload_name(path: str) -> str:
+    # the same as upload() does to browsers' filenames
+    return path.split("/")[-1][-32:]
+
+
+def open_job(job: Job) -> t.IO[bytes]:
+    if job.member is None:
+        return open(job.path, "rb")
+    # opening a zip reads its whole index, so keep it open
+    if job.path not in _zips:
+        _zips[job.path] = zipfile.ZipFile(job.path)
+    return _zips[job.path].open(job.member)
+
+
+def import_one(job: Job) -> Result:
+    try:
+        with open_job(job) as fp:
+            info = store_image(_blobs, fp, _settings.max_bytes, _settings.max_pixels)
+        if (info.width > thumb_size or info.height > thumb_size) and not _thumbs.exists(
+            info.hash
+        ):
+            with _blobs.open(info.hash) as src:
+                resize(
+                    src, _thumbs.path(info.hash), (thumb_size, thumb_size), info.mime
+                )
+        return Result(job, info, None)
+    except (AvatarAddError, OSError, ValueError, zipfile.BadZipFile) as e:
+        return Result(job, None, str(e))
+
+
+def thumb_one(hash: str, mime: str) -> None:
+    with _blobs.open(hash) as src:
+        resize(src, _thumbs.path(hash), (thumb_size, thumb_size), mime)
+
+
+def encode_one(hash: str, dst: str, format: str, limit: int) -> int:
+    with _blobs.open(hash) as src:
+        return encode(src, dst, format, limit)
@@ -0,0 +1,135 @@
+import logging
+import os
+import typing as t
+from datetime import UTC, datetime, timedelta
+
+from flask import current_app, g
+from sqlalchemy import select
+
+from .formats import FormatCache, encode
+from .metrics import metrics
+from .models import Avatar, Job, db
+from .storage import thumbs
+
+log = logging.getLogger(__name__)
+
+# kind -> function which does that kind of job
+HANDLERS: dict[str, t.Callable[..., None]] = {}
+
+
+def handler[F: t.Callable[..., None]](kind: str) -> t.Callable[[F], F]:
+    def register(f: F) -> F:
+        HANDLERS[kind] = f
+        return f
+
+    return register
+
+
+def now() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def enqueue(kind: str, description: str, owner_id: int | None, **args: t.Any) -> Job:
+    """Add a job to the session, to be committed with whatever needed it"""
+    job = Job(
+        kind=kind,
+        args=args,
+        description=description,
+        owner_id=owner_id,
+        run_after=now(),
+    )
+    db.session.add(job)
+    return job
+
+
+def claim() -> tuple[int, str, dict[str, t.Any]] | None:
+    """
+    Mark the job which has been due for longest as running, and return
+    its (id, kind, args). Transactions take the write lock as they start
+    (see `rav2.sqlite`), so two workers can't claim the same job.
+    """
+    job = db.session.scalars(
+        select(Job).where(Job.run_after <= now()).order_by(Job.run_after).limit(1)
+    ).first()
+    if job is None:
+        db.session.commit()
+        return None
+    lease = timedelta(seconds=current_app.config["JOB_LEASE_SECONDS"])
+    job.status, job.attempts, job.run_after = "running", job.attempts + 1, now() + lease
+    claimed = (job.id, job.kind, job.args)
+    # (before committing, as reading them afterwards would start another
+    # transaction, and take the write lock again)
+    db.session.commit()
+    return claimed
+
+
+def run_one() -> str | None:
+    """
+    Run the next job which is due, returning how it went ("done", "retry"
+    or "failed"), or None if there wasn't one
+    """
+    claimed = claim()
+    if claimed is None:
+        return None
+    id, kind, args = claimed
+
+    # handlers' reads go to the read-only pool, so that a slow job doesn't
+    # hold the write lock; any writes are theirs to commit
+    g.read_only = True
+    try:
+        HANDLERS[kind](**args)
+        error = None
+    except Exception as e:  # noqa: BLE001 - a broken job mustn't stop the worker
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        g.read_only = False
+        db.session.rollback()
+
+    job = db.session.get(Job, id)
+    if job is None:  # pragma: no cover - someone else cleared it out
+        return "done"
+    if error is None:
+        result = "done"
+        db.session.delete(job)
+    elif job.attempts >= current_app.config["JOB_ATTEMPTS"]:
+        result = "failed"
+        log.warning(f"Job {id} ({job.description}) failed for good: {error}")
+        job.status, job.run_after, job.error = "failed", None, error
+    else:
+        result = "retry"
+        log.warning(f"Job {id} ({job.description}) failed, will retry: {error}")
+        # back off: 1x, 2x, 4x... the delay
+        delay = current_app.config["JOB_RETRY_SECONDS"] * 2 ** (job.attempts - 1)
+        job.status, job.run_after, job.error = (
+            "queued",
+            now() + timedelta(seconds=delay),
+            error,
+        )
+    db.session.commit()
+    metrics().inc("rav2_jobs_total", kind=kind, result=result)
+    return result
+
+
+###################################################################
+# Handlers
+
+
+@handler("thumb")
+def make_thumb(avatar_id: int) -> None:
+    avatar = db.session.get(Avatar, avatar_id)
+    # (it may have been deleted since)
+    if avatar is not None and not thumbs().exists(avatar.hash):
+        avatar.make_thumb()
+
+
+@handler("formats")
+def encode_formats(avatar_id: int) -> None:
+    avatar = db.session.get(Avatar, avatar_id)
+    if avatar is None:
+        return
+    formats: FormatCache = current_app.extensions["rav2.formats"]
+    for format in formats.formats:
+        path = formats.path(avatar.hash, format)
+        if not os.path.exists(path):
+            with avatar.open() as src:
+                encode(src, path, format, avatar.filesize)
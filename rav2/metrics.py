@@ -0,0 +1,294 @@
+import json
+import mmap
+import os
+import threading
+import time
+import typing as t
+from struct import Struct
+
+from flask import current_app, g, has_request_context
+from sqlalchemy import Engine, event
+
+from .storage import FileLock
+
+# name -> (type, help, histogram buckets)
+FAMILIES: dict[str, tuple[str, str, tuple[float, ...]]] = {
+    "rav2_requests_total": ("counter", "Requests handled", ()),
+    "rav2_request_duration_seconds": (
+        "histogram",
+        "Time spent in the view, per route",
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ),
+    "rav2_sql_statements_total": ("counter", "SQL statements run, per route", ()),
+    "rav2_sql_seconds_total": ("counter", "Time spent running SQL, per route", ()),
+    "rav2_sql_statements_per_request": (
+        "histogram",
+        "SQL statements run by each request",
+        (0, 1, 2, 3, 5, 10, 20, 50, 100),
+    ),
+    "rav2_storage_reads_total": ("counter", "Avatar bodies read from storage", ()),
+    "rav2_storage_read_bytes_total": ("counter", "Bytes read from storage", ()),
+    "rav2_storage_read_seconds_total": ("counter", "Time spent reading storage", ()),
+    "rav2_cache_lookups_total": ("counter", "Cache lookups", ()),
+    "rav2_cache_misses_total": ("counter", "Cache lookups which missed", ()),
+    "rav2_hot_cache_evictions_total": ("counter", "Avatars evicted", ()),
+    "rav2_hot_cache_items": ("gauge", "Avatars in the shared cache", ()),
+    "rav2_jobs_total": ("counter", "Background jobs run, per kind and result", ()),
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Metrics:
+    """
+    Counters for /metrics. Each worker process adds to its own file in
+    `root` (named after its pid), and `collect()` adds up all of the
+    files, so the numbers cover every worker on the machine - including
+    ones which have exited, so that counters never go backwards (clear
+    out `root` when restarting the server). So that `root` doesn't grow
+    with every worker that's ever run, each new one folds the files of
+    exited workers into `exited.metrics`.
+
+    The files are memory-mapped, so bumping a counter is a dict lookup
+    and a struct write rather than a syscall. Each holds a list of
+    (length, key, value) records, appended to as new series turn up,
+    after a header saying how much of the file has been written.
+    """
+
+    header = Struct("<8sQ")
+    magic = b"RAVMET01"
+    record = Struct("<I")
+    value = Struct("<d")
+
+    def __init__(self, root: str | None) -> None:
+        self.root = root
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._map: mmap.mmap | None = None
+        self._offsets: dict[str, int] = {}
+        self._used = 0
+        # held while exited workers' files are folded together, so that
+        # nobody adds them up while they're in both places
+        self._exited_lock = (
+            FileLock(os.path.join(root, "exited.lock")) if root else None
+        )
+
+    def inc(self, name: str, amount: float = 1, /, **labels: str) -> None:
+        if self.root is None:
+            return
+        key = json.dumps([name, sorted(labels.items())])
+        with self._lock:
+            if self._pid != os.getpid():
+                # a new worker (or the first call), so start a new file
+                self._open()
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._add(key)
+            (old,) = self.value.unpack_from(t.cast(mmap.mmap, self._map), offset)
+            self.value.pack_into(t.cast(mmap.mmap, self._map), offset, old + amount)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Add `value` to the histogram `name`"""
+        buckets = FAMILIES[name][2]
+        le = next((str(b) for b in buckets if value <= b), "+Inf")
+        self.inc(f"{name}_bucket", **labels, le=le)
+        self.inc(f"{name}_sum", value, **labels)
+        self.inc(f"{name}_count", **labels)
+
+    def collect(self, extra: t.Iterable[tuple[str, dict[str, str], float]] = ()) -> str:
+        """
+        Every worker's counters added up, plus `extra` (name, labels,
+        value) samples, in Prometheus' text format
+        """
+        totals = self.totals()
+        for name, labels, value in extra:
+            series = (name, tuple(sorted(labels.items())))
+            totals[series] = totals.get(series, 0) + value
+
+        lines = []
+        for family, (type, help, buckets) in FAMILIES.items():
+            if type == "histogram":
+                samples = self._histogram(family, buckets, totals)
+            else:
+                samples = [
+                    (name, labels, value)
+                    for (name, labels), value in sorted(totals.items())
+                    if name == family
+                ]
+            if samples:
+                lines.append(f"# HELP {family} {help}")
+                lines.append(f"# TYPE {family} {type}")
+                lines.extend(format_sample(*sample) for sample in samples)
+        return "\n".join(lines) + "\n"
+
+    def totals(self) -> dict[tuple[str, Labels], float]:
+        """Every worker's counters added up, by (name, sorted labels)"""
+        totals: dict[tuple[str, Labels], float] = {}
+        if self.root is None or not os.path.isdir(self.root):
+            return totals
+        with t.cast(FileLock, self._exited_lock).shared():
+            for path in self._files():
+                for key, _, value in self._read(path):
+                    name, labels = json.loads(key)
+                    series = (name, tuple(tuple(label) for label in labels))
+                    totals[series] = totals.get(series, 0) + value
+        return totals
+
+    def _histogram(
+        self,
+        family: str,
+        buckets: tuple[float, ...],
+        totals: dict[tuple[str, Labels], float],
+    ) -> list[tuple[str, Labels, float]]:
+        # we store how many observations landed in each bucket, but
+        # Prometheus wants how many were <= each bucket's upper limit
+        label_sets = sorted(
+            {labels for name, labels in totals if name == f"{family}_count"}
+        )
+        samples = []
+        for labels in label_sets:
+            total = 0.0
+            for le in [str(b) for b in buckets] + ["+Inf"]:
+                bucket = tuple(sorted(labels + (("le", le),)))
+                total += totals.get((f"{family}_bucket", bucket), 0)
+                samples.append((f"{family}_bucket", labels + (("le", le),), total))
+            samples.append((f"{family}_sum", labels, totals[(f"{family}_sum", labels)]))
+            samples.append(
+                (f"{family}_count", labels, totals[(f"{family}_count", labels)])
+            )
+        return samples
+
+    ###################################################################
+    # Files
+
+    def _files(self) -> list[str]:
+        root = t.cast(str, self.root)
+        return [
+            os.path.join(root, name)
+            for name in os.listdir(root)
+            if name.endswith(".metrics")
+        ]
+
+    def _open(self) -> None:
+        root = t.cast(str, self.root)
+        os.makedirs(root, exist_ok=True)
+        self._pid = os.getpid()
+        path = os.path.join(root, f"{self._pid}.metrics")
+        # a worker with the same pid may have run before us; carry on
+        # from where it left off
+        self._offsets = {}
+        self._used = self.header.size
+        for key, offset, _ in self._read(path):
+            self._offsets[key] = offset
+            self._used = offset + self.value.size
+        with open(path, "ab+") as fp:
+            size = max(os.path.getsize(path), 16 * 1024)
+            fp.truncate(size)
+            self._map = mmap.mmap(fp.fileno(), size)
+        self.header.pack_into(self._map, 0, self.magic, self._used)
+        self._fold_exited()
+
+    def _fold_exited(self) -> None:
+        """Add up the files of workers which have exited into one"""
+        root = t.cast(str, self.root)
+        with t.cast(FileLock, self._exited_lock):
+            exited = []
+            for path in self._files():
+                pid = os.path.basename(path).removesuffix(".metrics")
+                if not pid.isdigit() or int(pid) == self._pid:
+                    continue
+                try:
+                    os.kill(int(pid), 0)
+                except ProcessLookupError:
+                    exited.append(path)
+                except PermissionError:  # pragma: no cover - someone else's
+                    pass
+            if not exited:
+                return
+            path = os.path.join(root, "exited.metrics")
+            values: dict[str, float] = {}
+            for src in [path, *exited]:
+                for key, _, value in self._read(src):
+                    values[key] = values.get(key, 0) + value
+            tmp = f"{path}.{self._pid}.tmp"
+            with open(tmp, "wb") as fp:
+                fp.write(self._pack(values))
+            os.replace(tmp, path)
+            for src in exited:
+                os.unlink(src)
+
+    def _pack(self, values: dict[str, float]) -> bytes:
+        """A whole file holding `values`, in the same layout as `_add()` writes"""
+        data = bytearray(self.header.size)
+        for key, value in values.items():
+            raw = key.encode("utf8")
+            data += self.record.pack(len(raw)) + raw
+            data += bytes(-len(data) % 8)
+            data += self.value.pack(value)
+        self.header.pack_into(data, 0, self.magic, len(data))
+        return bytes(data)
+
+    def _add(self, key: str) -> int:
+        data = key.encode("utf8")
+        start = self._used
+        offset = (start + self.record.size + len(data) + 7) & ~7
+        end = offset + self.value.size
+        m = t.cast(mmap.mmap, self._map)
+        if end > len(m):
+            m.resize(max(end, len(m) * 2))
+        self.record.pack_into(m, start, len(data))
+        m[start + self.record.size : start + self.record.size + len(data)] = data
+        self.value.pack_into(m, offset, 0)
+        # readers only look as far as the header says, so update it last
+        self._used = end
+        self.header.pack_into(m, 0, self.magic, end)
+        self._offsets[key] = offset
+        return offset
+
+    def _read(self, path: str) -> t.Iterator[tuple[str, int, float]]:
+        """(key, offset of the value, value) for every record in a file"""
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return
+        if data[0 : len(self.magic)] != self.magic:
+            # not one of ours, or just created and still empty
+            return
+        _, used = self.header.unpack_from(data)
+        pos = self.header.size
+        while pos < used:
+            (length,) = self.record.unpack_from(data, pos)
+            key = data[pos + self.record.size : pos + self.record.size + length]
+            pos = (pos + self.record.size + length + 7) & ~7
+            (value,) = self.value.unpack_from(data, pos)
+            pos += self.value.size
+            yield key.decode("utf8"), pos - self.value.size, value
+
+
+def format_sample(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+    return f"{name} {int(value) if value.is_integer() else value!r}"
+
+
+def metrics() -> Metrics:
+    return current_app.extensions["rav2.metrics"]
+
+
+def time_queries(engines: t.Mapping[str | None, Engine]) -> None:
+    """Record each SQL statement, and how long it took, in `g.sql`"""
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        if has_request_context():
+            sql = g.get("sql")
+            if sql is not None:
+                sql.append((elapsed, statement))
+
+    for engine in engines.values():
+        event.listen(engine, "before_cursor_execute", before)
+        event.listen(engine, "after_cursor_execute", after)
@@ -0,0 +1,71 @@
+from sqlalchemy import bindparam, func, inspect, select, text, update
+from sqlalchemy.schema import CreateColumn
+
+from .models import User, db, name_key, recount_avatars
+
+
+class MigrateError(Exception):
+    pass
+
+
+def migrate() -> list[str]:
+    """
+    Bring an existing database up to date with the models, returning a
+    description of each change made.
+
+    `db.create_all()` only creates tables which don't exist at all, so
+    this also adds anything that has been added to existing tables.
+    """
+    changes = []
+    db.create_all()
+
+    # all on one connection, as each one takes the write lock
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        added = set()
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    spec = CreateColumn(column).compile(conn)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {spec}"))
+                    changes.append(f"Added column {table.name}.{column.name}")
+                    added.add(f"{table.name}.{column.name}")
+
+        # new columns which are worked out from existing ones, filled in
+        # before the indexes on them are created
+        users = conn.execute(
+            select(User.id, User.username).where(User.name_key == "")
+        ).all()
+        if users:
+            conn.execute(
+                update(User.__table__)
+                .where(User.__table__.c.id == bindparam("user_id"))
+                .values(name_key=bindparam("key")),
+                [{"user_id": id, "key": name_key(name)} for id, name in users],
+            )
+            changes.append(f"Filled in users.name_key for {len(users)} users")
+            # names which only differed by case were separate accounts
+            # before, so its unique index can't be created until they're renamed
+            clashes = conn.execute(
+                select(func.group_concat(User.username, ", "))
+                .group_by(User.name_key)
+                .having(func.count() > 1)
+            ).scalars()
+            if clashes := list(clashes):
+                raise MigrateError(
+                    "Usernames which are only different by case need to be"
+                    " renamed first: " + "; ".join(clashes)
+                )
+        if "users.avatar_count" in added:
+            conn.execute(recount_avatars())
+            changes.append("Counted everyone's avatars")
+
+        for table in db.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    changes.append(f"Created index {index.name}")
+
+    return changes
@@ -1,30 +1,132 @@
 import hashlib
-import io
 import os
+import time
+import typing as t
+from datetime import UTC, datetime
 
+from flask import current_app, g
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as BaseSession
 from PIL import Image
+from sqlalchemy import Update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+from .metrics import metrics
+from .sqlite import READ_ONLY
+from .storage import BlobStore, blobs, thumbs
+from .variants import resize
+
+# gallery tiles are 160px wide with 8px of padding
+thumb_size = 144
+
+
+class AvatarAddError(Exception):
+    pass
+
+
+class ImageInfo(t.NamedTuple):
+    hash: str
+    filesize: int
+    width: int
+    height: int
+    mime: str
+
+
+def ingest(fp: t.IO[bytes]) -> ImageInfo:
+    """
+    Stream an uploaded image into the blob store, checking it against the
+    AVATAR_MAX_BYTES / AVATAR_MAX_PIXELS limits along the way, without
+    ever loading the whole file into memory.
+    """
+    return store_image(
+        blobs(),
+        fp,
+        current_app.config["AVATAR_MAX_BYTES"],
+        current_app.config["AVATAR_MAX_PIXELS"],
+    )
+
+
+def store_image(
+    store: BlobStore, fp: t.IO[bytes], max_bytes: int, max_pixels: int
+) -> ImageInfo:
+    """`ingest()`, for use outside of the app (eg in worker processes)"""
+    try:
+        hash, filesize, tmp = store.ingest(fp, max_bytes)
+    except ValueError:
+        raise AvatarAddError(f"Avatar is too big (max {max_bytes} bytes)")
+    try:
+        # Image.open() only reads the headers, not the pixel data
+        with Image.open(tmp) as img:
+            width, height = img.size
+            mime = img.format or "png"
+        if width * height > max_pixels:
+            raise AvatarAddError(f"Avatar is too big (max {max_pixels} pixels)")
+    except (OSError, Image.DecompressionBombError) as e:
+        os.unlink(tmp)
+        raise AvatarAddError("That doesn't look like an image") from e
+    except AvatarAddError:
+        os.unlink(tmp)
+        raise
+    store.commit(tmp, hash)
+    return ImageInfo(hash, filesize, width, height, mime)
+
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+class Session(BaseSession):
+    """
+    A session which, inside views marked as read-only, sends queries to
+    the read-only engine (see `rav2.sqlite`) - so public pages never wait
+    for, or hold up, a write.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and g.get("read_only"):
+            engine = self._db.engines.get(READ_ONLY)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+db = SQLAlchemy(model_class=Base, session_options={"class_": Session})
+
+
+def name_key(username: str) -> str:
+    """
+    What usernames are looked up by, so that "Bob" and "bob" are the same
+    account (and can't both be signed up for)
+    """
+    return username.lower()
 
 
 class User(db.Model):  # type: ignore
     __tablename__ = "users"
+    __table_args__ = (
+        # lower(name) can't use an index, so look users up by a copy of
+        # the name which is already lowered
+        db.Index("ix_users_name_key", "name_key", unique=True),
+        # the gallery's top users, read straight from the index
+        db.Index("ix_users_avatar_count", "avatar_count", "name"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column("name", nullable=False, index=True)
     password: Mapped[str] = mapped_column("pass", db.String(32), nullable=False)
     email: Mapped[str] = mapped_column(default="")
     message: Mapped[str] = mapped_column(default="")
+    # name_key(username) - last, as that's where migrate() adds it to
+    # older databases
+    name_key: Mapped[str] = mapped_column(nullable=False, server_default="")
+    # how many avatars the user has, kept up to date by count_avatars()
+    # in the same transaction as adding or deleting them
+    avatar_count: Mapped[int] = mapped_column(nullable=False, server_default="0")
 
     def __init__(self, username: str, password: str, email: str) -> None:
         self.username = username
+        self.name_key = name_key(username)
         self.password = hashlib.md5(password.encode("utf8")).hexdigest()
         self.email = email
 
@@ -33,27 +135,42 @@ class User(db.Model):  # type: ignore
 
     @property
     def num_avatars(self) -> int:
-        return len(self.avatars)
+        return db.session.scalar(
+            db.select(db.func.count()).where(Avatar.owner_id == self.id)
+        )
 
     @property
     def num_active_avatars(self) -> int:
-        return len([n for n in self.avatars if n.enabled])
+        return db.session.scalar(
+            db.select(db.func.count())
+            .where(Avatar.owner_id == self.id)
+            .where(Avatar.enabled == True)
+        )
 
     @property
     def common_size(self) -> str:
-        # FIXME: incorrect, this takes the first size...
-        sizes = ["%dx%d" % (a.width, a.height) for a in self.avatars]
-        return sizes[0] if sizes else "0x0"
+        size = db.session.execute(
+            db.select(Avatar.width, Avatar.height)
+            .where(Avatar.owner_id == self.id)
+            .group_by(Avatar.width, Avatar.height)
+            .order_by(db.func.count().desc())
+            .limit(1)
+        ).first()
+        return f"{size.width}x{size.height}" if size else "0x0"
 
 
 class Avatar(db.Model):  # type: ignore
     __tablename__ = "avatars"
+    __table_args__ = (
+        # covers picking a random avatar for a user without touching the table
+        db.Index("ix_avatars_owner_enabled", "owner_id", "enabled", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     owner_id: Mapped[int] = mapped_column(
         db.ForeignKey("users.id"), nullable=False, index=True
     )
-    hash: Mapped[str] = mapped_column(db.String(32), nullable=False)
+    hash: Mapped[str] = mapped_column(db.String(32), nullable=False, index=True)
     filename: Mapped[str] = mapped_column(nullable=False)
     width: Mapped[int] = mapped_column(nullable=False)
     height: Mapped[int] = mapped_column(nullable=False)
@@ -68,17 +185,16 @@ class Avatar(db.Model):  # type: ignore
         ),
     )
 
-    def __init__(self, name: str, data: bytes):
-        img = Image.open(io.BytesIO(data))
-
+    def __init__(self, name: str, info: ImageInfo):
+        """Create an avatar for an image which `ingest()` has stored"""
         self.filename = name
-        self.hash = hashlib.md5(data).hexdigest()
-        self.filesize = len(data)
-        self.width, self.height = img.size
-        self.mime = img.format or "png"
+        self.hash = info.hash
+        self.filesize = info.filesize
+        self.width = info.width
+        self.height = info.height
+        self.mime = info.mime
         # if self.width > 150 or self.height > 150:
         #    raise AvatarAddError("Avatar over-sized (max 150x150)")
-        self.data = data
 
     def __repr__(self):
         return f"Avatar({self.filename!r})"
@@ -88,16 +204,125 @@ class Avatar(db.Model):  # type: ignore
         return f"/{self.hash}.{self.mime.lower()}"
 
     @property
-    def dataname(self):
-        return f"data/avatars/{self.hash[0:2]}/{self.hash}"
+    def has_thumb(self) -> bool:
+        return self.width > thumb_size or self.height > thumb_size
+
+    @property
+    def thumb_link(self):
+        if not self.has_thumb:
+            return self.link
+        return f"/thumbs/{self.hash}.{self.mime.lower()}"
+
+    @property
+    def thumbname(self):
+        return thumbs().path(self.hash)
+
+    def make_thumb(self) -> None:
+        """(done by a job after uploading, or when the thumbnail is asked for)"""
+        with self.open() as fp:
+            resize(fp, self.thumbname, (thumb_size, thumb_size), self.mime)
+
+    @property
+    def dataname(self) -> str | None:
+        """The avatar's own file, or None if it's stored in a pack"""
+        return blobs().local_path(self.hash)
+
+    @property
+    def data(self) -> bytes | memoryview:
+        start = time.perf_counter()
+        data = blobs().read(self.hash)
+        m = metrics()
+        m.inc("rav2_storage_reads_total")
+        m.inc("rav2_storage_read_bytes_total", len(data))
+        m.inc("rav2_storage_read_seconds_total", time.perf_counter() - start)
+        return data
+
+    def open(self) -> t.IO[bytes]:
+        return blobs().open(self.hash)
+
+
+def count_avatars(user_id: int, change: int) -> None:
+    """Add `change` to a user's avatar_count"""
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(avatar_count=User.avatar_count + change)
+    )
+
+
+def recount_avatars() -> Update:
+    """A statement which sets every user's avatar_count from scratch"""
+    return db.update(User).values(
+        avatar_count=db.select(db.func.count())
+        .where(Avatar.owner_id == User.id)
+        .scalar_subquery()
+    )
+
+
+class Counter(db.Model):  # type: ignore
+    """
+    A version number for some part of the site, bumped in the same
+    transaction as anything which changes it, so that caches of that
+    part can tell whether they're up to date.
+    """
+
+    __tablename__ = "counters"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    value: Mapped[int] = mapped_column(nullable=False, default=0)
+    updated: Mapped[datetime] = mapped_column(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"Counter({self.name!r}, {self.value!r})"
+
+    @staticmethod
+    def bump(*names: str) -> None:
+        now = datetime.now(UTC).replace(tzinfo=None)
+        for name in names:
+            db.session.execute(
+                insert(Counter)
+                .values(name=name, value=1, updated=now)
+                .on_conflict_do_update(
+                    index_elements=[Counter.name],
+                    set_={"value": Counter.value + 1, "updated": now},
+                )
+            )
+
+    @staticmethod
+    def read(name: str) -> Counter:
+        return db.session.get(Counter, name) or Counter(
+            name=name, value=0, updated=datetime(2000, 1, 1)
+        )
+
+
+class Job(db.Model):  # type: ignore
+    """
+    Work for `flask worker` to do outside of a request (see `rav2.jobs`),
+    queued in the same transaction as whatever needed it.
+    """
+
+    __tablename__ = "jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(nullable=False)
+    # keyword arguments for the kind's handler
+    args: Mapped[dict[str, t.Any]] = mapped_column(db.JSON, nullable=False)
+    # what the owner sees on their page
+    description: Mapped[str] = mapped_column(nullable=False)
+    owner_id: Mapped[int | None] = mapped_column(db.ForeignKey("users.id"), index=True)
+    # "queued", "running" or "failed"
+    status: Mapped[str] = mapped_column(nullable=False, default="queued")
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    # when a queued job is due; when a running one's worker is presumed to
+    # have died, so that another can pick it up; None once it's failed
+    run_after: Mapped[datetime | None] = mapped_column(index=True)
+    error: Mapped[str] = mapped_column(nullable=False, default="")
+
+    def __repr__(self) -> str:
+        return f"Job({self.kind!r}, {self.args!r})"
 
     @property
-    def data(self) -> bytes:  # pragma: no cover
-        with open(self.dataname, "rb") as fp:
-            return fp.read()
-
-    @data.setter
-    def data(self, data: bytes) -> None:  # pragma: no cover
-        os.makedirs(os.path.dirname(self.dataname), exist_ok=True)
-        with open(self.dataname, "wb") as fp:
-            fp.write(data)
+    def state(self) -> str:
+        if self.status == "queued" and self.attempts:
+            return f"will retry (tried {self.attempts} times)"
+        return self.status
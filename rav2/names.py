@@ -0,0 +1,42 @@
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+
+class NameCache:
+    """
+    In-process map of username keys to user ids (or to None, for names
+    which nobody has), so that /<user>.png doesn't need to look the user
+    up on every request.
+
+    Each gunicorn worker has its own copy; a worker forgets a name as soon
+    as it changes that account, and the others when their entry is older
+    than `ttl` seconds. Past `max_items`, the least recently used go.
+    """
+
+    def __init__(self, max_items: int, ttl: float) -> None:
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[int | None, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, load: t.Callable[[], int | None]) -> int | None:
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and now - item[1] < self.ttl:
+                self._items.move_to_end(key)
+                return item[0]
+
+        user_id = load()
+        with self._lock:
+            self._items[key] = (user_id, now)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return user_id
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            self._items.pop(key, None)
@@ -0,0 +1,85 @@
+import random
+import threading
+import time
+import typing as t
+
+
+class IdPool:
+    """
+    A set of row ids which supports O(1) add / remove and picking
+    random members without asking the database to sort anything.
+
+    Safe to share between a worker's threads: changes and sampling
+    take a lock, so they never see the list and index out of step.
+    """
+
+    def __init__(self, ids: t.Iterable[int] = ()) -> None:
+        self._ids: list[int] = []
+        self._pos: dict[int, int] = {}
+        self._lock = threading.Lock()
+        for id in ids:
+            self.add(id)
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._pos
+
+    def add(self, id: int) -> None:
+        with self._lock:
+            if id not in self._pos:
+                self._pos[id] = len(self._ids)
+                self._ids.append(id)
+
+    def remove(self, id: int) -> None:
+        with self._lock:
+            # swap the last element into the removed slot so that the
+            # list stays dense and removal doesn't need to shift anything
+            pos = self._pos.pop(id, None)
+            if pos is None:
+                return
+            last = self._ids.pop()
+            if pos < len(self._ids):
+                self._ids[pos] = last
+                self._pos[last] = pos
+
+    def choice(self) -> int | None:
+        with self._lock:
+            return random.choice(self._ids) if self._ids else None
+
+    def sample(self, k: int) -> list[int]:
+        with self._lock:
+            return random.sample(self._ids, min(k, len(self._ids)))
+
+
+class PoolCache[K]:
+    """
+    In-process cache of IdPools, loaded on demand.
+
+    Each gunicorn worker has its own copy, so changes made by one worker
+    are applied locally straight away and picked up by the others when
+    their copy is older than `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._pools: dict[K, IdPool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: K, load: t.Callable[[], t.Iterable[int]]) -> IdPool:
+        pool = self._pools.get(key)
+        if pool is None or time.monotonic() - pool.loaded_at > self.ttl:
+            pool = IdPool(load())
+            with self._lock:
+                self._pools[key] = pool
+        return pool
+
+    def peek(self, key: K) -> IdPool | None:
+        """Get a pool only if it's already loaded, eg to update it in place."""
+        return self._pools.get(key)
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._pools.pop(key, None)
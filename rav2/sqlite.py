@@ -0,0 +1,72 @@
+import sqlite3
+import typing as t
+
+from flask import Flask, g, has_app_context
+from sqlalchemy import Connection, Engine, event, make_url
+
+# the SQLALCHEMY_BINDS key for connections used by read-only views
+READ_ONLY = "readonly"
+
+
+def configure(app: Flask) -> None:
+    """
+    Set up the engine options for `db.init_app()`: bounded connection
+    pools, and (for an SQLite file) a second, read-only, engine.
+    """
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url.database in (None, "", ":memory:"):
+        return
+    # a bounded pool, so that a burst of requests queues for a
+    # connection instead of opening hundreds of them
+    pool = {"pool_size": app.config["ASGI_THREADS"], "max_overflow": 0}
+    engine_options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    for key, value in pool.items():
+        engine_options.setdefault(key, value)
+
+    if url.get_backend_name() != "sqlite":  # pragma: no cover
+        return
+    if not url.query.get("uri"):
+        url = url.set(database=f"file:{url.database}").update_query_dict(
+            {"uri": "true"}
+        )
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+    binds.setdefault(READ_ONLY, {"url": url.update_query_dict({"mode": "ro"}), **pool})
+
+
+def tune(engines: t.Mapping[str | None, Engine], pragmas: dict[str, t.Any]) -> None:
+    """
+    Apply `pragmas` to every new SQLite connection. The main engine also
+    switches the database to WAL, so that readers and the writer don't
+    block each other, and starts transactions which will write with
+    BEGIN IMMEDIATE.
+    """
+    for key, engine in engines.items():
+        if engine.dialect.name != "sqlite":  # pragma: no cover
+            continue
+        writer = key is None
+
+        def connect(dbapi_connection: sqlite3.Connection, record, writer=writer):
+            if writer:
+                # we send BEGIN ourselves, below
+                dbapi_connection.isolation_level = None
+                dbapi_connection.execute("PRAGMA journal_mode=WAL")
+            for name, value in pragmas.items():
+                dbapi_connection.execute(f"PRAGMA {name}={value}")
+
+        event.listen(engine, "connect", connect)
+
+        if writer:
+            event.listen(engine, "begin", begin)
+
+
+def begin(conn: Connection) -> None:
+    # take the write lock at the start of the transaction, rather than when
+    # we first write: an upgrade from a read lock which has to wait fails
+    # straight away with "database is locked", while waiting for BEGIN
+    # IMMEDIATE respects busy_timeout. Views marked as read-only only come
+    # here to flush (which writes straight away), or to read when there's
+    # no read-only engine, so they needn't wait for the lock.
+    if has_app_context() and g.get("read_only"):
+        conn.exec_driver_sql("BEGIN")
+    else:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
@@ -0,0 +1,557 @@
+import contextlib
+import fcntl
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import typing as t
+
+from flask import current_app
+
+
+class FileLock:
+    """
+    A lock shared by every thread, in every process, which uses `path`:
+    `with lock:` to hold it alone, or `with lock.shared():` alongside
+    anyone else who only wants to read.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    def _file(self) -> t.IO[bytes]:
+        # flock()s belong to the open file, which other threads and forked
+        # workers would share, so each thread of each process opens its own
+        fp = getattr(self._local, "fp", None)
+        if fp is None or self._local.pid != os.getpid():
+            fp = self._local.fp = open(self.path, "a+b")  # noqa: SIM115
+            self._local.pid = os.getpid()
+        return fp
+
+    def __enter__(self) -> None:
+        fcntl.flock(self._file(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc: object) -> None:
+        fcntl.flock(self._local.fp, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def shared(self) -> t.Generator[None]:
+        fp = self._file()
+        fcntl.flock(fp, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class BlobStore:
+    """
+    Content-addressed files, stored as `<root>/<hash[0:2]>/<hash>`.
+
+    Since a blob's name is the hash of its content, a blob which already
+    exists never needs writing again, no matter how many avatars use it.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path(self, hash: str) -> str:
+        return os.path.join(self.root, hash[0:2], hash)
+
+    def local_path(self, hash: str) -> str | None:
+        """A file containing just this blob, if the store has one"""
+        return self.path(hash)
+
+    def exists(self, hash: str) -> bool:
+        return os.path.exists(self.path(hash))
+
+    def read(self, hash: str) -> bytes | memoryview:
+        with open(self.path(hash), "rb") as fp:
+            return fp.read()
+
+    def open(self, hash: str) -> t.IO[bytes]:
+        return open(self.path(hash), "rb")
+
+    def put(self, hash: str, data: bytes) -> bool:
+        """Store a blob, returning False if it was already there"""
+        path = self.path(hash)
+        try:
+            # bump the mtime so that gc-storage, which only deletes blobs
+            # older than its grace period, won't race with this upload
+            os.utime(path)
+            return False
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary name and rename, so that readers never see
+        # a half-written file
+        tmp = self.tmp_path(hash)
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+        return True
+
+    def tmp_path(self, hash: str) -> str:
+        return f"{self.path(hash)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def ingest(
+        self, fp: t.IO[bytes], max_bytes: int, chunk_size: int = 64 * 1024
+    ) -> tuple[str, int, str]:
+        """
+        Copy a stream into a temporary file in the store, hashing it as we
+        go, without ever holding more than `chunk_size` bytes in memory.
+
+        Returns (hash, size, temporary path); pass the path to `commit()`
+        once the caller is happy with the content. Raises ValueError and
+        removes the temporary file if the stream is over `max_bytes`.
+        """
+        tmp = os.path.join(
+            self.root, "incoming", f"{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        md5 = hashlib.md5()
+        size = 0
+        try:
+            with open(tmp, "wb") as out:
+                while chunk := fp.read(chunk_size):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(f"Blob is over {max_bytes} bytes")
+                    md5.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return md5.hexdigest(), size, tmp
+
+    def commit(self, tmp: str, hash: str) -> bool:
+        """Move an ingested file into place, returning False if it was already there"""
+        path = self.path(hash)
+        try:
+            # (see put())
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+            return True
+        os.unlink(tmp)
+        return False
+
+    def delete(self, hash: str) -> None:
+        try:
+            os.unlink(self.path(hash))
+        except FileNotFoundError:
+            pass
+
+    def delete_unused(
+        self, hash: str, cutoff: float, in_use: t.Callable[[str], bool]
+    ) -> bool:
+        """
+        Delete a blob unless it has been stored again since `cutoff`, or
+        `in_use(hash)` says that something refers to it now, returning
+        whether it was deleted.
+
+        It's moved out of the way before checking, so an upload of the
+        same content either bumps the mtime before that (and the blob is
+        put back), or finds it gone and writes a copy of its own.
+        """
+        path = self.path(hash)
+        trash = self.tmp_path(hash)
+        try:
+            os.replace(path, trash)
+        except FileNotFoundError:  # pragma: no cover
+            return False
+        if os.stat(trash).st_mtime > cutoff or in_use(hash):
+            # (an upload may have written an identical copy meanwhile)
+            os.replace(trash, path)
+            return False
+        os.unlink(trash)
+        return True
+
+    def files(self) -> t.Iterator[os.DirEntry]:
+        """Every file in the store's shards, including temporary ones"""
+        if not os.path.isdir(self.root):
+            return
+        for shard in os.scandir(self.root):
+            if shard.is_dir() and (len(shard.name) == 2 or shard.name == "incoming"):
+                yield from (e for e in os.scandir(shard) if e.is_file())
+
+    def entries(self) -> t.Iterator[tuple[str, float, int]]:
+        """(hash, mtime, size) for every complete blob"""
+        for entry in self.files():
+            if len(entry.name) == 32:
+                stat = entry.stat()
+                yield entry.name, stat.st_mtime, stat.st_size
+
+
+class PackStore(BlobStore):
+    """
+    Blobs appended to large pack files in `<root>/packs/`, instead of
+    one file each.
+
+    They're found through `index.dat`, an open-addressing hash table of
+    md5 -> (pack, offset, length) which every worker mmaps, so lookups
+    are a few memory reads with no parsing, and the OS page cache holds
+    one copy of it for all workers. Packs are mmapped too, so reads are
+    memoryview slices of the page cache rather than copies.
+
+    Writers take an flock() on `<root>/packs/lock`. Deleting a blob only
+    marks its slot as deleted - the space is reclaimed by `compact()`.
+    """
+
+    pack_size = 1 << 30
+    # magic, capacity, used slots, current pack, superseded
+    header = struct.Struct("<8sQQQQ")
+    header_size = 64
+    # md5, pack, state, offset, length, mtime
+    slot = struct.Struct("<16sIIQQQ")
+    magic = b"RAVPACK1"
+    EMPTY, LIVE, DELETED = 0, 1, 2
+
+    def __init__(self, root: str, capacity: int = 1 << 16) -> None:
+        super().__init__(root)
+        self.dir = os.path.join(root, "packs")
+        os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, "index.dat")
+        self._lock = FileLock(os.path.join(self.dir, "lock"))
+        self._packs: dict[int, mmap.mmap] = {}
+        with self._lock:
+            if not os.path.exists(self.index_path):
+                self._write_index(capacity, 0, [])
+        self._open_index()
+
+    ###################################################################
+    # Index
+
+    def _open_index(self) -> None:
+        with open(self.index_path, "r+b") as fp:
+            self._index = mmap.mmap(fp.fileno(), 0)
+        magic, self._capacity, _, _, _ = self.header.unpack_from(self._index)
+        if magic != self.magic:  # pragma: no cover
+            raise ValueError(f"{self.index_path} is not a pack index")
+
+    def _refresh(self) -> None:
+        # another process replaced the index (to grow or compact it) and
+        # flagged the one we have open as out of date
+        if self._get_header()[4]:
+            self._open_index()
+
+    def _get_header(self) -> tuple[bytes, int, int, int, int]:
+        return self.header.unpack_from(self._index)
+
+    def _set_header(self, used: int, pack: int, superseded: int = 0) -> None:
+        self.header.pack_into(
+            self._index, 0, self.magic, self._capacity, used, pack, superseded
+        )
+
+    def _write_index(
+        self, capacity: int, pack: int, live: list[tuple[bytes, int, int, int, int]]
+    ) -> None:
+        """Write a fresh index containing `live` and swap it into place"""
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w+b") as fp:
+            fp.truncate(self.header_size + capacity * self.slot.size)
+            index = mmap.mmap(fp.fileno(), 0)
+            self.header.pack_into(index, 0, self.magic, capacity, len(live), pack, 0)
+            for key, pack_no, offset, length, mtime in live:
+                n = int.from_bytes(key[0:8], "little") % capacity
+                while self.slot.unpack_from(index, self._slot_offset(n))[2]:
+                    n = (n + 1) % capacity
+                self.slot.pack_into(
+                    index,
+                    self._slot_offset(n),
+                    key,
+                    pack_no,
+                    self.LIVE,
+                    offset,
+                    length,
+                    mtime,
+                )
+            index.flush()
+            index.close()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.index_path)
+
+    def _slot_offset(self, n: int) -> int:
+        return self.header_size + n * self.slot.size
+
+    def _set_state(self, n: int, state: int) -> None:
+        struct.pack_into("<I", self._index, self._slot_offset(n) + 20, state)
+
+    def _find(self, key: bytes) -> tuple[int, tuple[int, int, int, int] | None]:
+        """
+        Returns (slot number, (pack, offset, length, mtime)) if the key
+        is live, or (slot number to insert it at, None) if it isn't
+        """
+        n = int.from_bytes(key[0:8], "little") % self._capacity
+        free = None
+        for _ in range(self._capacity):
+            k, pack, state, offset, length, mtime = self.slot.unpack_from(
+                self._index, self._slot_offset(n)
+            )
+            if state == self.EMPTY:
+                return (n if free is None else free), None
+            if state == self.DELETED:
+                if free is None:
+                    free = n
+            elif k == key:
+                return n, (pack, offset, length, mtime)
+            n = (n + 1) % self._capacity
+        assert free is not None, "pack index is full"
+        return free, None
+
+    def _live(self) -> list[tuple[bytes, int, int, int, int]]:
+        live = []
+        for n in range(self._capacity):
+            k, pack, state, offset, length, mtime = self.slot.unpack_from(
+                self._index, self._slot_offset(n)
+            )
+            if state == self.LIVE:
+                live.append((k, pack, offset, length, mtime))
+        return live
+
+    def _replace_index(
+        self, capacity: int, pack: int, live: list[tuple[bytes, int, int, int, int]]
+    ) -> None:
+        self._write_index(capacity, pack, live)
+        old_used, old_pack = self._get_header()[2:4]
+        self._set_header(old_used, old_pack, superseded=1)
+        self._open_index()
+
+    ###################################################################
+    # Packs
+
+    def _pack_path(self, pack: int) -> str:
+        return os.path.join(self.dir, f"pack-{pack:06d}.dat")
+
+    def _pack_map(self, pack: int, end: int) -> mmap.mmap:
+        m = self._packs.get(pack)
+        if m is None or len(m) < end:
+            # never seen this pack, or it has grown since we mapped it;
+            # old maps are left for the GC to close, since there may still
+            # be memoryviews of them in use
+            with open(self._pack_path(pack), "rb") as fp:
+                m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._packs[pack] = m
+        return m
+
+    def _append(self, pack: int, src: t.IO[bytes]) -> tuple[int, int, int]:
+        """Copy `src` to the end of a pack, returning (pack, offset, length)"""
+        path = self._pack_path(pack)
+        if os.path.exists(path) and os.path.getsize(path) >= self.pack_size:
+            pack += 1
+            path = self._pack_path(pack)
+        with open(path, "ab") as fp:
+            offset = fp.tell()
+            shutil.copyfileobj(src, fp)
+            length = fp.tell() - offset
+            fp.flush()
+            os.fsync(fp.fileno())
+        return pack, offset, length
+
+    def _add(self, hash: str, src: t.IO[bytes]) -> bool:
+        key = bytes.fromhex(hash)
+        with self._lock:
+            self._refresh()
+            n, found = self._find(key)
+            _, _, used, current, _ = self._get_header()
+            if found:
+                # like the mtime bump in BlobStore.put()
+                struct.pack_into(
+                    "<Q", self._index, self._slot_offset(n) + 40, int(time.time())
+                )
+                return False
+            pack, offset, length = self._append(current, src)
+            # the data is on disk before the index points at it, and the
+            # slot is filled in before it's marked live, so readers never
+            # see half of an entry
+            self.slot.pack_into(
+                self._index,
+                self._slot_offset(n),
+                key,
+                pack,
+                self.DELETED,
+                offset,
+                length,
+                int(time.time()),
+            )
+            self._set_state(n, self.LIVE)
+            self._set_header(used + 1, pack)
+            if used + 1 > self._capacity * 0.7:
+                self._replace_index(self._capacity * 2, pack, self._live())
+        return True
+
+    ###################################################################
+    # BlobStore API
+
+    def local_path(self, hash: str) -> str | None:
+        return None
+
+    def _lookup(self, hash: str) -> tuple[int, int, int, int] | None:
+        self._refresh()
+        return self._find(bytes.fromhex(hash))[1]
+
+    def exists(self, hash: str) -> bool:
+        return self._lookup(hash) is not None
+
+    def read(self, hash: str) -> memoryview:
+        found = self._lookup(hash)
+        if found is None:
+            raise FileNotFoundError(hash)
+        pack, offset, length, _ = found
+        return memoryview(self._pack_map(pack, offset + length))[
+            offset : offset + length
+        ]
+
+    def open(self, hash: str) -> t.IO[bytes]:
+        return io.BytesIO(self.read(hash))
+
+    def put(self, hash: str, data: bytes) -> bool:
+        return self._add(hash, io.BytesIO(data))
+
+    def commit(self, tmp: str, hash: str) -> bool:
+        try:
+            with open(tmp, "rb") as fp:
+                return self._add(hash, fp)
+        finally:
+            os.unlink(tmp)
+
+    def delete(self, hash: str) -> None:
+        key = bytes.fromhex(hash)
+        with self._lock:
+            self._refresh()
+            n, found = self._find(key)
+            if found:
+                self._set_state(n, self.DELETED)
+
+    def delete_unused(
+        self, hash: str, cutoff: float, in_use: t.Callable[[str], bool]
+    ) -> bool:
+        # adding a blob takes the same lock, so an upload either bumps the
+        # mtime before we look, or finds the blob gone and adds it again
+        key = bytes.fromhex(hash)
+        with self._lock:
+            self._refresh()
+            n, found = self._find(key)
+            if found is None or found[3] > cutoff or in_use(hash):
+                return False
+            self._set_state(n, self.DELETED)
+            return True
+
+    def entries(self) -> t.Iterator[tuple[str, float, int]]:
+        self._refresh()
+        for key, _, _, length, mtime in self._live():
+            yield key.hex(), mtime, length
+
+    ###################################################################
+    # Maintenance
+
+    def compact(self) -> int:
+        """
+        Copy live blobs into fresh packs and delete the old ones, returning
+        the number of bytes reclaimed. Readers can carry on throughout:
+        they either have the old index and old (unlinked, still mapped)
+        packs, or the new ones.
+        """
+        with self._lock:
+            self._refresh()
+            old_packs = sorted(
+                int(name[5:11])
+                for name in os.listdir(self.dir)
+                if name.startswith("pack-")
+            )
+            before = sum(os.path.getsize(self._pack_path(p)) for p in old_packs)
+            pack = (old_packs[-1] + 1) if old_packs else 0
+            live = []
+            for key, old_pack, offset, length, mtime in self._live():
+                m = self._pack_map(old_pack, offset + length)
+                pack, new_offset, _ = self._append(
+                    pack, io.BytesIO(m[offset : offset + length])
+                )
+                live.append((key, pack, new_offset, length, mtime))
+            capacity = self._capacity
+            while len(live) > capacity * 0.5 and capacity > 1:  # pragma: no cover
+                capacity *= 2
+            self._replace_index(capacity, pack, live)
+            for p in old_packs:
+                os.unlink(self._pack_path(p))
+                self._packs.pop(p, None)
+            after = sum(
+                os.path.getsize(self._pack_path(p))
+                for p in {p for _, p, _, _, _ in live}
+            )
+        return before - after
+
+
+def blobs() -> BlobStore:
+    """Original avatar files"""
+    return current_app.extensions["rav2.blobs"]
+
+
+def thumbs() -> BlobStore:
+    """Gallery thumbnails, named after the hash of the original"""
+    return current_app.extensions["rav2.thumbs"]
+
+
+class GCReport(t.NamedTuple):
+    deleted: int
+    deleted_bytes: int
+    missing: list[str]
+
+
+def collect_garbage(
+    store: BlobStore,
+    derived: t.Iterable[str],
+    referenced: set[str],
+    grace: float,
+    dry_run: bool = False,
+    in_use: t.Callable[[str], bool] = lambda hash: False,
+) -> GCReport:
+    """
+    Delete blobs from `store`, and files derived from them (thumbnails,
+    scaled variants) from the `derived` directories, whose hash isn't in
+    `referenced`; and list referenced blobs which are missing.
+
+    `referenced` must be read *before* calling this, and anything modified
+    in the last `grace` seconds is left alone. Each blob's mtime is checked
+    again as it's deleted, along with `in_use(hash)` (which should look in
+    the database again) - so an upload which finishes while we're running,
+    even one of a blob which we're about to delete, is never deleted from
+    under it.
+    """
+    deleted = deleted_bytes = 0
+    present = set()
+    cutoff = time.time() - grace
+
+    for hash, mtime, size in list(store.entries()):
+        if hash in referenced:
+            present.add(hash)
+        elif mtime <= cutoff and (dry_run or store.delete_unused(hash, cutoff, in_use)):
+            deleted += 1
+            deleted_bytes += size
+
+    for root in [store.root, *derived]:
+        for entry in BlobStore(root).files():
+            # derived files are named "<hash>" or "<hash>.<something>"
+            if root == store.root:
+                if not entry.name.endswith(".tmp"):
+                    continue  # blobs were dealt with above
+            elif entry.name[0:32] in referenced:
+                continue
+            stat = entry.stat()
+            if stat.st_mtime > cutoff:
+                continue
+            if not dry_run:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:  # pragma: no cover
+                    continue
+            deleted += 1
+            deleted_bytes += stat.st_size
+
+    return GCReport(deleted, deleted_bytes, sorted(referenced - present))
@@ -0,0 +1,130 @@
+import os
+import threading
+import typing as t
+
+from PIL import Image, ImageSequence
+
+Size = tuple[int, int]
+
+# scaled frames of an animation are all held in memory until it's saved, so
+# ones which would add up to more pixels than this only keep their first
+ANIMATION_PIXELS = 16 * 1024 * 1024
+
+
+def resize(
+    src: str | t.IO[bytes],
+    dst: str,
+    size: Size,
+    format: str,
+    max_pixels: int = ANIMATION_PIXELS,
+) -> None:
+    """Write a copy of `src` (a path or file) scaled to fit within `size` to `dst`."""
+    with Image.open(src) as img:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # write to a temporary name and rename, so that other workers
+        # never see a half-written file
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        scale = min(1, size[0] / img.width, size[1] / img.height)
+        pixels = int(img.width * scale) * int(img.height * scale)
+        if (
+            getattr(img, "is_animated", False)
+            and getattr(img, "n_frames", 1) * pixels <= max_pixels
+        ):
+            # scale every frame, so that animations still move
+            frames = []
+            durations = []
+            for frame in ImageSequence.Iterator(img):
+                durations.append(frame.info.get("duration", 100))
+                frame = frame.convert("RGBA")
+                frame.thumbnail(size)
+                frames.append(frame)
+            extra = {"loop": img.info["loop"]} if "loop" in img.info else {}
+            frames[0].save(
+                tmp,
+                format,
+                save_all=True,
+                append_images=frames[1:],
+                duration=durations,
+                **extra,
+            )
+        else:
+            img.thumbnail(size)
+            img.save(tmp, format)
+        os.replace(tmp, dst)
+
+
+class VariantCache:
+    """
+    Scaled copies of avatars, stored on disk as `<root>/xx/<hash>.<W>x<H>`.
+
+    The total size is kept under `max_bytes` by deleting the least recently
+    used variants, where "used" is tracked by the file's mtime so that all
+    workers share the same view of it. Each time it goes over, variants are
+    deleted until it's `low_water` of the way there, so that the directory
+    isn't re-scanned for every new one.
+    """
+
+    low_water = 0.9
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self._used: int | None = None
+        self._lock = threading.Lock()
+
+    def path(self, hash: str, size: Size) -> str:
+        return os.path.join(self.root, hash[0:2], f"{hash}.{size[0]}x{size[1]}")
+
+    def get(
+        self, open: t.Callable[[], t.IO[bytes]], hash: str, format: str, size: Size
+    ) -> str:
+        """
+        The path of `hash` scaled to `size`, creating it from the original
+        (which `open()` returns) if it isn't cached already
+        """
+        path = self.path(hash, size)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        with open() as src:
+            resize(src, path, size, format)
+        with self._lock:
+            if self._used is None:
+                self._used = self._scan()[1]
+            else:
+                self._used += os.path.getsize(path)
+            if self._used > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _scan(self) -> tuple[list[os.DirEntry], int]:
+        entries = []
+        if os.path.isdir(self.root):
+            for shard in os.scandir(self.root):
+                # (leaving out files which resize() is still writing)
+                entries.extend(
+                    e
+                    for e in os.scandir(shard)
+                    if e.is_file() and not e.name.endswith(".tmp")
+                )
+        return entries, sum(e.stat().st_size for e in entries)
+
+    def _evict(self, keep: str) -> None:
+        # other workers add and remove files too, so rather than trusting
+        # our running total, re-count what's actually on disk
+        entries, used = self._scan()
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            if used <= self.max_bytes * self.low_water:
+                break
+            if entry.path == keep:
+                continue
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:  # pragma: no cover
+                pass
+            used -= entry.stat().st_size
+        self._used = used
@@ -6,6 +6,8 @@ import typing as t
 import pytest
 from flask import Flask
 from flask.testing import FlaskClient, FlaskCliRunner
+from PIL import Image
+from sqlalchemy import event
 
 from rav2 import create_app
 from rav2.models import db
@@ -17,22 +19,44 @@ with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as f:
 @pytest.fixture
 def app():
     db_fd, db_path = tempfile.mkstemp()
+    data_dir = tempfile.TemporaryDirectory()
+    avatar_dir = os.path.join(data_dir.name, "avatars")
 
     app = create_app(
         {
             "TESTING": True,
             "SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}",
+            "AVATAR_DIR": avatar_dir,
+            "AVATAR_VARIANT_DIR": os.path.join(data_dir.name, "variants"),
+            "THUMB_DIR": os.path.join(data_dir.name, "thumbs"),
+            "AVATAR_FORMAT_DIR": os.path.join(data_dir.name, "formats"),
+            "HOT_CACHE_PATH": os.path.join(data_dir.name, "hot"),
+            "METRICS_DIR": os.path.join(data_dir.name, "metrics"),
         }
     )
 
     with app.app_context():
         db.create_all()
-        sqlite3.connect(db_path).cursor().executescript(_data_sql)
+        conn = sqlite3.connect(db_path)
+        conn.executescript(_data_sql)
+        # real image files for the avatars in data.sql (the hashes don't
+        # match the content, but nothing checks that)
+        for hash, width, height, mime in conn.execute(
+            "SELECT hash, width, height, mime FROM avatars"
+        ):
+            os.makedirs(os.path.join(avatar_dir, hash[0:2]), exist_ok=True)
+            Image.new("RGB", (width, height), "purple").save(
+                os.path.join(avatar_dir, hash[0:2], hash), mime
+            )
+        conn.close()
 
     yield app
 
     os.close(db_fd)
-    os.unlink(db_path)
+    for path in [db_path, f"{db_path}-wal", f"{db_path}-shm"]:
+        if os.path.exists(path):
+            os.unlink(path)
+    data_dir.cleanup()
 
 
 @pytest.fixture
@@ -52,3 +76,20 @@ def user_client(client: FlaskClient) -> t.Generator[FlaskClient, None, None]:
 @pytest.fixture
 def runner(app: Flask) -> FlaskCliRunner:
     return app.test_cli_runner()
+
+
+@pytest.fixture
+def queries(app: Flask) -> t.Generator[list[str], None, None]:
+    """SQL statements run while the test is running"""
+    statements: list[str] = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    for engine in engines:
+        event.remove(engine, "before_cursor_execute", record)
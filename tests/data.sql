@@ -1,6 +1,6 @@
-INSERT INTO users VALUES(1,'test','098f6bcd4621d373cade4e832627b4f6','','testing <b>boldly</b>');
-INSERT INTO users VALUES(2,'test2','ad0234829205b9033196ba818f7a872b','','');
-INSERT INTO users VALUES(3,'noavs','6ce85dd6c242477580ca2a210e75bfd7','','');
+INSERT INTO users VALUES(1,'test','098f6bcd4621d373cade4e832627b4f6','','testing <b>boldly</b>','test',2);
+INSERT INTO users VALUES(2,'test2','ad0234829205b9033196ba818f7a872b','','','test2',1);
+INSERT INTO users VALUES(3,'noavs','6ce85dd6c242477580ca2a210e75bfd7','','','noavs',0);
 
 INSERT INTO avatars VALUES(1,1,'0c15b14b8e32985f39a52c0a071ae6cd','klk-1.png',249,249,63273,'PNG',1);
 INSERT INTO avatars VALUES(2,1,'1873689aae9bd74e55dec440e10bc01c','ina_assembler.png',246,246,114067,'PNG',1);
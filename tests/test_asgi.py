@@ -0,0 +1,161 @@
+import asyncio
+import io
+import typing as t
+
+from flask import Flask
+from flask.testing import FlaskClient
+
+from rav2.asgi import ASGIApp, AsyncFile, create_asgi_app
+
+
+def call(
+    asgi: ASGIApp,
+    path: str,
+    method: str = "GET",
+    headers: t.Sequence[tuple[str, str]] = (),
+    body: t.Sequence[bytes] = (b"",),
+) -> tuple[int, dict[str, str], bytes]:
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "server": ("localhost", 8000),
+        "client": ("127.0.0.1", 1234),
+    }
+    chunks = list(body)
+    sent: list[dict[str, t.Any]] = []
+
+    async def receive():
+        return {
+            "type": "http.request",
+            "body": chunks.pop(0),
+            "more_body": bool(chunks),
+        }
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi(scope, receive, send))
+    start = sent[0]
+    assert start["type"] == "http.response.start"
+    assert not sent[-1].get("more_body")
+    return (
+        start["status"],
+        {k.decode(): v.decode() for k, v in start["headers"]},
+        b"".join(m["body"] for m in sent[1:]),
+    )
+
+
+def test_asgi(app: Flask, client: FlaskClient):
+    asgi = ASGIApp(app, threads=2)
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+
+    # from memory
+    status, headers, data = call(asgi, f"/{hash}.png")
+    assert status == 200
+    assert data == client.get(f"/{hash}.png").data
+    assert headers["etag"] == f'"{hash}"'
+
+    # from a file, which the event loop sends
+    status, headers, data = call(asgi, f"/thumbs/{hash}.png")
+    assert status == 200
+    assert data == client.get(f"/thumbs/{hash}.png").data
+    assert int(headers["content-length"]) == len(data)
+
+    status, headers, part = call(
+        asgi, f"/thumbs/{hash}.png", headers=[("Range", "bytes=2-4")]
+    )
+    assert status == 206
+    assert part == data[2:5]
+
+    status, _, _ = call(asgi, f"/thumbs/{hash}.png", headers=[("If-None-Match", hash)])
+    assert status == 304
+
+    status, _, data = call(asgi, "/gallery", method="HEAD")
+    assert status == 200
+    assert data == b""
+
+    status, _, data = call(asgi, "/test.png?scale=10x10")
+    assert status == 200
+
+    status, _, data = call(
+        asgi,
+        "/login",
+        method="POST",
+        headers=[("Content-Type", "application/x-www-form-urlencoded")],
+        body=[b"username=test&", b"password=wrong"],
+    )
+    assert status == 404
+
+    # a body which is spooled to disk, and a session cookie which arrives
+    # alongside another one
+    app.config["ASGI_SPOOL_BYTES"] = 4
+    status, headers, _ = call(
+        asgi,
+        "/login",
+        method="POST",
+        headers=[("Content-Type", "application/x-www-form-urlencoded")],
+        body=[b"username=test&", b"password=test"],
+    )
+    assert status == 302
+    session = headers["set-cookie"].split(";")[0]
+    for cookies in (["a=1", session], [session, "b=2"]):
+        status, _, _ = call(asgi, "/user", headers=[("Cookie", c) for c in cookies])
+        assert status == 200
+
+    app.config["MAX_CONTENT_LENGTH"] = 10
+    status, _, data = call(asgi, "/upload", method="POST", body=[b"x" * 20])
+    assert status == 413
+
+
+def test_asgi_lifespan(app: Flask):
+    asgi = create_asgi_app({**app.config})
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent: list[dict[str, t.Any]] = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi({"type": "lifespan"}, receive, send))
+    assert [m["type"] for m in sent] == [
+        "lifespan.startup.complete",
+        "lifespan.shutdown.complete",
+    ]
+
+    # we don't do websockets
+    asyncio.run(asgi({"type": "websocket"}, receive, send))
+    assert len(sent) == 2
+
+
+def test_async_file_fallback():
+    fp = AsyncFile(io.BytesIO(b"hello"), block_size=2)
+    assert fp.seekable()
+    fp.seek(1)
+    assert fp.tell() == 1
+    assert list(fp) == [b"el", b"lo"]
+
+
+def test_async_file_send():
+    def messages(start: int = 0, end: int | None = None) -> list[tuple[bytes, bool]]:
+        sent = []
+
+        async def send(message):
+            sent.append((message["body"], message["more_body"]))
+
+        asyncio.run(
+            AsyncFile(io.BytesIO(b"hello"), block_size=2).send(send, start, end)
+        )
+        return sent
+
+    # the last block says it's the last, rather than an empty message after it
+    assert messages() == [(b"he", True), (b"ll", True), (b"o", False)]
+    assert messages(1, 5) == [(b"el", True), (b"lo", False)]
+    assert messages(5) == [(b"", False)]
@@ -2,6 +2,7 @@ import pytest
 from flask import Flask, g, session
 from flask.testing import FlaskClient
 
+import rav2
 from rav2.models import db
 
 
@@ -34,6 +35,32 @@ def test_create(client: FlaskClient, username, password1, password2, error):
         )
 
 
+def test_create_race(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    # someone else signs up with the name between our check and our insert
+    monkeypatch.setattr(rav2, "name_key", lambda username: "not-taken")
+    response = client.post(
+        "/create", data={"username": "Test", "password1": "a", "password2": "a"}
+    )
+    assert b"already been taken" in response.data
+
+
+def test_create_known_name(client: FlaskClient):
+    # a worker which has seen that nobody has a name forgets it when
+    # someone signs up with it
+    assert client.get("/newbie.png").status_code == 404
+    client.post(
+        "/create", data={"username": "NewBie", "password1": "a", "password2": "a"}
+    )
+    db.session.execute(
+        db.text(
+            "INSERT INTO avatars VALUES(4, 4, '0c15b14b8e32985f39a52c0a071ae6cd', "
+            "'klk-1.png', 249, 249, 63273, 'PNG', 1)"
+        )
+    )
+    db.session.commit()
+    assert client.get("/newbie.png").status_code == 200
+
+
 @pytest.mark.parametrize(
     ("username", "password", "ok"),
     (
@@ -0,0 +1,276 @@
+import io
+import os
+import zipfile
+
+from flask import Flask
+from flask.testing import FlaskCliRunner
+from PIL import Image
+from sqlalchemy import event, select
+
+from rav2 import create_app
+from rav2.models import Avatar, db
+from rav2.storage import blobs
+
+
+def test_backfill_thumbs(app: Flask, runner: FlaskCliRunner):
+    result = runner.invoke(args=["backfill-thumbs", "--workers", "2"])
+    assert "Created 3 thumbnails, 0 failed." in result.output
+
+    with app.app_context():
+        for avatar in db.session.execute(select(Avatar)).scalars():
+            assert Image.open(avatar.thumbname).size == (144, 144)
+        os.unlink(avatar.thumbname)
+        os.unlink(blobs().path(avatar.hash))
+
+    result = runner.invoke(args=["backfill-thumbs", "--workers", "1"])
+    assert "Created 0 thumbnails, 1 failed." in result.output
+
+
+def test_encode_formats(app: Flask, runner: FlaskCliRunner):
+    result = runner.invoke(args=["encode-formats", "--workers", "1"])
+    assert "Encoded 6 files (" in result.output
+    assert "0 not worth it, 0 failed." in result.output
+
+    with app.app_context():
+        hash = db.get_or_404(Avatar, 1).hash
+    path = os.path.join(app.config["AVATAR_FORMAT_DIR"], hash[0:2], f"{hash}.webp")
+    os.unlink(path)
+    with open(os.path.join(app.config["AVATAR_DIR"], hash[0:2], hash), "wb") as fp:
+        fp.write(b"junk")
+    result = runner.invoke(args=["encode-formats", "--workers", "1"])
+    assert f"{path}: " in result.output
+    assert (
+        "Encoded 0 files (0 bytes smaller than the originals), 0 not worth it, "
+        in result.output
+    )
+    assert "1 failed." in result.output
+
+
+def test_migrate_db(app: Flask, runner: FlaskCliRunner):
+    with app.app_context():
+        db.session.execute(db.text("DROP INDEX ix_avatars_hash"))
+        db.session.commit()
+
+    result = runner.invoke(args=["migrate-db"])
+    assert "Created index ix_avatars_hash" in result.output
+    assert "up to date" in result.output
+
+    result = runner.invoke(args=["migrate-db"])
+    assert "Created" not in result.output
+
+
+def test_migrate_db_users(app: Flask, runner: FlaskCliRunner):
+    # a database from before users had name_key and avatar_count
+    with app.app_context():
+        db.session.execute(db.text("DROP INDEX ix_users_name_key"))
+        db.session.execute(db.text("ALTER TABLE users DROP COLUMN name_key"))
+        db.session.execute(db.text("DROP INDEX ix_users_avatar_count"))
+        db.session.execute(db.text("ALTER TABLE users DROP COLUMN avatar_count"))
+        db.session.execute(db.text("UPDATE users SET name = 'TeSt' WHERE id = 1"))
+        db.session.execute(db.text("UPDATE users SET name = 'TEST2' WHERE id = 3"))
+        db.session.commit()
+
+    # two users would have the same name_key, so nothing is changed
+    result = runner.invoke(args=["migrate-db"])
+    assert result.exit_code == 1
+    assert "need to be renamed first: " in result.output
+    assert "test2, TEST2" in result.output
+    assert "TeSt" not in result.output
+    with app.app_context():
+        columns = db.session.execute(db.text("PRAGMA table_info(users)")).all()
+        assert "name_key" not in {column.name for column in columns}
+        db.session.execute(db.text("UPDATE users SET name = 'noavs' WHERE id = 3"))
+        db.session.commit()
+
+    result = runner.invoke(args=["migrate-db"])
+    assert "Added column users.name_key" in result.output
+    assert "Filled in users.name_key for 3 users" in result.output
+    assert "Created index ix_users_name_key" in result.output
+    assert "Counted everyone's avatars" in result.output
+
+    with app.app_context():
+        rows = db.session.execute(
+            db.text("SELECT name_key, avatar_count FROM users ORDER BY id")
+        )
+        assert rows.tuples().all() == [("test", 2), ("test2", 1), ("noavs", 0)]
+
+
+def test_rebuild_leaderboard(app: Flask, runner: FlaskCliRunner):
+    result = runner.invoke(args=["rebuild-leaderboard", "--verify"])
+    assert result.exit_code == 0
+    assert "All users are right." in result.output
+
+    with app.app_context():
+        db.session.execute(db.text("UPDATE users SET avatar_count = 5 WHERE id = 1"))
+        db.session.execute(db.text("DELETE FROM avatars WHERE id = 3"))
+        db.session.commit()
+
+    result = runner.invoke(args=["rebuild-leaderboard", "--verify"])
+    assert result.exit_code == 1
+    assert "test: counted 5, has 2" in result.output
+    assert "test2: counted 1, has 0" in result.output
+    assert "2 users are wrong" in result.output
+
+    result = runner.invoke(args=["rebuild-leaderboard"])
+    assert "Fixed 2 users." in result.output
+    result = runner.invoke(args=["rebuild-leaderboard", "--verify"])
+    assert result.exit_code == 0
+
+
+def test_gc_storage(app: Flask, runner: FlaskCliRunner):
+    with app.app_context():
+        # avatar 3's blob and thumbnail are no longer used
+        avatar = db.get_or_404(Avatar, 3)
+        avatar.make_thumb()
+        db.session.delete(avatar)
+        db.session.commit()
+        # nothing uses this blob
+        blobs().put("f" * 32, b"orphan")
+        # avatar 2's blob has gone missing
+        missing = db.get_or_404(Avatar, 2).hash
+        blobs().delete(missing)
+
+    result = runner.invoke(args=["gc-storage", "--dry-run", "--grace", "0"])
+    assert "Would delete 3 files (" in result.output
+    assert "1 missing" in result.output
+    assert f"Missing: {missing}" in result.output
+
+    # recently-written files are left alone
+    result = runner.invoke(args=["gc-storage"])
+    assert "Deleted 0 files" in result.output
+
+    result = runner.invoke(args=["gc-storage", "--grace", "0"])
+    assert "Deleted 3 files" in result.output
+    with app.app_context():
+        assert not blobs().exists("f" * 32)
+        assert blobs().exists("0c15b14b8e32985f39a52c0a071ae6cd")
+
+
+def test_pack_storage(app: Flask, runner: FlaskCliRunner):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    result = runner.invoke(args=["pack-storage", "--delete"])
+    assert "Packed 3 files (" in result.output
+    assert not os.path.exists(os.path.join(app.config["AVATAR_DIR"], "18", hash))
+
+    packed = create_app({**app.config, "AVATAR_STORAGE": "packs"})
+    with packed.app_context(), packed.test_client() as client:
+        response = client.get(f"/{hash}.png")
+        assert response.status_code == 200
+        assert response.headers["ETag"] == f'"{hash}"'
+        assert Image.open(io.BytesIO(response.data)).size == (246, 246)
+        data = response.data
+
+        response = client.get(f"/{hash}.png", headers={"Range": "bytes=2-4"})
+        assert response.status_code == 206
+        assert response.data == data[2:5]
+
+        # no file to hand to the proxy, so we send it ourselves
+        packed.config["AVATAR_ACCEL_REDIRECT"] = "/_avatars/"
+        response = client.get(f"/{hash}.png")
+        assert "X-Accel-Redirect" not in response.headers
+        assert response.data == data
+
+        response = client.get(f"/{hash}.png?scale=10x10")
+        assert Image.open(io.BytesIO(response.data)).size == (10, 10)
+        response = client.get(f"/thumbs/{hash}.png")
+        assert Image.open(io.BytesIO(response.data)).size == (144, 144)
+
+        # uploads go straight into a pack
+        upload = io.BytesIO()
+        Image.new("RGB", (300, 200), "purple").save(upload, "PNG")
+        client.post("/login", data={"username": "test", "password": "test"})
+        response = client.post(
+            "/upload",
+            data={"avatar_data": (io.BytesIO(upload.getvalue()), "big.png")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 302
+        db.session.commit()
+        result = packed.test_cli_runner().invoke(args=["worker", "--burst"])
+        assert "Ran 2 jobs: 2 done, 0 to retry, 0 failed." in result.output
+        new = db.get_or_404(Avatar, 4)
+        assert new.dataname is None
+        assert bytes(new.data) == upload.getvalue()
+        assert Image.open(new.thumbname).size == (144, 96)
+
+        db.session.execute(db.text("DELETE FROM avatars WHERE id=3"))
+        db.session.commit()
+    packed_runner = packed.test_cli_runner()
+    result = packed_runner.invoke(args=["backfill-thumbs", "--workers", "1"])
+    assert "Created 1 thumbnails, 0 failed." in result.output
+    result = packed_runner.invoke(args=["gc-storage", "--grace", "0"])
+    assert "Deleted 1 files" in result.output
+    result = packed_runner.invoke(args=["compact-packs"])
+    assert "Reclaimed " in result.output
+    assert "Reclaimed 0 bytes." not in result.output
+
+
+def test_cache_stats(app: Flask, runner: FlaskCliRunner):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    with app.app_context(), app.test_client() as client:
+        data = client.get(f"/{hash}.png").data
+        response = client.get(f"/{hash}.png")
+        assert response.data == data
+        assert "Last-Modified" in response.headers
+    result = runner.invoke(args=["cache-stats"])
+    assert "1 avatars cached; 1 hits, 1 misses (50% hit rate)" in result.output
+
+    disabled = create_app({**app.config, "HOT_CACHE_BYTES": 0})
+    result = disabled.test_cli_runner().invoke(args=["cache-stats"])
+    assert "disabled" in result.output
+
+
+def test_import_avatars(app: Flask, runner: FlaskCliRunner, tmp_path):
+    def image(size: tuple[int, int], colour: str) -> bytes:
+        out = io.BytesIO()
+        Image.new("RGB", size, colour).save(out, "PNG")
+        return out.getvalue()
+
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "red.png").write_bytes(image((300, 200), "red"))
+    (source / "sub" / "small.png").write_bytes(image((20, 20), "blue"))
+    (source / "notes.txt").write_text("not an image")
+    (source / "redder.png").write_bytes(image((300, 200), "red"))
+
+    # the transaction which reads what the user has already is over before
+    # the images are processed, rather than holding the write lock until
+    # the first batch is added
+    with app.app_context():
+        engine = db.engine
+    events: list[str] = []
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: events.append(statement.split()[0]),
+    )
+    event.listen(engine, "rollback", lambda conn: events.append("ROLLBACK"))
+    event.listen(engine, "commit", lambda conn: events.append("COMMIT"))
+    result = runner.invoke(
+        args=["import-avatars", "test", str(source), "--workers", "2", "--batch", "1"]
+    )
+    assert events[0:5] == ["BEGIN", "SELECT", "SELECT", "ROLLBACK", "BEGIN"]
+    assert "notes.txt: " in result.output
+    assert "4/4 files done" in result.output
+    assert "Imported 2 avatars, 1 already there, 1 failed." in result.output
+    result = runner.invoke(args=["rebuild-leaderboard", "--verify"])
+    assert result.exit_code == 0
+    with app.app_context():
+        added = db.session.execute(
+            select(Avatar).where(Avatar.filename.in_(["red.png", "small.png"]))
+        ).scalars()
+        sizes = {avatar.filename: avatar for avatar in added}
+        assert Image.open(sizes["red.png"].thumbname).size == (144, 96)
+        assert not os.path.exists(sizes["small.png"].thumbname)
+
+    # running it again, eg after being interrupted, adds nothing new
+    archive = tmp_path / "source.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.write(source / "red.png", "red.png")
+        zf.writestr("green.png", image((30, 30), "green"))
+    result = runner.invoke(args=["import-avatars", "test", str(archive)])
+    assert "Imported 1 avatars, 1 already there, 0 failed." in result.output
+
+    result = runner.invoke(args=["import-avatars", "nobody", str(archive)])
+    assert result.exit_code == 1
+    assert "No such user: nobody" in result.output
@@ -1,3 +1,6 @@
+import pytest
+from flask import g
+
 from rav2 import create_app
 
 
@@ -9,3 +12,10 @@ def test_config():
 def test_hello(client):
     response = client.get("/")
     assert response.data.startswith(b"<html>")
+
+
+def test_globals(app):
+    with app.test_request_context():
+        assert g.user is None
+        with pytest.raises(AttributeError):
+            g.nothing
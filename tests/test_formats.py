@@ -0,0 +1,86 @@
+import io
+import os
+import threading
+
+from PIL import Image
+
+from rav2.formats import FormatCache, encode
+
+
+def test_format_cache(tmp_path, caplog):
+    path = str(tmp_path / "src.png")
+    Image.new("RGB", (64, 64), "purple").save(path, "PNG")
+    size = os.path.getsize(path)
+
+    def src():
+        return open(path, "rb")
+
+    cache = FormatCache(str(tmp_path / "formats"), ["webp", "jpeg"], threads=1)
+    assert cache.formats == ["webp"]
+    # not accepted
+    assert cache.get(src, "a" * 32, size, []) is None
+    # accepted, but not encoded yet
+    assert cache.choose(src, "a" * 32, size, ["webp"]) == (None, False)
+    cache.wait()
+    assert cache.choose(src, "a" * 32, size, ["webp"])[1]
+    found = cache.get(src, "a" * 32, size, ["webp"])
+    assert found is not None
+    format, webp = found
+    assert format == "webp"
+    assert Image.open(webp).format == "WEBP"
+    assert 0 < os.path.getsize(webp) < size
+
+    # only one encoding at a time for each file, and only so many queued
+    go = threading.Event()
+    opened = []
+
+    def slow_src():
+        opened.append(1)
+        go.wait()
+        return src()
+
+    cache.max_pending = 1
+    assert cache.get(slow_src, "b" * 32, size, ["webp"]) is None
+    assert cache.get(slow_src, "b" * 32, size, ["webp"]) is None
+    assert cache.get(slow_src, "c" * 32, size, ["webp"]) is None
+    go.set()
+    cache.wait()
+    assert len(opened) == 1
+    assert cache.get(src, "b" * 32, size, ["webp"]) is not None
+    assert not os.path.exists(cache.path("c" * 32, "webp"))
+
+    # things we can't encode are left as they are, and not tried again
+    assert cache.get(lambda: io.BytesIO(b"junk"), "d" * 32, 4, ["webp"]) is None
+    cache.wait()
+    assert "Can't encode" in caplog.text
+    assert os.path.getsize(cache.path("d" * 32, "webp")) == 0
+    assert cache.get(src, "d" * 32, size, ["webp"]) is None
+
+
+def test_encode(tmp_path):
+    png = io.BytesIO()
+    Image.effect_noise((64, 64), 40).convert("RGB").save(png, "PNG")
+    dst = str(tmp_path / "x" / "out")
+
+    for format in ["webp", "avif"]:
+        png.seek(0)
+        assert encode(png, dst, format, len(png.getvalue())) > 0
+        assert Image.open(dst).format == format.upper()
+
+    # no smaller than the original
+    png.seek(0)
+    assert encode(png, dst, "webp", 10) == 0
+    assert os.path.getsize(dst) == 0
+
+    # animations would lose their frames
+    gif = io.BytesIO()
+    frames = [Image.new("RGB", (8, 8), colour) for colour in ["red", "blue"]]
+    frames[0].save(gif, "GIF", save_all=True, append_images=frames[1:])
+    gif.seek(0)
+    assert encode(gif, dst, "webp", 1_000_000) == 0
+
+    # lossy for photos
+    jpeg = io.BytesIO()
+    Image.new("RGB", (64, 64), "purple").save(jpeg, "JPEG")
+    jpeg.seek(0)
+    assert encode(jpeg, dst, "webp", 1_000_000) > 0
@@ -0,0 +1,23 @@
+from rav2.fragments import FragmentCache
+
+
+def test_fragment_cache():
+    renders = []
+
+    def render(html):
+        def f():
+            renders.append(html)
+            return html
+
+        return f
+
+    cache = FragmentCache(max_bytes=8)
+    assert cache.get("a", 1, render("aaaa")) == "aaaa"
+    assert cache.get("a", 1, render("xxxx")) == "aaaa"
+    assert cache.get("a", 2, render("AAAA")) == "AAAA"
+    assert renders == ["aaaa", "AAAA"]
+
+    # a1 is least recently used, so gets evicted
+    cache.get("b", 1, render("bbbb"))
+    assert cache.get("a", 1, render("aaaa")) == "aaaa"
+    assert renders == ["aaaa", "AAAA", "bbbb", "aaaa"]
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+
+from rav2.hotcache import HotCache, HotStats
+
+
+def key(n: int) -> str:
+    return f"{n:032x}"
+
+
+def test_hot_cache(tmp_path):
+    path = str(tmp_path / "hot")
+    cache = HotCache(path, max_bytes=4096)
+    assert cache.get(key(1)) is None
+    assert cache.put(key(1), b"hello", 123.0)
+    assert not cache.put(key(1), b"hello")
+    assert not cache.put(key(2), b"x" * 1000)
+    assert cache.get(key(1)) == (b"hello", 123.0)
+
+    # other workers share the same memory
+    other = HotCache(path, max_bytes=4096)
+    assert other.get(key(1)) == (b"hello", 123.0)
+    assert other.stats() == HotStats(evictions=0, items=1)
+
+    # lookups don't wait for each other
+    reading = threading.Event()
+    done = threading.Event()
+
+    def read_slowly():
+        with other._lock.shared():
+            reading.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=read_slowly)
+    thread.start()
+    try:
+        reading.wait(5)
+        assert cache.get(key(1)) == (b"hello", 123.0)
+    finally:
+        done.set()
+        thread.join()
+
+    # changing the size starts again, without disturbing anyone using the old one
+    bigger = HotCache(path, max_bytes=8192)
+    assert bigger.get(key(1)) is None
+    assert cache.get(key(1)) == (b"hello", 123.0)
+
+
+def test_hot_cache_eviction(tmp_path):
+    cache = HotCache(str(tmp_path / "hot"), max_bytes=4096)
+    # 144 byte records, so 28 fit
+    for n in range(28):
+        assert cache.put(key(n), bytes([n]) * 104)
+    assert cache.stats().evictions == 0
+
+    # the oldest goes first, unless it has been read recently
+    assert cache.get(key(0))
+    cache.put(key(100), b"a" * 104)
+    assert cache.get(key(0)) == (b"\x00" * 104, 0)
+    assert cache.get(key(1)) is None
+    assert cache.stats().evictions == 1
+
+    # a bigger record needs several small ones evicted, and the kept
+    # ones are moved out of its way
+    assert cache.get(key(3))
+    cache.put(key(101), b"b" * 250)
+    assert cache.get(key(2)) is None
+    assert cache.get(key(3)) == (b"\x03" * 104, 0)
+    assert cache.get(key(4)) is None
+    assert cache.get(key(101)) == (b"b" * 250, 0)
+
+    # going round many times, with a few favourites
+    for n in range(1000, 1500):
+        cache.get(key(10))
+        cache.put(key(n), b"c" * (n % 200))
+    assert cache.get(key(10)) == (b"\n" * 104, 0)
+    assert cache.get(key(1499)) == (b"c" * (1499 % 200), 0)
+    assert cache.stats().items < 64
+
+
+def test_hot_cache_full_table(tmp_path):
+    # lots of tiny records fill the hash table before the ring, so older
+    # ones are evicted to make room in it (and its tombstones cleared out)
+    cache = HotCache(str(tmp_path / "hot"), max_bytes=4096)
+    keys = [hashlib.md5(bytes([n % 256, n // 256])).hexdigest() for n in range(1000)]
+    assert all(cache.put(k, b"") for k in keys)
+    stats = cache.stats()
+    assert stats.items == 39
+    assert stats.evictions == 961
+    assert all(cache.get(k) for k in keys[961:])
+    assert not any(cache.get(k) for k in keys[:961])
+
+
+def test_hot_cache_new_working_set(tmp_path):
+    # small avatars, filling the table with most of the ring unused
+    cache = HotCache(str(tmp_path / "hot"), max_bytes=1024 * 1024)
+    for n in range(1000):
+        cache.put(key(n), b"x" * 1500)
+        cache.get(key(n))
+
+    # then different ones get popular
+    hits = 0
+    for _ in range(3):
+        for n in range(2000, 2200):
+            if cache.get(key(n)) is None:
+                cache.put(key(n), b"y" * 1500)
+            else:
+                hits += 1
+    assert hits == 400
+    assert cache.stats().evictions >= 200
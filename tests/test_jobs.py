@@ -0,0 +1,87 @@
+import logging
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskCliRunner
+
+from rav2 import create_app, jobs
+from rav2.models import Job, db
+
+
+@pytest.fixture
+def failing(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    calls = []
+
+    def fail(message: str) -> None:
+        calls.append(message)
+        raise ValueError(message)
+
+    monkeypatch.setitem(jobs.HANDLERS, "fail", fail)
+    return calls
+
+
+def test_retries(app: Flask, runner: FlaskCliRunner, failing: list[str], caplog):
+    app.config["JOB_ATTEMPTS"] = 3
+    with app.app_context():
+        jobs.enqueue("fail", "Doomed", 1, message="nope")
+        db.session.commit()
+
+        assert jobs.run_one() == "retry"
+        job = db.session.scalars(db.select(Job)).one()
+        assert job.state == "will retry (tried 1 times)"
+        assert job.error == "ValueError: nope"
+        # not due again until 30s later, then 60s after that
+        assert job.run_after is not None
+        assert job.run_after > jobs.now() + timedelta(seconds=25)
+        assert jobs.run_one() is None
+        job.run_after = jobs.now()
+        db.session.commit()
+
+    app.config["JOB_RETRY_SECONDS"] = 0
+    with caplog.at_level(logging.WARNING):
+        result = runner.invoke(args=["worker", "--burst", "--threads", "1"])
+    assert "Ran 2 jobs: 0 done, 1 to retry, 1 failed." in result.output
+    assert "(Doomed) failed for good: ValueError: nope" in caplog.text
+    assert failing == ["nope"] * 3
+
+    with app.app_context():
+        job = db.session.scalars(db.select(Job)).one()
+        assert (job.state, job.attempts, job.run_after) == ("failed", 3, None)
+
+    client = app.test_client()
+    client.post("/login", data={"username": "test", "password": "test"})
+    assert b"<td>failed: ValueError: nope</td>" in client.get("/user").data
+
+
+def test_abandoned(app: Flask):
+    # a job whose worker died part-way through is picked up again once
+    # its lease runs out
+    with app.app_context():
+        job = jobs.enqueue("thumb", "Thumbnail", None, avatar_id=1)
+        job.status, job.run_after = "running", datetime(2000, 1, 1)
+        db.session.commit()
+        assert jobs.claim() == (job.id, "thumb", {"avatar_id": 1})
+        assert jobs.claim() is None
+
+
+def test_deleted_avatar(app: Flask):
+    with app.app_context():
+        jobs.enqueue("thumb", "Thumbnail", None, avatar_id=99)
+        jobs.enqueue("formats", "Compact copies", None, avatar_id=99)
+        db.session.commit()
+        assert jobs.run_one() == "done"
+        assert jobs.run_one() == "done"
+        assert jobs.run_one() is None
+
+
+def test_worker_locked_out(app: Flask, caplog):
+    impatient = create_app({**app.config, "SQLITE_PRAGMAS": {"busy_timeout": 10}})
+    with app.app_context():
+        # another worker is in the middle of writing
+        db.session.execute(db.text("UPDATE users SET message='' WHERE id=1"))
+        with caplog.at_level(logging.WARNING):
+            result = impatient.test_cli_runner().invoke(args=["worker", "--burst"])
+        db.session.rollback()
+    assert "Ran 0 jobs" in result.output
+    assert "Worker can't run jobs: database is locked" in caplog.text
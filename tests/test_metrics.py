@@ -0,0 +1,119 @@
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+
+from rav2 import create_app
+from rav2.metrics import Metrics
+
+
+def test_metrics_workers(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    metrics = Metrics(str(tmp_path))
+    assert metrics.collect() == "\n"
+    metrics.inc("rav2_requests_total", route="index", status="200")
+    metrics.inc("rav2_requests_total", route="index", status="200")
+    metrics.observe("rav2_request_duration_seconds", 0.003, route="index")
+
+    # after a fork, the child carries on in a file of its own
+    pid = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: pid + 1)
+    metrics.inc("rav2_requests_total", route="index", status="200")
+    metrics.observe("rav2_request_duration_seconds", 20, route="index")
+    files = sorted(os.listdir(tmp_path))
+    assert files == [f"{pid}.metrics", f"{pid + 1}.metrics", "exited.lock"]
+
+    # a new worker which gets the same pid as an old one starts from the
+    # old one's numbers (and enough new series to need a bigger file)
+    for n in range(500):
+        Metrics(str(tmp_path)).inc("rav2_requests_total", route=f"r{n}", status="200")
+
+    (tmp_path / "junk.metrics").write_bytes(b"junk")
+    text = Metrics(str(tmp_path)).collect(
+        [("rav2_hot_cache_items", {}, 3), ("rav2_requests_total", {"x": "y"}, 0.5)]
+    )
+    assert "# TYPE rav2_requests_total counter" in text
+    assert 'rav2_requests_total{route="index",status="200"} 3\n' in text
+    assert 'rav2_requests_total{route="r499",status="200"} 1\n' in text
+    assert 'rav2_requests_total{x="y"} 0.5\n' in text
+    assert "rav2_hot_cache_items 3\n" in text
+    assert "# TYPE rav2_request_duration_seconds histogram" in text
+    bucket = 'rav2_request_duration_seconds_bucket{route="index",le="%s"} %d\n'
+    assert bucket % ("0.0025", 0) in text
+    assert bucket % ("0.005", 1) in text
+    assert bucket % ("10", 1) in text
+    assert bucket % ("+Inf", 2) in text
+    assert 'rav2_request_duration_seconds_sum{route="index"} 20.003\n' in text
+    assert 'rav2_request_duration_seconds_count{route="index"} 2\n' in text
+
+    # disabled
+    metrics = Metrics(None)
+    metrics.inc("rav2_requests_total")
+    assert metrics.collect() == "\n"
+
+
+def test_metrics_exited_workers(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    # a pid which is free, as its process has exited
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+
+    pid = os.getpid()
+    for n in range(2):
+        monkeypatch.setattr(os, "getpid", lambda: dead.pid)
+        Metrics(str(tmp_path)).inc("rav2_requests_total", route="index")
+        monkeypatch.setattr(os, "getpid", lambda: pid)
+
+        # the next worker to start folds the exited one's file into the
+        # others which have exited
+        metrics = Metrics(str(tmp_path))
+        metrics.inc("rav2_requests_total", route="index")
+        files = sorted(os.listdir(tmp_path))
+        assert files == [f"{pid}.metrics", "exited.lock", "exited.metrics"]
+        text = metrics.collect()
+        assert f'rav2_requests_total{{route="index"}} {n + 2}\n' in text
+        (tmp_path / f"{pid}.metrics").unlink()
+
+
+def test_metrics_page(app: Flask, client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    data = client.get(f"/{hash}.png").data
+    client.get(f"/{hash}.png?scale=10x10")
+    client.get(f"/{hash}.png?scale=10x10", headers={"If-None-Match": "nope"})
+    client.get("/gallery")
+    client.get("/gallery")
+    client.get("/nope.html")
+
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'rav2_requests_total{route="avatar",status="200"} 3\n' in text
+    assert 'rav2_requests_total{route="user_gallery",status="404"} 1\n' in text
+    assert 'rav2_request_duration_seconds_count{route="gallery"} 2\n' in text
+    assert 'rav2_sql_statements_total{route="gallery"} ' in text
+    assert "rav2_sql_statements_per_request_bucket{le=" in text
+    assert "rav2_storage_reads_total 1\n" in text
+    assert f"rav2_storage_read_bytes_total {len(data)}\n" in text
+    assert 'rav2_cache_lookups_total{cache="fragments"} 2\n' in text
+    assert 'rav2_cache_misses_total{cache="fragments"} 1\n' in text
+    assert 'rav2_cache_lookups_total{cache="variants"} 2\n' in text
+    assert 'rav2_cache_misses_total{cache="variants"} 1\n' in text
+    assert 'rav2_cache_lookups_total{cache="hot"} 1\n' in text
+    assert "rav2_hot_cache_items 1\n" in text
+
+    disabled = create_app({**app.config, "METRICS_DIR": None, "HOT_CACHE_BYTES": 0})
+    with disabled.app_context(), disabled.test_client() as other:
+        assert other.get("/metrics").status_code == 404
+
+
+def test_slow_request_log(app: Flask, client: FlaskClient, caplog):
+    client.get("/gallery")
+    assert "Slow request" not in caplog.text
+
+    app.config["SLOW_REQUEST_SECONDS"] = 0
+    with caplog.at_level(logging.WARNING):
+        client.get("/gallery?x=1")
+    assert "Slow request: GET /gallery?x=1 took " in caplog.text
+    assert "ms SELECT " in caplog.text
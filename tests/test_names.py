@@ -0,0 +1,30 @@
+from rav2.names import NameCache
+
+
+def test_name_cache():
+    loads = []
+
+    def load(user_id):
+        def f():
+            loads.append(user_id)
+            return user_id
+
+        return f
+
+    cache = NameCache(max_items=2, ttl=60)
+    assert cache.get("a", load(1)) == 1
+    assert cache.get("a", load(2)) == 1
+    assert cache.get("nobody", load(None)) is None
+    assert cache.get("nobody", load(3)) is None
+    assert loads == [1, None]
+
+    cache.forget("nobody")
+    assert cache.get("nobody", load(3)) == 3
+
+    # "a" is least recently used, so gets evicted
+    cache.get("b", load(4))
+    assert cache.get("a", load(1)) == 1
+    assert loads == [1, None, 3, 4, 1]
+
+    cache.ttl = -1
+    assert cache.get("a", load(5)) == 5
@@ -1,6 +1,11 @@
+import io
+import os
+
+import pytest
+from flask import Flask
 from flask.testing import FlaskClient
-from rav2.models import Avatar
-from unittest.mock import patch
+from PIL import Image
+from rav2.models import Counter, db
 
 
 def test_favicon(client: FlaskClient):
@@ -31,22 +36,374 @@ def test_user_gallery(client: FlaskClient):
     assert response.status_code == 404
 
 
+@pytest.mark.parametrize("url", ("/TeSt.png", "/TeSt.html", "/api/TeSt/avatars"))
+def test_username_case(client: FlaskClient, url: str):
+    response = client.get(url)
+    assert response.status_code == 200
+
+
+def test_user_gallery_pages(app: Flask, client: FlaskClient):
+    app.config["AVATARS_PER_PAGE"] = 1
+    data = client.get("/test.html").get_data(as_text=True)
+    assert "ina_assembler.png" in data
+    assert "klk-1.png" not in data
+    assert '<a href="?before=2">Older</a>' in data
+    assert "Newest" not in data
+
+    data = client.get("/test.html?before=2").get_data(as_text=True)
+    assert "klk-1.png" in data
+    assert "ina_assembler.png" not in data
+    assert '<a href="?">Newest</a>' in data
+    assert "Older" not in data
+
+
+def test_avatar_page_query_plan(client: FlaskClient):
+    # a page deep into a big gallery shouldn't cost any more than the first
+    plan = db.session.execute(
+        db.text(
+            "EXPLAIN QUERY PLAN SELECT * FROM avatars"
+            " WHERE owner_id = 1 AND id < 1000 ORDER BY id DESC LIMIT 101"
+        )
+    ).all()
+    detail = " ".join(row[-1] for row in plan)
+    assert "USING INDEX ix_avatars_owner_id (owner_id=? AND rowid<?)" in detail
+    assert "TEMP B-TREE" not in detail
+
+
+def test_gallery_top_users(client: FlaskClient):
+    data = client.get("/gallery").get_data(as_text=True)
+    assert "<td><a href='test.html'>test</a></td><td>2</td>" in data
+    assert "<td><a href='test2.html'>test2</a></td><td>1</td>" in data
+    assert "noavs" not in data
+
+    # read from the index, without counting anything
+    plan = db.session.execute(
+        db.text(
+            "EXPLAIN QUERY PLAN SELECT name, avatar_count FROM users"
+            " WHERE avatar_count > 0 ORDER BY avatar_count DESC LIMIT 35"
+        )
+    ).all()
+    detail = " ".join(row[-1] for row in plan)
+    assert "USING COVERING INDEX ix_users_avatar_count" in detail
+    assert "TEMP B-TREE" not in detail
+
+
+def test_api_avatars(app: Flask, client: FlaskClient):
+    response = client.get("/api/test/avatars")
+    assert response.status_code == 200
+    assert response.json == {
+        "avatars": [
+            {
+                "id": 1,
+                "hash": "0c15b14b8e32985f39a52c0a071ae6cd",
+                "filename": "klk-1.png",
+                "width": 249,
+                "height": 249,
+                "filesize": 63273,
+                "mime": "PNG",
+                "enabled": True,
+                "link": "/0c15b14b8e32985f39a52c0a071ae6cd.png",
+                "thumb_link": "/thumbs/0c15b14b8e32985f39a52c0a071ae6cd.png",
+            },
+            {
+                "id": 2,
+                "hash": "1873689aae9bd74e55dec440e10bc01c",
+                "filename": "ina_assembler.png",
+                "width": 246,
+                "height": 246,
+                "filesize": 114067,
+                "mime": "PNG",
+                "enabled": True,
+                "link": "/1873689aae9bd74e55dec440e10bc01c.png",
+                "thumb_link": "/thumbs/1873689aae9bd74e55dec440e10bc01c.png",
+            },
+        ],
+        "next": None,
+    }
+
+    def ids(url: str) -> tuple[list[int], str | None]:
+        page = client.get(url).json
+        assert page is not None
+        return [avatar["id"] for avatar in page["avatars"]], page["next"]
+
+    assert ids("/api/test/avatars?limit=1") == ([1], "/api/test/avatars?after=1")
+    assert ids("/api/test/avatars?after=1") == ([2], None)
+    response = client.get("/api/test/avatars?limit=1")
+    assert response.headers["Link"] == '</api/test/avatars?after=1>; rel="next"'
+
+    app.config["AVATARS_PER_PAGE"] = 1
+    assert ids("/api/test/avatars?limit=1000") == ([1], "/api/test/avatars?after=1")
+
+    response = client.get("/api/test/avatars")
+    etag = response.headers["ETag"]
+    response = client.get("/api/test/avatars", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = client.get("/api/nobody/avatars")
+    assert response.status_code == 404
+
+
 def test_avatar(client: FlaskClient):
-    with patch.object(Avatar, "data", "test"):
+    response = client.get("/test.png")
+    assert response.status_code == 200
+    assert response.data.startswith(b"\x89PNG")
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    response = client.get("/nobody.png")
+    assert response.status_code == 404
+
+    response = client.get("/1873689aae9bd74e55dec440e10bc01c.png")
+    assert response.status_code == 200
+
+    response = client.get("/xxx3689aae9bd74e55dec440e10bcxxx.png")
+    assert response.status_code == 404
+
+    response = client.get("/1873689aae9bd74e55dec440e10bc01c/blah.png")
+    assert response.status_code == 200
+
+    response = client.get("/xxx3689aae9bd74e55dec440e10bcxxx/blah.png")
+    assert response.status_code == 404
+
+
+def test_avatar_random(client: FlaskClient):
+    response = client.get("/noavs.png")
+    assert response.status_code == 404
+
+    response = client.get("/test.png")
+    assert response.status_code == 200
+
+    # disabled behind the cached pool's back, eg by another worker
+    db.session.execute(db.text("UPDATE avatars SET enabled=0 WHERE id=1"))
+    db.session.commit()
+    for _ in range(10):
         response = client.get("/test.png")
         assert response.status_code == 200
 
-        response = client.get("/nobody.png")
-        assert response.status_code == 404
+    db.session.execute(db.text("UPDATE avatars SET enabled=0"))
+    db.session.commit()
+    response = client.get("/test.png")
+    assert response.status_code == 404
 
-        response = client.get("/1873689aae9bd74e55dec440e10bc01c.png")
-        assert response.status_code == 200
 
-        response = client.get("/xxx3689aae9bd74e55dec440e10bcxxx.png")
-        assert response.status_code == 404
+def test_avatar_caching(client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    response = client.get(f"/{hash}.png")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{hash}"'
+    assert "immutable" in response.headers["Cache-Control"]
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "Last-Modified" in response.headers
+    data = response.data
 
-        response = client.get("/1873689aae9bd74e55dec440e10bc01c/blah.png")
-        assert response.status_code == 200
+    response = client.get(f"/{hash}.png", headers={"If-None-Match": f'"{hash}"'})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == f'"{hash}"'
+    assert response.data == b""
+
+    response = client.get(f"/{hash}.png", headers={"Range": "bytes=2-4"})
+    assert response.status_code == 206
+    assert response.data == data[2:5]
+    assert response.headers["Content-Range"] == f"bytes 2-4/{len(data)}"
+
+
+def test_avatar_formats(app: Flask, client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    png = client.get(f"/{hash}.png").data
+    webp = {"Accept": "image/webp,image/*"}
+
+    # the first request queues the encoding, and gets the original - but
+    # only to keep for a short while, as the WebP copy will be better
+    response = client.get(f"/{hash}.png", headers=webp)
+    assert response.mimetype == "image/png"
+    assert response.headers["Vary"] == "Accept"
+    assert response.headers["Cache-Control"] == "public, max-age=60"
+    app.extensions["rav2.formats"].wait()
 
-        response = client.get("/xxx3689aae9bd74e55dec440e10bcxxx/blah.png")
-        assert response.status_code == 404
+    # and when it asks again, it gets the better one
+    response = client.get(
+        f"/{hash}.png", headers={**webp, "If-None-Match": f'"{hash}"'}
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+
+    response = client.get(f"/{hash}.png", headers=webp)
+    assert response.mimetype == "image/webp"
+    assert response.headers["ETag"] == f'"{hash}-webp"'
+    assert response.headers["Vary"] == "Accept"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert Image.open(io.BytesIO(response.data)).format == "WEBP"
+    assert len(response.data) < len(png)
+
+    response = client.get(
+        f"/{hash}.png", headers={**webp, "If-None-Match": f'"{hash}-webp"'}
+    )
+    assert response.status_code == 304
+    assert response.headers["Vary"] == "Accept"
+
+    # wildcards don't count as asking for a format
+    response = client.get(f"/{hash}.png", headers={"Accept": "*/*"})
+    assert response.mimetype == "image/png"
+
+    # the smallest of the formats they accept
+    both = {"Accept": "image/avif,image/webp"}
+    response = client.get(f"/{hash}.png", headers=both)
+    assert response.mimetype == "image/webp"
+    app.extensions["rav2.formats"].wait()
+    formats = os.path.join(app.config["AVATAR_FORMAT_DIR"], hash[0:2], hash)
+    assert 0 < os.path.getsize(f"{formats}.avif")
+    # (PNG and WebP are both good at a flat purple square, AVIF isn't)
+    assert client.get(f"/{hash}.png", headers=both).mimetype == "image/webp"
+    os.truncate(f"{formats}.webp", 0)
+    assert client.get(f"/{hash}.png", headers=both).mimetype == "image/avif"
+
+    # scaled copies are left alone
+    response = client.get(f"/{hash}.png?scale=10x10", headers=webp)
+    assert response.mimetype == "image/png"
+    assert "Vary" not in response.headers
+
+
+def test_avatar_offload(app: Flask, client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    app.config["AVATAR_ACCEL_REDIRECT"] = "/_avatars/"
+    response = client.get(f"/{hash}.png")
+    assert response.status_code == 200
+    assert response.headers["X-Accel-Redirect"] == f"/_avatars/18/{hash}"
+    assert response.data == b""
+
+    app.config["AVATAR_ACCEL_REDIRECT"] = None
+    app.config["USE_X_SENDFILE"] = True
+    response = client.get(f"/{hash}.png")
+    assert response.headers["X-Sendfile"].endswith(f"/18/{hash}")
+    assert response.data == b""
+
+
+def test_avatar_scale(client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    response = client.get(f"/{hash}.png?scale=100x50")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{hash}-100x50"'
+    assert Image.open(io.BytesIO(response.data)).size == (50, 50)
+
+    response = client.get(
+        f"/{hash}.png?scale=100x50", headers={"If-None-Match": f'"{hash}-100x50"'}
+    )
+    assert response.status_code == 304
+
+    # no upscaling
+    response = client.get(f"/{hash}.png?scale=500x500")
+    assert Image.open(io.BytesIO(response.data)).size == (246, 246)
+
+    response = client.get("/test.png?scale=10x10")
+    assert Image.open(io.BytesIO(response.data)).size == (10, 10)
+
+    for scale in ["big", "10", "0x10", "10x99999"]:
+        response = client.get(f"/{hash}.png?scale={scale}")
+        assert response.status_code == 400
+
+
+def test_thumb(client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    response = client.get("/gallery")
+    assert f"/thumbs/{hash}.png".encode() in response.data
+
+    response = client.get(f"/thumbs/{hash}.png")
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+    assert Image.open(io.BytesIO(response.data)).size == (144, 144)
+
+    response = client.get(f"/thumbs/{hash}.png", headers={"If-None-Match": hash})
+    assert response.status_code == 304
+
+    response = client.get("/thumbs/xxx3689aae9bd74e55dec440e10bcxxx.png")
+    assert response.status_code == 404
+
+
+def test_thumb_small(client: FlaskClient):
+    hash = "1873689aae9bd74e55dec440e10bc01c"
+    db.session.execute(db.text("UPDATE avatars SET width=100, height=100"))
+    db.session.commit()
+    response = client.get("/test.html")
+    assert f'src="/{hash}.png"'.encode() in response.data
+
+    response = client.get(f"/thumbs/{hash}.png")
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).size == (246, 246)
+
+
+def test_user_gallery_stats(client: FlaskClient):
+    db.session.execute(db.text("UPDATE avatars SET enabled=0 WHERE id=1"))
+    db.session.execute(
+        db.text(
+            "INSERT INTO avatars SELECT 4,1,hash,'a.png',246,246,1,'PNG',1 FROM avatars WHERE id=2"
+        )
+    )
+    db.session.commit()
+    response = client.get("/test.html")
+    assert b"User has 2 active avatars" in response.data
+    assert b"(3 total)" in response.data
+    assert b"mostly sized 246x246" in response.data
+
+    response = client.get("/noavs.html")
+    assert b"User has 0 active avatars" in response.data
+    assert b"mostly sized 0x0" in response.data
+
+
+@pytest.mark.parametrize(
+    ("url", "count"),
+    (
+        ("/favicon.ico", 0),
+        ("/manual", 0),
+        ("/", 1),
+        ("/gallery", 2),
+        ("/test.html", 2),
+        ("/test.png", 1),
+        ("/1873689aae9bd74e55dec440e10bc01c.png", 1),
+        ("/thumbs/1873689aae9bd74e55dec440e10bc01c.png", 1),
+    ),
+)
+def test_query_count(client: FlaskClient, queries: list[str], url: str, count: int):
+    # warm up the caches, but not the ORM session, which would normally
+    # be thrown away at the end of each request
+    client.get(url)
+    db.session.remove()
+    queries.clear()
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert len(queries) == count, "\n".join(queries)
+
+
+@pytest.mark.parametrize(
+    ("url", "counter", "count"),
+    (
+        ("/gallery", "gallery", 4),
+        ("/test.html", "user:1", 6),
+    ),
+)
+def test_query_count_cold(
+    client: FlaskClient, queries: list[str], url: str, counter: str, count: int
+):
+    # the same, with the rendered page out of date
+    client.get(url)
+    Counter.bump(counter)
+    db.session.commit()
+    db.session.remove()
+    queries.clear()
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert len(queries) == count, "\n".join(queries)
+
+
+@pytest.mark.parametrize(
+    "url",
+    (
+        "/favicon.ico",
+        "/1873689aae9bd74e55dec440e10bc01c.png",
+        "/thumbs/1873689aae9bd74e55dec440e10bc01c.png",
+    ),
+)
+def test_no_user_lookup(user_client: FlaskClient, queries: list[str], url: str):
+    response = user_client.get(url)
+    assert response.status_code == 200
+    assert not [q for q in queries if "FROM users" in q]
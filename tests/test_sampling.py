@@ -0,0 +1,62 @@
+import threading
+
+from rav2.sampling import IdPool, PoolCache
+
+
+def test_pool():
+    pool = IdPool([1, 2, 3])
+    assert len(pool) == 3
+    assert pool.choice() in (1, 2, 3)
+
+    pool.add(3)
+    assert len(pool) == 3
+
+    pool.remove(1)
+    pool.remove(1)
+    assert 1 not in pool
+    assert 2 in pool and 3 in pool
+
+    assert sorted(pool.sample(5)) == [2, 3]
+    assert len(pool.sample(1)) == 1
+
+    pool.remove(3)
+    pool.remove(2)
+    assert len(pool) == 0
+    assert pool.choice() is None
+    assert pool.sample(5) == []
+
+
+def test_pool_lock():
+    # the workers' threads share pools, so changes wait for each other
+    pool = IdPool([1, 2, 3])
+    with pool._lock:
+        thread = threading.Thread(target=pool.add, args=(4,))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        assert 4 not in pool
+    thread.join()
+    assert 4 in pool
+
+
+def test_pool_cache():
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [1, 2]
+
+    cache: PoolCache[int] = PoolCache(ttl=60)
+    assert cache.peek(1) is None
+    assert len(cache.get(1, load)) == 2
+    assert cache.peek(1) is not None
+    assert len(cache.get(1, load)) == 2
+    assert len(loads) == 1
+
+    cache.invalidate(1)
+    cache.get(1, load)
+    assert len(loads) == 2
+
+    cache.ttl = -1
+    cache.get(1, load)
+    assert len(loads) == 3
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+from flask import Flask, g
+from flask.testing import FlaskClient
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from rav2 import create_app
+from rav2.models import db
+from rav2.sqlite import READ_ONLY
+
+
+def test_pragmas(app: Flask):
+    with app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "wal"
+        assert db.session.execute(db.text("PRAGMA synchronous")).scalar() == 1
+        assert db.session.execute(db.text("PRAGMA busy_timeout")).scalar() == 5000
+
+
+def test_read_only(app: Flask, client: FlaskClient):
+    with app.app_context():
+        engines = dict(db.engines)
+    used: list[tuple[str | None, str]] = []
+    for key, engine in engines.items():
+        event.listen(
+            engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args, key=key: used.append(
+                (key, statement)
+            ),
+        )
+
+    client.get("/test.png")
+    client.get("/test.html")
+    assert used
+    assert {key for key, _ in used} == {READ_ONLY}
+
+    client.post("/login", data={"username": "test", "password": "test"})
+    client.get("/user")
+    assert {key for key, _ in used} == {READ_ONLY}
+
+    used.clear()
+    client.get("/toggle?avatar_id=1")
+    assert {key for key, _ in used} == {None}
+    assert used[0][1] == "BEGIN IMMEDIATE"
+
+    with (
+        pytest.raises(OperationalError, match="readonly"),
+        engines[READ_ONLY].begin() as conn,
+    ):
+        conn.execute(db.text("DELETE FROM avatars"))
+
+
+def test_database_busy(app: Flask):
+    impatient = create_app({**app.config, "SQLITE_PRAGMAS": {"busy_timeout": 10}})
+    path = app.config["SQLALCHEMY_DATABASE_URI"].removeprefix("sqlite:///")
+    other_worker = sqlite3.connect(path, isolation_level=None)
+    other_worker.execute("BEGIN IMMEDIATE")
+    try:
+        with impatient.app_context(), impatient.test_client() as client:
+            # readers aren't held up
+            assert client.get("/test.html").status_code == 200
+            response = client.post(
+                "/login", data={"username": "test", "password": "test"}
+            )
+            assert response.status_code == 302
+            # writers give up after busy_timeout
+            response = client.post("/settings", data={"message": "", "email": ""})
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+    finally:
+        other_worker.execute("ROLLBACK")
+        other_worker.close()
+
+
+def test_other_errors(app: Flask, client: FlaskClient):
+    db.session.execute(db.text("DROP TABLE counters"))
+    db.session.commit()
+    with pytest.raises(OperationalError, match="no such table"):
+        client.get("/test.html")
+
+
+def test_memory_database():
+    app = create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    with app.app_context():
+        assert READ_ONLY not in db.engines
+        used: list[str] = []
+        event.listen(
+            db.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: used.append(statement),
+        )
+        # read-only views' queries come here, but don't need the write lock
+        g.read_only = True
+        db.session.execute(db.text("SELECT 1"))
+        db.session.rollback()
+        g.read_only = False
+        db.session.execute(db.text("SELECT 1"))
+        assert used == ["BEGIN", "SELECT 1", "BEGIN IMMEDIATE", "SELECT 1"]
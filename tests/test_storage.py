@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from rav2.storage import BlobStore, PackStore, collect_garbage
+
+
+def test_blob_store(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    assert list(store.files()) == []
+
+    assert store.put("a" * 32, b"hello")
+    assert not store.put("a" * 32, b"hello")
+    assert store.exists("a" * 32)
+    assert store.read("a" * 32) == b"hello"
+    assert [e.name for e in store.files()] == ["a" * 32]
+
+    store.delete("a" * 32)
+    store.delete("a" * 32)
+    assert not store.exists("a" * 32)
+
+
+def test_pack_store(tmp_path):
+    store = PackStore(str(tmp_path / "blobs"), capacity=4)
+    assert list(store.entries()) == []
+
+    assert store.put("a" * 32, b"hello")
+    assert not store.put("a" * 32, b"hello")
+    assert store.exists("a" * 32)
+    assert bytes(store.read("a" * 32)) == b"hello"
+    assert store.open("a" * 32).read() == b"hello"
+    assert store.local_path("a" * 32) is None
+    with pytest.raises(FileNotFoundError):
+        store.read("b" * 32)
+
+    # another worker sees our writes, even after the index has grown
+    other = PackStore(str(tmp_path / "blobs"))
+    for c in "bcdef":
+        store.put(c * 32, c.encode() * 10)
+    assert store._capacity == 16
+    assert bytes(other.read("f" * 32)) == b"f" * 10
+    assert other._capacity == 16
+
+    # and tombstones
+    other.delete("b" * 32)
+    other.delete("b" * 32)
+    assert not store.exists("b" * 32)
+    assert sorted(h for h, _, _ in store.entries()) == [c * 32 for c in "acdef"]
+    assert store.put("b" * 32, b"again")
+
+    # compacting drops the dead copy of "b" and keeps everything else
+    store.delete("a" * 32)
+    assert store.compact() == len(b"hello") + 10
+    assert bytes(other.read("b" * 32)) == b"again"
+    assert bytes(store.read("f" * 32)) == b"f" * 10
+    assert not other.exists("a" * 32)
+
+
+def test_pack_store_rollover(tmp_path):
+    store = PackStore(str(tmp_path / "blobs"))
+    store.pack_size = 8
+    store.put("a" * 32, b"0123456789")
+    store.put("b" * 32, b"abc")
+    assert sorted(os.listdir(store.dir)) == [
+        "index.dat",
+        "lock",
+        "pack-000000.dat",
+        "pack-000001.dat",
+    ]
+    assert bytes(store.read("a" * 32)) == b"0123456789"
+    assert bytes(store.read("b" * 32)) == b"abc"
+
+
+@pytest.mark.parametrize("packs", (False, True))
+def test_gc_during_upload(tmp_path, monkeypatch: pytest.MonkeyPatch, packs: bool):
+    root = str(tmp_path / "blobs")
+    store = PackStore(root) if packs else BlobStore(root)
+    # three blobs which no avatar uses, written long ago
+    with monkeypatch.context() as m:
+        m.setattr("rav2.storage.time.time", lambda: 1000.0)
+        for hash in ("a" * 32, "b" * 32, "c" * 32):
+            store.put(hash, hash.encode())
+            if not packs:
+                os.utime(store.path(hash), (1000, 1000))
+
+    rows = set()
+    scan = store.entries
+
+    def entries():
+        yield from scan()
+        # after gc has decided what to delete, someone uploads "a" again,
+        # and an avatar using "b" turns up
+        store.put("a" * 32, b"a" * 32)
+        rows.update(["a" * 32, "b" * 32])
+
+    monkeypatch.setattr(store, "entries", entries)
+    report = collect_garbage(store, [], set(), 60, in_use=rows.__contains__)
+    assert report.deleted == 1
+    assert store.read("a" * 32) == b"a" * 32
+    assert store.read("b" * 32) == b"b" * 32
+    assert not store.exists("c" * 32)
+    if not packs:
+        assert sorted(e.name for e in store.files()) == ["a" * 32, "b" * 32]
@@ -1,8 +1,14 @@
-import io
 import base64
+import io
+import os
 
-from flask import g, session, url_for
+import pytest
+from flask import Flask, g, session, url_for
 from flask.testing import FlaskClient
+from PIL import Image
+
+import rav2
+from rav2.models import Counter, db
 
 img_data = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/PchI7wAAAABJRU5ErkJggg=="
 
@@ -21,10 +27,15 @@ def test_anon_user(client: FlaskClient):
     assert response.status_code == 302
 
 
-def test_user(user_client: FlaskClient):
+def test_user(app: Flask, user_client: FlaskClient):
     response = user_client.get(url_for("user"))
     assert response.status_code == 200
 
+    app.config["AVATARS_PER_PAGE"] = 1
+    response = user_client.get(url_for("user", before=2))
+    assert b'id="av1"' in response.data
+    assert b'id="av2"' not in response.data
+
 
 def test_toggle(user_client: FlaskClient):
     response = user_client.get("/toggle?avatar_id=1")
@@ -39,10 +50,23 @@ def test_toggle(user_client: FlaskClient):
     assert response.data == b"no"
 
 
+def test_toggle_showcase(user_client: FlaskClient):
+    hash = "0c15b14b8e32985f39a52c0a071ae6cd"
+    assert hash.encode() in user_client.get("/").data
+
+    user_client.get("/toggle?avatar_id=1")
+    for _ in range(5):
+        assert hash.encode() not in user_client.get("/").data
+
+    user_client.get("/toggle?avatar_id=1")
+    assert hash.encode() in user_client.get("/").data
+
+
 def test_delete(user_client: FlaskClient):
     # test's avatar
     response = user_client.get("/delete?avatar_id=1")
     assert response.status_code == 302
+    assert g.user.avatar_count == 1
 
     # test2's avatar
     response = user_client.get("/delete?avatar_id=3")
@@ -64,6 +88,64 @@ def test_upload(user_client: FlaskClient):
         content_type="multipart/form-data",
     )
     assert response.status_code == 302
+    assert g.user.avatars[0].data == base64.b64decode(img_data)
+    assert g.user.avatar_count == 3
+
+
+def test_upload_lock(
+    user_client: FlaskClient, queries: list[str], monkeypatch: pytest.MonkeyPatch
+):
+    # the upload is stored before the transaction (and so the write lock)
+    # starts, not while holding it
+    ingest = rav2.ingest
+    before_ingest: list[str] = []
+
+    def spy(fp):
+        before_ingest.extend(queries)
+        return ingest(fp)
+
+    monkeypatch.setattr(rav2, "ingest", spy)
+    db.session.commit()
+    queries.clear()
+    response = user_client.post(
+        url_for("upload"),
+        data={"avatar_data": (io.BytesIO(base64.b64decode(img_data)), "test.png")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 302
+    assert before_ingest == []
+    assert queries[0] == "BEGIN IMMEDIATE"
+    # without loading the user's other avatars
+    assert not [q for q in queries if "WHERE ? = avatars.owner_id" in q]
+
+
+def test_upload_thumb(app: Flask, user_client: FlaskClient):
+    data = io.BytesIO()
+    Image.new("RGB", (300, 200), "purple").save(data, "PNG")
+    data.seek(0)
+    response = user_client.post(
+        url_for("upload"),
+        data={"avatar_data": (data, "big.png")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 302
+    avatar = g.user.avatars[0]
+    assert not os.path.exists(avatar.thumbname)
+
+    # the thumbnail and compact copies are made in the background
+    response = user_client.get(url_for("user"))
+    assert b"Thumbnail for big.png</td>" in response.data
+    assert b"Compact copies of big.png</td>" in response.data
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=["worker", "--burst"])
+    assert "Ran 2 jobs: 2 done, 0 to retry, 0 failed." in result.output
+    assert Image.open(avatar.thumbname).size == (144, 96)
+    formats = app.extensions["rav2.formats"]
+    assert all(
+        os.path.exists(formats.path(avatar.hash, format)) for format in formats.formats
+    )
+    response = user_client.get(url_for("user"))
+    assert b"Processing" not in response.data
 
 
 def test_upload_long(user_client: FlaskClient):
@@ -73,3 +155,56 @@ def test_upload_long(user_client: FlaskClient):
         content_type="multipart/form-data",
     )
     assert response.status_code == 302
+
+
+def test_upload_dedupe(user_client: FlaskClient):
+    for _ in range(2):
+        user_client.post(
+            url_for("upload"),
+            data={"avatar_data": (io.BytesIO(base64.b64decode(img_data)), "a.png")},
+            content_type="multipart/form-data",
+        )
+    a, b = g.user.avatars[0:2]
+    assert a.id != b.id
+    assert a.dataname == b.dataname
+
+
+@pytest.mark.parametrize(
+    ("config", "data", "error"),
+    (
+        ({}, b"not an image", b"look like an image"),
+        ({"AVATAR_MAX_BYTES": 10}, base64.b64decode(img_data), b"max 10 bytes"),
+        ({"AVATAR_MAX_PIXELS": 0}, base64.b64decode(img_data), b"max 0 pixels"),
+    ),
+)
+def test_upload_invalid(app: Flask, user_client: FlaskClient, config, data, error):
+    app.config.update(config)
+    response = user_client.post(
+        url_for("upload"),
+        data={"avatar_data": (io.BytesIO(data), "bad.png")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 403
+    assert error in response.data
+    assert len(g.user.avatars) == 2
+    assert not os.listdir(os.path.join(app.config["AVATAR_DIR"], "incoming"))
+
+
+def test_gallery_cache(user_client: FlaskClient):
+    response = user_client.get("/test.html")
+    etag = response.headers["ETag"]
+    assert "Last-Modified" in response.headers
+
+    response = user_client.get("/test.html", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    user_client.post(url_for("settings"), data={"message": "Hello!", "email": ""})
+    response = user_client.get("/test.html", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert b"Hello!" in response.data
+    assert response.headers["ETag"] != etag
+    assert repr(Counter.read("user:1")) == "Counter('user:1', 1)"
+
+    assert b"0c15b14b8e32985f39a52c0a071ae6cd" in user_client.get("/gallery").data
+    user_client.get("/toggle?avatar_id=1")
+    assert b"0c15b14b8e32985f39a52c0a071ae6cd" not in user_client.get("/gallery").data
@@ -0,0 +1,65 @@
+import os
+
+from PIL import Image
+
+from rav2.variants import VariantCache, resize
+
+
+def test_eviction(tmp_path):
+    path = str(tmp_path / "src.png")
+    Image.new("RGB", (64, 64), "purple").save(path, "PNG")
+
+    def src():
+        return open(path, "rb")
+
+    cache = VariantCache(str(tmp_path / "variants"), max_bytes=0)
+    a = cache.get(src, "a" * 32, "PNG", (16, 16))
+    assert Image.open(a).size == (16, 16)
+    assert cache.get(src, "a" * 32, "PNG", (16, 16)) == a
+
+    # the least recently used variants get evicted
+    size = os.path.getsize(a)
+    cache.max_bytes = int(size * 2.5)
+    b = cache.get(src, "b" * 32, "PNG", (16, 16))
+    assert os.path.exists(a) and os.path.exists(b)
+    os.utime(a, (0, 0))
+    c = cache.get(src, "c" * 32, "PNG", (16, 16))
+    assert not os.path.exists(a)
+    assert os.path.exists(b) and os.path.exists(c)
+
+    # down to the low-water mark, rather than just under the limit; files
+    # which are still being written are left alone
+    tmp = f"{cache.path('d' * 32, (16, 16))}.1.2.tmp"
+    os.makedirs(os.path.dirname(tmp))
+    with open(tmp, "wb") as fp:
+        fp.write(b"x" * size * 10)
+    os.utime(b, (0, 0))
+    cache.max_bytes = int(size * 2.1)
+    d = cache.get(src, "d" * 32, "PNG", (16, 16))
+    assert not os.path.exists(b) and not os.path.exists(c)
+    assert os.path.exists(d) and os.path.exists(tmp)
+
+
+def test_resize_animated(tmp_path):
+    src = str(tmp_path / "src.gif")
+    frames = [Image.new("RGB", (64, 64), colour) for colour in ("red", "lime", "blue")]
+    frames[0].save(
+        src, "GIF", save_all=True, append_images=frames[1:], duration=50, loop=0
+    )
+
+    dst = str(tmp_path / "thumbs" / "dst.gif")
+    resize(src, dst, (16, 16), "GIF")
+    with Image.open(dst) as img:
+        assert img.size == (16, 16)
+        assert getattr(img, "n_frames", 1) == 3
+        assert img.info["duration"] == 50
+        assert img.info["loop"] == 0
+        img.seek(2)
+        assert img.convert("RGB").getpixel((8, 8)) == (0, 0, 255)
+
+    # too many frames to hold at once, so only the first is kept
+    resize(src, dst, (16, 16), "GIF", max_pixels=16 * 16 * 2)
+    with Image.open(dst) as img:
+        assert img.size == (16, 16)
+        assert getattr(img, "n_frames", 1) == 1
+        assert img.convert("RGB").getpixel((8, 8)) == (255, 0, 0)